@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Measure v1 API endpoint throughput against a synthetic fleet
+
+A fleet of storages, machines, sources, a FilterSet graph and BackupLog
+history is built in a throwaway SQLite database.  Each endpoint is then
+sent a fixed, seeded sequence of requests at the given concurrency,
+either through Django's test client or a WSGI server in this process,
+and its latency percentiles, request rate and database queries per
+request are printed as JSON.  For example:
+
+    python3 benchmarks/api_load.py --machines 1000 --filter-sets 30 \\
+        --logs-per-source 10 --requests 2000 --concurrency 8 --transport wsgi
+
+Secrets are hashed with a fast hasher unless --real-hasher is given, so
+the results reflect the API rather than the password hasher.
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import random
+import socketserver
+import threading
+import time
+from wsgiref import simple_server
+
+import common
+
+ENDPOINTS = (
+    "agent_ping_checkin",
+    "update_config",
+    "storage_ping_source_update",
+    "storage_update_config",
+    "agent_ping_restore",
+    "storage_ping_checkin",
+    "storage_ping_checkin_batch",
+)
+DEFAULT_ENDPOINTS = ENDPOINTS[:4]
+SECRET = "bench"
+
+
+class RequestBuilder:
+    """Seeded request bodies for each endpoint"""
+
+    def __init__(self, machines, sources, rnd):
+        self.machines = machines
+        self.sources = sources
+        self.rnd = rnd
+        self.serial = 0
+
+    def machine_auth(self, machine):
+        return {"uuid": str(machine.uuid), "secret": SECRET}
+
+    def storage_auth(self, storage):
+        return {"name": storage.name, "secret": SECRET}
+
+    def agent_ping_checkin(self, machine):
+        return {"machine": self.machine_auth(machine)}
+
+    def agent_ping_restore(self, machine):
+        return {"machine": self.machine_auth(machine)}
+
+    def update_config(self, machine):
+        # The comment changes on each request, so the full config is
+        # compared and saved rather than short-circuited by config_hash
+        self.serial += 1
+        sources = {
+            source.name: {
+                "path": source.path,
+                "frequency": "daily",
+                "retention": "last 5 days, earliest of month",
+                "comment": "bench {}".format(self.serial),
+                "filter": source.filter,
+                "exclude": ["*.swp"],
+            }
+            for source in self.sources[machine.pk]
+        }
+        return {"machine": dict(self.machine_auth(machine), unit_name=machine.unit_name, sources=sources)}
+
+    def storage_ping_checkin(self, machine):
+        return {"storage": self.storage_auth(machine.storage), "machine": {"uuid": str(machine.uuid)}}
+
+    def storage_ping_checkin_batch(self, machine):
+        # All of the machine's storage's machines in one request
+        machines = [str(m.uuid) for m in self.machines if m.storage_id == machine.storage_id]
+        return {"storage": self.storage_auth(machine.storage), "machines": machines}
+
+    def storage_ping_source_update(self, machine):
+        now = time.time()
+        sources = {
+            source.name: {
+                "success": True,
+                "snapshot": "bench-{}".format(int(now)),
+                "summary": "Synthetic backup",
+                "time_begin": now - 600,
+                "time_end": now,
+            }
+            for source in self.sources[machine.pk]
+        }
+        return {"storage": self.storage_auth(machine.storage), "machine": {"uuid": str(machine.uuid), "sources": sources}}
+
+    def storage_update_config(self, machine):
+        storage = machine.storage
+        return {
+            "storage": dict(
+                self.storage_auth(storage),
+                ssh_ping_host=storage.ssh_ping_host,
+                ssh_ping_host_keys=storage.ssh_ping_host_keys,
+                ssh_ping_port=storage.ssh_ping_port,
+                ssh_ping_user=storage.ssh_ping_user,
+                space_total=storage.space_total,
+                space_available=storage.space_available,
+            )
+        }
+
+    def build(self, endpoint, count):
+        return [getattr(self, endpoint)(self.rnd.choice(self.machines)) for i in range(count)]
+
+
+class ClientTransport:
+    """Requests through Django's test client, one client per thread"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def post(self, endpoint, body):
+        from django.test import Client
+
+        if not hasattr(self.local, "client"):
+            self.local.client = Client()
+        return self.local.client.post("/v1/{}".format(endpoint), body, content_type="application/json").status_code
+
+    def close(self):
+        pass
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class WSGITransport:
+    """Requests over HTTP to a threaded WSGI server in this process"""
+
+    def __init__(self):
+        from django.core.wsgi import get_wsgi_application
+
+        self.server = simple_server.make_server(
+            "127.0.0.1", 0, get_wsgi_application(), server_class=_ThreadingWSGIServer, handler_class=_QuietHandler
+        )
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.local = threading.local()
+
+    def post(self, endpoint, body):
+        if not hasattr(self.local, "conn"):
+            self.local.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            self.local.conn.request("POST", "/v1/{}".format(endpoint), body, {"Content-Type": "application/json"})
+            response = self.local.conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            del self.local.conn
+            raise
+        return response.status
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_endpoint(transport, endpoint, bodies, concurrency):
+    from django.db import connections
+
+    from turku_api.metrics import metrics
+
+    pending = iter(bodies)
+    lock = threading.Lock()
+
+    def worker():
+        timings = []
+        errors = 0
+        try:
+            while True:
+                with lock:
+                    body = next(pending, None)
+                if body is None:
+                    return timings, errors
+                start = time.perf_counter()
+                try:
+                    status = transport.post(endpoint, body)
+                except (OSError, http.client.HTTPException):
+                    status = None
+                timings.append(time.perf_counter() - start)
+                if status != 200:
+                    errors += 1
+        finally:
+            connections.close_all()
+
+    metrics.clear()
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda i: worker(), range(concurrency)))
+    elapsed = time.monotonic() - start
+    out = common.summarize([t for r in results for t in r[0]], elapsed, sum(r[1] for r in results))
+    histogram = metrics.get_histogram("turku_request_duration_seconds", endpoint=endpoint)
+    handled = histogram.count if histogram else 0
+    out["queries_per_request"] = metrics.get("turku_request_db_queries_total", endpoint=endpoint) / handled if handled else None
+    out["response_bytes_per_request"] = metrics.get("turku_response_bytes_total", endpoint=endpoint) / handled if handled else None
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storages", type=int, default=4)
+    parser.add_argument("--machines", type=int, default=1000)
+    parser.add_argument("--sources-per-machine", type=int, default=5)
+    parser.add_argument("--filter-sets", type=int, default=30, help="FilterSets in the merge graph")
+    parser.add_argument("--logs-per-source", type=int, default=10)
+    parser.add_argument(
+        "--endpoints", default=",".join(DEFAULT_ENDPOINTS), help="Comma-separated endpoints (of {})".format(", ".join(ENDPOINTS))
+    )
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--transport", choices=("client", "wsgi"), default="client")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--real-hasher", action="store_true", help="Use the configured password hashers")
+    args = parser.parse_args()
+
+    endpoints = args.endpoints.split(",")
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            parser.error("Unknown endpoint {}".format(endpoint))
+
+    db_path = common.setup_django()
+    try:
+        from django.conf import settings
+
+        if not args.real_hasher:
+            settings.PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+        common.migrate()
+        storages, machines = common.build_fleet(
+            storages=args.storages,
+            machines=args.machines,
+            sources_per_machine=args.sources_per_machine,
+            logs_per_source=args.logs_per_source,
+            filter_sets=args.filter_sets,
+            secret=SECRET,
+        )
+
+        from turku_api.heartbeat import heartbeats
+        from turku_api.models import Source
+
+        sources = {machine.pk: [] for machine in machines}
+        for source in Source.objects.all():
+            sources[source.machine_id].append(source)
+        builder = RequestBuilder(machines, sources, random.Random(args.seed))
+
+        transport = ClientTransport() if args.transport == "client" else WSGITransport()
+        results = {}
+        try:
+            for endpoint in endpoints:
+                common.progress("Driving {}".format(endpoint))
+                bodies = [json.dumps(req) for req in builder.build(endpoint, args.requests)]
+                results[endpoint] = run_endpoint(transport, endpoint, bodies, args.concurrency)
+        finally:
+            transport.close()
+            # Write buffered check-ins while the database still exists
+            heartbeats.flush()
+        print(json.dumps({"config": vars(args), "endpoints": results}, indent=2, sort_keys=True))
+    finally:
+        os.unlink(db_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Shared helpers for turku-api benchmarks
+
+Benchmarks run against a throwaway SQLite database (or the database
+configured by DJANGO_SETTINGS_MODULE when requested), never against
+live data unless explicitly pointed at it.
+"""
+
+from datetime import timedelta
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django(db_path=None, use_configured_db=False):
+    """Configure Django for a benchmark run and return the database path"""
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "turku_api.settings")
+
+    import django
+    from django.conf import settings
+
+    if not use_configured_db:
+        if db_path is None:
+            fd, db_path = tempfile.mkstemp(prefix="turku-bench-", suffix=".sqlite3")
+            os.close(fd)
+        settings.DATABASES["default"] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": db_path,
+            # Concurrent load benchmarks contend for the write lock
+            "OPTIONS": {"timeout": 60},
+        }
+    django.setup()
+    return settings.DATABASES["default"]["NAME"]
+
+
+def migrate(target=None):
+    from django.core.management import call_command
+
+    if target:
+        call_command("migrate", "turku_api", target, verbosity=0)
+    else:
+        call_command("migrate", verbosity=0)
+
+
+def progress(message):
+    sys.stderr.write("{}\n".format(message))
+    sys.stderr.flush()
+
+
+def build_filter_sets(count, depth=3, rnd=None):
+    """Create a graph of FilterSets and return the top level's names
+
+    FilterSets are arranged in depth levels, each merging one or two
+    FilterSets from the level below, as sites commonly layer
+    service-specific filters over shared base filters.
+    """
+    from turku_api.models import FilterSet
+
+    rnd = rnd or random.Random(0)
+    names = ["bench-filters-{}".format(i) for i in range(count)]
+    levels = [names[i::depth] for i in range(depth)]
+    filter_sets = []
+    for level, level_names in enumerate(levels):
+        for name in level_names:
+            filters = ["- /var/cache/{}/*".format(name), "- *.tmp"]
+            if level > 0 and levels[level - 1]:
+                for merged in rnd.sample(levels[level - 1], min(2, len(levels[level - 1]))):
+                    filters.append("merge {}".format(merged))
+            filter_sets.append(FilterSet(name=name, filters=filters))
+    FilterSet.objects.bulk_create(filter_sets)
+    progress("Created {} filter sets".format(count))
+    return levels[-1] or names
+
+
+def build_fleet(storages=1, machines=10, sources_per_machine=10, logs_per_source=0, filter_sets=0, secret="bench", batch_size=5000):
+    """Create a synthetic fleet and return (storages, machines)
+
+    All Machines and Storages share the same secret.  Source schedules
+    are spread over the previous and next day, so roughly half of the
+    sources are due at any time.  With filter_sets, a FilterSet graph
+    is created and each source merges one of its top-level FilterSets.
+    """
+    from django.contrib.auth import hashers
+    from django.utils import timezone
+
+    from turku_api.models import Auth, BackupLog, Machine, Source, Storage
+
+    rnd = random.Random(0)
+    now = timezone.now()
+    secret_hash = hashers.make_password(secret)
+    storage_auth = Auth.objects.create(
+        name="bench-storage-{}".format(uuid.uuid4()), secret_hash=secret_hash, secret_type="storage_reg"
+    )
+    machine_auth = Auth.objects.create(
+        name="bench-machine-{}".format(uuid.uuid4()), secret_hash=secret_hash, secret_type="machine_reg"
+    )
+
+    storage_objs = Storage.objects.bulk_create(
+        [
+            Storage(
+                name="bench-storage-{}".format(i),
+                secret_hash=secret_hash,
+                ssh_ping_host="storage{}.example.com".format(i),
+                ssh_ping_host_keys=["ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBenchmarkHostKey"],
+                ssh_ping_port=22,
+                ssh_ping_user="turku",
+                space_total=1000000,
+                space_available=rnd.randint(1000, 1000000),
+                auth=storage_auth,
+                date_checked_in=now,
+            )
+            for i in range(storages)
+        ]
+    )
+
+    machine_objs = []
+    for i in range(machines):
+        machine_objs.append(
+            Machine(
+                uuid=uuid.UUID(int=rnd.getrandbits(128), version=4),
+                secret_hash=secret_hash,
+                unit_name="bench-machine-{}".format(i),
+                ssh_public_key="ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBenchmarkMachineKey{} bench".format(i),
+                auth=machine_auth,
+                storage=storage_objs[i % storages],
+                date_checked_in=now,
+            )
+        )
+    Machine.objects.bulk_create(machine_objs, batch_size=batch_size)
+    progress("Created {} storages, {} machines".format(storages, machines))
+
+    filter_names = build_filter_sets(filter_sets, rnd=rnd) if filter_sets else []
+
+    source_batch = []
+    source_ids = []
+
+    def flush_sources():
+        Source.objects.bulk_create(source_batch, batch_size=batch_size)
+        source_ids.extend(s.id for s in source_batch)
+        source_batch.clear()
+
+    for machine in machine_objs:
+        for j in range(sources_per_machine):
+            source_batch.append(
+                Source(
+                    name="source{}".format(j),
+                    machine=machine,
+                    path="/srv/source{}".format(j),
+                    date_last_backed_up=now - timedelta(days=1),
+                    date_next_backup=now + timedelta(seconds=rnd.randint(-86400, 86400)),
+                    filter=(["merge {}".format(rnd.choice(filter_names)), "- *.swp"] if filter_names else []),
+                )
+            )
+            if len(source_batch) >= batch_size:
+                flush_sources()
+    flush_sources()
+    progress("Created {} sources".format(len(source_ids)))
+
+    if logs_per_source:
+        log_batch = []
+        created = 0
+        start = time.monotonic()
+        for source_id in source_ids:
+            storage = storage_objs[rnd.randrange(storages)]
+            for k in range(logs_per_source):
+                date = now - timedelta(days=k + 1)
+                log_batch.append(
+                    BackupLog(
+                        source_id=source_id,
+                        storage=storage,
+                        date=date,
+                        success=True,
+                        date_begin=date - timedelta(minutes=10),
+                        date_end=date,
+                        snapshot=date.strftime("%Y-%m-%dT%H:%M:%S"),
+                    )
+                )
+            if len(log_batch) >= batch_size:
+                BackupLog.objects.bulk_create(log_batch, batch_size=batch_size)
+                created += len(log_batch)
+                log_batch = []
+                if created % (batch_size * 100) < batch_size:
+                    progress("Created {} logs ({:.0f}/s)".format(created, created / (time.monotonic() - start)))
+        BackupLog.objects.bulk_create(log_batch, batch_size=batch_size)
+        created += len(log_batch)
+        progress("Created {} logs".format(created))
+
+    return storage_objs, machine_objs
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a list of values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)]
+
+
+def summarize(timings, elapsed, errors=0):
+    """Return request count, rate and latency percentiles of a load run"""
+    return {
+        "requests": len(timings),
+        "errors": errors,
+        "requests_per_second": len(timings) / elapsed if elapsed else None,
+        "p50_ms": (percentile(timings, 50) or 0) * 1000,
+        "p99_ms": (percentile(timings, 99) or 0) * 1000,
+    }
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Compare the gthread (WSGI) and ASGI deployments under HTTP load
+
+A synthetic fleet is built in a throwaway SQLite database, then each
+server is started in turn (gunicorn with gthread workers, and uvicorn
+serving the async views) and driven with agent and storage check-ins
+at the given concurrency.  gunicorn and uvicorn must be installed.
+For example:
+
+    python3 benchmarks/http_load.py --machines 1000 --concurrency 32 \\
+        --duration 30 --workers 2
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+
+import common
+
+SERVERS = {
+    "gthread": lambda args, port: [
+        "gunicorn",
+        "-k",
+        "gthread",
+        "--workers",
+        str(args.workers),
+        "--threads",
+        str(args.threads),
+        "--bind",
+        "127.0.0.1:{}".format(port),
+        "turku_api.wsgi:application",
+    ],
+    "asgi": lambda args, port: [
+        "uvicorn",
+        "--workers",
+        str(args.workers),
+        "--port",
+        str(port),
+        "--log-level",
+        "warning",
+        "--no-access-log",
+        "turku_api.asgi:application",
+    ],
+}
+
+
+def write_settings(settings_dir, db_path, async_api):
+    with open(os.path.join(settings_dir, "bench_settings.py"), "w") as f:
+        f.write(textwrap.dedent("""\
+                from turku_api.settings import *  # noqa: F401,F403
+
+                DATABASES = {{"default": {{"ENGINE": "django.db.backends.sqlite3", "NAME": {db_path!r}}}}}
+                TURKU_ASYNC_API = {async_api!r}
+                """).format(db_path=db_path, async_api=async_api))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start listening on port {}".format(port))
+
+
+def requests_for(storages, machines, secret):
+    """Return a list of (view name, request) to pick from"""
+    out = []
+    for machine in machines:
+        out.append(("agent_ping_checkin", {"machine": {"uuid": str(machine.uuid), "secret": secret}}))
+        out.append(
+            (
+                "storage_ping_checkin",
+                {"storage": {"name": machine.storage.name, "secret": secret}, "machine": {"uuid": str(machine.uuid)}},
+            )
+        )
+    return out
+
+
+def drive(port, requests, concurrency, duration):
+    """Send requests from concurrency threads for duration seconds"""
+    local = threading.local()
+    deadline = time.monotonic() + duration
+    rnd = random.Random(0)
+    lock = threading.Lock()
+
+    def worker():
+        timings = []
+        errors = 0
+        local.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        while time.monotonic() < deadline:
+            with lock:
+                view_name, req = rnd.choice(requests)
+            body = json.dumps(req)
+            start = time.perf_counter()
+            try:
+                local.conn.request("POST", "/v1/" + view_name, body, {"Content-Type": "application/json"})
+                response = local.conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors += 1
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                local.conn.close()
+                local.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                continue
+            timings.append(time.perf_counter() - start)
+        local.conn.close()
+        return timings, errors
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda i: worker(), range(concurrency)))
+    elapsed = time.monotonic() - start
+    return common.summarize([t for r in results for t in r[0]], elapsed, sum(r[1] for r in results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storages", type=int, default=4)
+    parser.add_argument("--machines", type=int, default=1000)
+    parser.add_argument("--sources-per-machine", type=int, default=5)
+    parser.add_argument("--servers", default="gthread,asgi", help="Comma-separated servers to compare")
+    parser.add_argument("--workers", type=int, default=2, help="Server worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="Threads per gthread worker")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent client connections")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to drive each server")
+    args = parser.parse_args()
+
+    for server in args.servers.split(","):
+        if server not in SERVERS:
+            parser.error("Unknown server {}".format(server))
+        if not shutil.which(SERVERS[server](args, 0)[0]):
+            parser.error("{} is not installed".format(SERVERS[server](args, 0)[0]))
+
+    settings_dir = tempfile.mkdtemp(prefix="turku-bench-")
+    db_path = common.setup_django(os.path.join(settings_dir, "db.sqlite3"))
+    try:
+        common.migrate()
+        storages, machines = common.build_fleet(
+            storages=args.storages, machines=args.machines, sources_per_machine=args.sources_per_machine
+        )
+        requests = requests_for(storages, machines, "bench")
+
+        results = {}
+        for server in args.servers.split(","):
+            write_settings(settings_dir, db_path, server == "asgi")
+            env = dict(
+                os.environ,
+                DJANGO_SETTINGS_MODULE="bench_settings",
+                PYTHONPATH=os.pathsep.join([settings_dir, common.BASE_DIR]),
+            )
+            port = free_port()
+            proc = subprocess.Popen(SERVERS[server](args, port), env=env, cwd=common.BASE_DIR, stdout=sys.stderr)
+            try:
+                wait_for_port(port)
+                common.progress("Driving {}".format(server))
+                # Warm up secret caches and connections
+                drive(port, requests, args.concurrency, min(2, args.duration))
+                results[server] = drive(port, requests, args.concurrency, args.duration)
+            finally:
+                proc.terminate()
+                proc.wait()
+        print(json.dumps(results, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(settings_dir)
+
+
+if __name__ == "__main__":
+    main()
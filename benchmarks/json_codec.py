@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Compare JSON encode/decode throughput of the serialization backends
+
+A synthetic agent_ping_restore response and update_config request are
+encoded and decoded with each available backend.  For example:
+
+    python3 benchmarks/json_codec.py --sources 50 --repeat 2000
+"""
+
+import argparse
+import json
+import os
+import time
+
+import common
+
+
+def payloads(sources):
+    storage = {
+        "name": "storage1",
+        "ssh_ping_host": "storage1.example.com",
+        "ssh_ping_host_keys": ["ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{:040d}".format(i) for i in range(3)],
+        "ssh_ping_port": 22,
+        "ssh_ping_user": "turku",
+    }
+    restore = {"machine": {"sources": {}}}
+    update_config = {"machine": {"uuid": "9d9e8a6b-2f5c-4b1e-8c3a-6f0d1e2a7b45", "secret": "x" * 30, "sources": {}}}
+    for i in range(sources):
+        filters = ["- /srv/source{}/cache/*".format(i), "merge common", "- *.tmp", "+ */", "- *"]
+        restore["machine"]["sources"]["source{}".format(i)] = {
+            "path": "/srv/source{}".format(i),
+            "retention": "last 5 days, earliest of month",
+            "bwlimit": None,
+            "filter": filters,
+            "exclude": ["*.swp", "lost+found"],
+            "shared_service": False,
+            "large_rotating_files": False,
+            "large_modifying_files": False,
+            "snapshot_mode": None,
+            "preserve_hard_links": False,
+            "storage": storage,
+        }
+        update_config["machine"]["sources"]["source{}".format(i)] = {
+            "path": "/srv/source{}".format(i),
+            "frequency": "daily, 0200-0600",
+            "filter": filters,
+        }
+    return {"agent_ping_restore": restore, "update_config": update_config}
+
+
+def rate(func, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        func()
+    return repeat / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sources", type=int, default=50, help="Sources per payload")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    db_path = common.setup_django()
+    try:
+        from turku_api import serialization
+
+        backends = ["json"] + (["orjson"] if serialization.orjson is not None else [])
+        results = {}
+        for backend in backends:
+            serialization.BACKEND = backend
+            results[backend] = {}
+            for name, obj in payloads(args.sources).items():
+                encoded = serialization.dumps(obj)
+                results[backend][name] = {
+                    "bytes": len(encoded),
+                    "encode_per_second": rate(lambda: serialization.dumps(obj), args.repeat),
+                    "decode_per_second": rate(lambda: serialization.loads(encoded), args.repeat),
+                }
+        print(json.dumps(results, indent=2, sort_keys=True))
+    finally:
+        os.unlink(db_path)
+
+
+if __name__ == "__main__":
+    main()
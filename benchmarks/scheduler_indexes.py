@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Show query plans and latencies of the scheduler/health/log queries
+
+A synthetic fleet is built and migrated back to the pre-index schema
+(migration 0001), the queries are measured, then the later migrations
+are applied and the queries are measured again.  For example:
+
+    python3 benchmarks/scheduler_indexes.py --machines 10000 \\
+        --sources-per-machine 10 --logs-per-source 100
+"""
+
+import argparse
+from datetime import timedelta
+import json
+import os
+import time
+
+import common
+
+
+def timed(func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def measure(args, machines):
+    from django.utils import timezone
+
+    from turku_api.models import BackupLog, Source
+
+    now = timezone.now()
+    machine = machines[len(machines) // 2]
+    source = Source.objects.filter(machine=machine).first()
+    queries = {
+        "scheduled_sources": Source.objects.filter(machine=machine, date_next_backup__lte=now, active=True, published=True),
+        "health_sources": Source.objects.filter(machine__active=True, machine__published=True, active=True, published=True),
+        "source_log_history": BackupLog.objects.filter(source=source).order_by("-date")[:10],
+        "clean_logs": BackupLog.objects.filter(date_end__lt=now - timedelta(days=args.logs_per_source // 2 or 1)),
+    }
+    out = {}
+    for name, qs in queries.items():
+        if name in ("health_sources", "clean_logs"):
+            func = qs.count
+        else:
+            func = lambda qs=qs: list(qs.all())  # noqa: E731
+        timings = timed(func, args.repeat)
+        out[name] = {
+            "plan": qs.explain(),
+            "p50_ms": common.percentile(timings, 50) * 1000,
+            "max_ms": max(timings) * 1000,
+        }
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--storages", type=int, default=10)
+    parser.add_argument("--machines", type=int, default=10000)
+    parser.add_argument("--sources-per-machine", type=int, default=10)
+    parser.add_argument("--logs-per-source", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--db", default=None, help="SQLite database path to create (default temporary)")
+    parser.add_argument("--keep-db", action="store_true", help="Do not remove the database afterward")
+    args = parser.parse_args()
+
+    db_path = common.setup_django(args.db)
+    try:
+        # The fleet is built with the current models, then migrated
+        # back to the pre-index schema
+        common.migrate()
+        storages, machines = common.build_fleet(
+            storages=args.storages,
+            machines=args.machines,
+            sources_per_machine=args.sources_per_machine,
+            logs_per_source=args.logs_per_source,
+        )
+        common.migrate("0001")
+        results = {"before": measure(args, machines)}
+        start = time.perf_counter()
+        common.migrate()
+        results["index_build_seconds"] = time.perf_counter() - start
+        results["after"] = measure(args, machines)
+        print(json.dumps(results, indent=2, sort_keys=True))
+    finally:
+        if not args.keep_db:
+            os.unlink(db_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.db.models import Min
+from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+
+from turku_api import tokens
+from turku_api.cache import secret_cache
+from turku_api.hashing import HasherSaturated, hasher_pool
+from turku_api.heartbeat import heartbeats
+from turku_api.longpoll import waits
+from turku_api.metrics import metrics
+from turku_api.models import Auth, BackupLog, FilterSet, Machine, Source, Storage
+from turku_api.profiling import instrument
+from turku_api.serialization import json_response
+from turku_api.views import (
+    HttpResponseException,
+    SourceResponseBuilder,
+    ViewV1,
+    hasher_saturated_response,
+    longpoll_timeout,
+    path,
+)
+
+
+class AsyncViewV1(ViewV1):
+    """v1 API for ASGI deployments
+
+    Logins, check-ins and health checks use the async ORM, password
+    hashing runs in the bounded hasher pool, and long-polls wait
+    without holding a thread.  Endpoints which write within
+    transactions run the synchronous implementation in a thread, as
+    Django's transaction API is synchronous only.  Async counterparts
+    of ViewV1 helpers are prefixed with "a", so the synchronous
+    endpoints keep using the originals.
+    """
+
+    async def acheck_secret(self, kind, ident, secret, obj):
+        if secret_cache.check(kind, ident, secret, obj.secret_hash):
+            return True
+        valid, upgraded = await hasher_pool.check_password(secret, obj.secret_hash)
+        if not valid:
+            return False
+        if upgraded is not None:
+            obj.secret_hash = await hasher_pool.make_password(upgraded)
+            await obj.asave(update_fields=["secret_hash"])
+        secret_cache.add(kind, ident, secret, obj.secret_hash)
+        return True
+
+    async def acheck_login(self, kind, ident, req_login, obj):
+        if "secret" in req_login:
+            return await self.acheck_secret(kind, ident, req_login["secret"], obj)
+        return tokens.verify(req_login["token"], kind, obj)
+
+    async def amachine_login(self):
+        if not (("machine" in self.req) and (isinstance(self.req["machine"], dict))):
+            raise HttpResponseException(HttpResponseBadRequest('"machine" dict required'))
+        if "uuid" not in self.req["machine"]:
+            raise HttpResponseException(HttpResponseBadRequest('Missing required machine option "uuid"'))
+        if not ({"secret", "token"} & set(self.req["machine"])):
+            raise HttpResponseException(HttpResponseBadRequest('Missing required machine option "secret"'))
+
+        try:
+            machine = await Machine.objects.select_related("storage").aget(
+                uuid=uuid.UUID(self.req["machine"]["uuid"]), active=True, published=True
+            )
+        except Machine.DoesNotExist:
+            raise HttpResponseException(HttpResponseForbidden("Bad auth"))
+        if not await self.acheck_login("machine", machine.uuid, self.req["machine"], machine):
+            raise HttpResponseException(HttpResponseForbidden("Bad auth"))
+        return machine
+
+    async def astorage_login(self):
+        if "storage" not in self.req:
+            raise HttpResponseException(HttpResponseBadRequest('Missing required option "storage"'))
+        if "name" not in self.req["storage"] or not ({"secret", "token"} & set(self.req["storage"])):
+            raise HttpResponseException(HttpResponseForbidden("Bad auth"))
+        try:
+            storage = await Storage.objects.aget(name=self.req["storage"]["name"], active=True)
+        except Storage.DoesNotExist:
+            raise HttpResponseException(HttpResponseForbidden("Bad auth"))
+        if not await self.acheck_login("storage", storage.name, self.req["storage"], storage):
+            raise HttpResponseException(HttpResponseForbidden("Bad auth"))
+        return storage
+
+    async def astorage_get_machine(self, storage):
+        if "machine" not in self.req:
+            raise HttpResponseException(HttpResponseBadRequest('Missing required option "machine"'))
+        if "uuid" not in self.req["machine"]:
+            raise HttpResponseException(HttpResponseBadRequest('Missing required option "machine.uuid"'))
+        try:
+            machine = await Machine.objects.aget(
+                uuid=uuid.UUID(self.req["machine"]["uuid"]), storage=storage, active=True, published=True
+            )
+        except Machine.DoesNotExist:
+            raise HttpResponseException(HttpResponseNotFound("Machine not found"))
+        machine.storage = storage
+        return machine
+
+    async def aget_checkin_scheduled_sources(self, machine):
+        now = timezone.localtime()
+        sources = [s async for s in machine.source_set.filter(date_next_backup__lte=now, active=True, published=True)]
+        if not sources:
+            return {}
+        # FilterSets are only loaded on a filter cache miss
+        return await sync_to_async(SourceResponseBuilder(machine.storage).build)(sources)
+
+    async def await_checkin_scheduled_sources(self, machine):
+        deadline = time.monotonic() + self.requested_wait()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {}
+            next_backup = (
+                await machine.source_set.filter(active=True, published=True).aaggregate(next_backup=Min("date_next_backup"))
+            )["next_backup"]
+            if await waits.async_wait(machine.pk, longpoll_timeout(remaining, next_backup)) is None:
+                return {}
+            scheduled_sources = await self.aget_checkin_scheduled_sources(machine)
+            if scheduled_sources:
+                return scheduled_sources
+
+    async def agent_ping_checkin(self):
+        machine = await self.amachine_login()
+        scheduled_sources = await self.aget_checkin_scheduled_sources(machine)
+        await sync_to_async(heartbeats.record)(machine, timezone.localtime())
+
+        if not scheduled_sources:
+            scheduled_sources = await self.await_checkin_scheduled_sources(machine)
+
+        return json_response({"machine": {"scheduled_sources": scheduled_sources}})
+
+    async def storage_ping_checkin(self):
+        storage = await self.astorage_login()
+        machine = await self.astorage_get_machine(storage)
+
+        scheduled_sources = await self.aget_checkin_scheduled_sources(machine)
+        await sync_to_async(heartbeats.record)(machine, timezone.localtime())
+
+        out = {
+            "machine": {
+                "uuid": str(machine.uuid),
+                "environment_name": machine.environment_name,
+                "service_name": machine.service_name,
+                "unit_name": machine.unit_name,
+                "scheduled_sources": scheduled_sources,
+            }
+        }
+        return json_response(out)
+
+    async def health(self):
+        out = {
+            "healthy": True,
+            "date": timezone.localtime().isoformat(),
+            "counts": {
+                "auth": await Auth.objects.acount(),
+                "storage": await Storage.objects.acount(),
+                "machine": await Machine.objects.acount(),
+                "source": await Source.objects.acount(),
+                "filter_set": await FilterSet.objects.acount(),
+                "backup_log": await BackupLog.objects.acount(),
+            },
+            "metrics": metrics.snapshot(),
+        }
+        return json_response(out)
+
+    async def session_token(self):
+        return await sync_to_async(ViewV1.session_token)(self)
+
+    async def update_config(self):
+        return await sync_to_async(ViewV1.update_config)(self)
+
+    async def agent_ping_restore(self):
+        return await sync_to_async(ViewV1.agent_ping_restore)(self)
+
+    async def storage_ping_checkin_batch(self):
+        return await sync_to_async(ViewV1.storage_ping_checkin_batch)(self)
+
+    async def storage_ping_source_update(self):
+        return await sync_to_async(ViewV1.storage_ping_source_update)(self)
+
+    async def storage_update_config(self):
+        return await sync_to_async(ViewV1.storage_update_config)(self)
+
+
+@csrf_exempt
+async def async_view_handler(request):
+    namespace_map = {"v1": AsyncViewV1}
+    namespace, name = request.resolver_match.view_name.split(":", 1)
+    with instrument(name, profile=False) as stats:
+        try:
+            stats.response = await getattr(namespace_map[namespace](request), name).__call__()
+        except HttpResponseException as e:
+            stats.response = e.message
+        except HasherSaturated as e:
+            stats.response = hasher_saturated_response(e)
+    return stats.response
+
+
+urls = (
+    [path(view_name, async_view_handler, name=view_name) for view_name in AsyncViewV1.view_names],
+    "turku_api",
+    "v1",
+)
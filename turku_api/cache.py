@@ -0,0 +1,217 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import collections
+import hashlib
+import hmac
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from turku_api.models import FilterSet, Machine, Source, Storage
+from turku_api.placement import placement
+
+
+class TTLCache:
+    """Thread-safe LRU cache with a bounded per-entry lifetime"""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= now:
+                del self._data[key]
+                self._evicted(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._evicted(self._data.popitem(last=False)[0])
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._evicted(key)
+
+    def clear(self):
+        with self._lock:
+            for key in self._data:
+                self._evicted(key)
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _evicted(self, key):
+        # Called with the lock held whenever a key is removed
+        pass
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class SecretCache(TTLCache):
+    """Cache of recently verified Machine/Storage secrets
+
+    Entries are keyed on the object type and login ID, and hold a keyed
+    digest of the login ID, the presented secret and the stored secret
+    hash.  A changed secret or secret hash will never match an old
+    entry, so only the hash function needs to be skipped on a hit.
+    """
+
+    def digest(self, kind, ident, secret, secret_hash):
+        msg = "\0".join((kind, str(ident), str(secret), secret_hash)).encode("UTF-8")
+        return hmac.new(settings.SECRET_KEY.encode("UTF-8"), msg, hashlib.sha256).digest()
+
+    def check(self, kind, ident, secret, secret_hash):
+        cached = self.get((kind, str(ident)))
+        if cached is None:
+            return False
+        return hmac.compare_digest(cached, self.digest(kind, ident, secret, secret_hash))
+
+    def add(self, kind, ident, secret, secret_hash):
+        self.set((kind, str(ident)), self.digest(kind, ident, secret, secret_hash))
+
+
+class FilterCache(TTLCache):
+    """Cache of fully expanded Source filter rule lists
+
+    Entries are keyed on a Source's filter rules as a tuple, and a reverse
+    dependency graph records which FilterSet names each expansion
+    referenced (whether or not the FilterSet existed at the time), so
+    a changed FilterSet only invalidates the expansions using it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.generation = 0
+        self._dependents = collections.defaultdict(set)
+        self._dependencies = {}
+
+    def set(self, key, value, names=(), generation=None):
+        """Add an expansion, unless the cache was invalidated since generation"""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._evicted(key)
+            super().set(key, value)
+            if key not in self._data:
+                return
+            self._dependencies[key] = frozenset(names)
+            for name in names:
+                self._dependents[name].add(key)
+
+    def invalidate_name(self, name):
+        with self._lock:
+            self.generation += 1
+            for key in list(self._dependents.pop(name, ())):
+                self._data.pop(key, None)
+                self._evicted(key)
+
+    def _evicted(self, key):
+        for name in self._dependencies.pop(key, ()):
+            dependents = self._dependents.get(name)
+            if dependents is None:
+                continue
+            dependents.discard(key)
+            if not dependents:
+                del self._dependents[name]
+
+
+secret_cache = SecretCache(
+    maxsize=getattr(settings, "TURKU_SECRET_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "TURKU_SECRET_CACHE_TTL", 300),
+)
+
+filter_cache = FilterCache(
+    maxsize=getattr(settings, "TURKU_FILTER_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "TURKU_FILTER_CACHE_TTL", 60),
+)
+
+histogram_cache = TTLCache(maxsize=1000, ttl=getattr(settings, "TURKU_SCHEDULE_HISTOGRAM_TTL", 300))
+
+
+@receiver(post_save, sender=Machine)
+@receiver(post_delete, sender=Machine)
+def _invalidate_machine_secret(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not ({"secret_hash", "active", "published"} & set(update_fields)):
+        return
+    secret_cache.invalidate(("machine", str(instance.uuid)))
+
+
+@receiver(post_save, sender=Storage)
+@receiver(post_delete, sender=Storage)
+def _invalidate_storage_secret(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not ({"secret_hash", "active", "published"} & set(update_fields)):
+        return
+    secret_cache.invalidate(("storage", instance.name))
+
+
+@receiver(post_save, sender=Storage)
+@receiver(post_delete, sender=Storage)
+def _invalidate_placement(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= {"date_checked_in"}:
+        return
+    placement.invalidate()
+
+
+@receiver(pre_save, sender=FilterSet)
+def _invalidate_renamed_filter_set(sender, instance, **kwargs):
+    for name in FilterSet.objects.filter(pk=instance.pk).exclude(name=instance.name).values_list("name", flat=True):
+        filter_cache.invalidate_name(name)
+
+
+@receiver(post_save, sender=FilterSet)
+@receiver(post_delete, sender=FilterSet)
+def _invalidate_filter_set(sender, instance, **kwargs):
+    filter_cache.invalidate_name(instance.name)
+
+
+# Saves which don't change a Machine's config
+HEARTBEAT_FIELDS = frozenset(("date_checked_in", "secret_hash", "config_hash"))
+
+
+@receiver(post_save, sender=Machine)
+def _invalidate_machine_config_hash(sender, instance, update_fields=None, **kwargs):
+    if not instance.config_hash:
+        return
+    if update_fields is not None and set(update_fields) <= HEARTBEAT_FIELDS:
+        return
+    Machine.objects.filter(pk=instance.pk).update(config_hash=None)
+    instance.config_hash = None
+
+
+@receiver(post_save, sender=Source)
+@receiver(post_delete, sender=Source)
+def _invalidate_source_config_hash(sender, instance, **kwargs):
+    Machine.objects.filter(pk=instance.machine_id).exclude(config_hash=None).update(config_hash=None)
@@ -0,0 +1,174 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import asyncio
+import concurrent.futures
+import contextvars
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import hashers
+
+from turku_api.metrics import metrics
+from turku_api.profiling import hash_timer
+
+
+class HasherSaturated(Exception):
+    """The hasher pool's queue is full; retry after retry_after seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def _check_password(password, encoded, setter):
+    with hash_timer():
+        return hashers.check_password(password, encoded, setter=setter)
+
+
+def _make_password(password):
+    with hash_timer():
+        return hashers.make_password(password)
+
+
+class HasherPool:
+    """Bounded thread pool for password hashing
+
+    Argon2 releases the GIL while hashing, so a small pool of threads
+    (TURKU_HASHER_THREADS, default the number of CPUs) keeps a burst of
+    logins or registrations from running more concurrent hashes than
+    there are CPUs to run them, and keeps hashing off the event loop in
+    the async API.  At most TURKU_HASHER_MAX_QUEUE hashes wait for a
+    thread; beyond that, submissions raise HasherSaturated so the
+    request can be refused quickly instead of tying up a worker.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        # Moving average of hash durations, for Retry-After estimates
+        self._average_duration = 0.1
+
+    @property
+    def max_workers(self):
+        return getattr(settings, "TURKU_HASHER_THREADS", None) or os.cpu_count() or 1
+
+    @property
+    def max_queue(self):
+        return getattr(settings, "TURKU_HASHER_MAX_QUEUE", 64)
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="turku-hasher"
+                )
+            return self._executor
+
+    def retry_after(self):
+        """Estimate the seconds until the current queue has drained"""
+        return max(1, math.ceil((self._queued / self.max_workers + 1) * self._average_duration))
+
+    def _update_gauges(self):
+        # Called with the lock held
+        metrics.set("turku_hasher_queued", self._queued)
+        metrics.set("turku_hasher_active", self._active)
+
+    def _task(self, submitted, func, *args):
+        start = time.monotonic()
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+            self._update_gauges()
+        metrics.observe("turku_hasher_wait_seconds", start - submitted)
+        try:
+            return func(*args)
+        finally:
+            duration = time.monotonic() - start
+            metrics.observe("turku_hasher_duration_seconds", duration)
+            with self._lock:
+                self._active -= 1
+                self._average_duration = 0.9 * self._average_duration + 0.1 * duration
+                self._update_gauges()
+
+    def submit(self, func, *args):
+        """Queue func in the pool, returning a concurrent.futures.Future
+
+        func runs in a copy of the caller's context, so its hashing time
+        is counted towards the caller's request.
+        """
+        executor = self.executor
+        with self._lock:
+            max_queue = self.max_queue
+            if max_queue and self._queued >= max_queue:
+                metrics.incr("turku_hasher_rejected_total")
+                raise HasherSaturated(self.retry_after())
+            self._queued += 1
+            self._update_gauges()
+        try:
+            return executor.submit(contextvars.copy_context().run, self._task, time.monotonic(), func, *args)
+        except RuntimeError:
+            # The executor was shut down
+            with self._lock:
+                self._queued -= 1
+                self._update_gauges()
+            raise
+
+    def call(self, func, *args):
+        """Run func in the pool, blocking until it completes"""
+        return self.submit(func, *args).result()
+
+    async def run(self, func, *args):
+        """Run func in the pool without blocking the event loop"""
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    async def check_password(self, password, encoded):
+        """Check a password, returning (valid, upgraded_password)
+
+        upgraded_password is set if the stored hash should be replaced
+        using a newer hasher or parameters; the caller is responsible
+        for saving it, since the pool threads do not touch the database.
+        """
+        upgraded = []
+        valid = await self.run(_check_password, password, encoded, upgraded.append)
+        return valid, (upgraded[0] if upgraded else None)
+
+    async def make_password(self, password):
+        return await self.run(_make_password, password)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+hasher_pool = HasherPool()
+
+
+def check_password(password, encoded, setter=None):
+    """hashers.check_password, run in the hasher pool
+
+    The setter is called on the calling thread once the check is done,
+    so upgrading the hash doesn't wait on the pool from within it.
+    """
+    upgraded = []
+    valid = hasher_pool.call(_check_password, password, encoded, upgraded.append)
+    if valid and upgraded and setter is not None:
+        setter(upgraded[0])
+    return valid
+
+
+def make_password(password):
+    """hashers.make_password, run in the hasher pool"""
+    return hasher_pool.call(_make_password, password)
@@ -0,0 +1,115 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import atexit
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatBuffer:
+    """Write-behind buffer for Machine/Storage date_checked_in updates
+
+    Check-in times are held in memory and written in one batched UPDATE
+    per model every TURKU_HEARTBEAT_INTERVAL seconds (default 60), or
+    on process exit.  An interval of 0 writes each check-in immediately.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._timer = None
+
+    @property
+    def interval(self):
+        return getattr(settings, "TURKU_HEARTBEAT_INTERVAL", 60)
+
+    def record(self, obj, when):
+        """Record a check-in of a Machine or Storage instance"""
+        obj.date_checked_in = when
+        self.record_many(type(obj), [obj.pk], when)
+
+    def record_many(self, model, pks, when):
+        """Record a check-in of multiple objects of the same model"""
+        if self.interval <= 0:
+            model.objects.filter(pk__in=pks).update(date_checked_in=when)
+            return
+        with self._lock:
+            for pk in pks:
+                self._pending[(model, pk)] = when
+            flush_due = time.monotonic() - self._last_flush >= self.interval
+            if not flush_due and self._timer is None:
+                # Make sure an idle process still writes its check-ins
+                self._timer = threading.Timer(self.interval, self._timer_flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_due:
+            self.flush()
+
+    def get(self, obj):
+        """Return the buffered check-in time of an instance, if any"""
+        return self._pending.get((type(obj), obj.pk))
+
+    def date_checked_in(self, obj):
+        """Return the most recent check-in time of an instance"""
+        buffered = self.get(obj)
+        if buffered is None or (obj.date_checked_in is not None and obj.date_checked_in > buffered):
+            return obj.date_checked_in
+        return buffered
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        by_model = collections.defaultdict(list)
+        for (model, pk), when in pending.items():
+            by_model[model].append(model(pk=pk, date_checked_in=when))
+        try:
+            for model, objs in by_model.items():
+                model.objects.bulk_update(objs, ["date_checked_in"], batch_size=1000)
+        except Exception:
+            # Keep the check-ins for the next attempt, unless newer ones
+            # have arrived in the meantime
+            with self._lock:
+                for key, when in pending.items():
+                    self._pending.setdefault(key, when)
+            raise
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+    def _timer_flush(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Heartbeat flush failed")
+        finally:
+            connections.close_all()
+
+
+heartbeats = HeartbeatBuffer()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        heartbeats.flush()
+    except Exception:
+        logger.exception("Heartbeat flush failed")
@@ -0,0 +1,118 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import asyncio
+import collections
+import threading
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from turku_api.models import Source
+
+
+class WaitRegistry:
+    """Long-polling check-ins waiting for a Machine's sources to become due
+
+    Waiters are any objects with a set() method, such as a
+    threading.Event, registered under a Machine primary key.  Each
+    blocking waiter holds a worker thread, so they are capped at
+    TURKU_LONGPOLL_MAX_WAITERS (default 0, disabled) per process;
+    async waiters hold no thread and are capped separately at
+    TURKU_LONGPOLL_ASYNC_MAX_WAITERS.
+    """
+
+    def __init__(self):
+        self._waiters = collections.defaultdict(set)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def max_waiters(self):
+        return getattr(settings, "TURKU_LONGPOLL_MAX_WAITERS", 0)
+
+    @property
+    def async_max_waiters(self):
+        return getattr(settings, "TURKU_LONGPOLL_ASYNC_MAX_WAITERS", 100)
+
+    def register(self, key, waiter, max_waiters):
+        """Register a waiter, returning False if the registry is full"""
+        with self._lock:
+            if self._count >= max_waiters:
+                return False
+            self._waiters[key].add(waiter)
+            self._count += 1
+            return True
+
+    def unregister(self, key, waiter):
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if waiters is None or waiter not in waiters:
+                return
+            waiters.discard(waiter)
+            self._count -= 1
+            if not waiters:
+                del self._waiters[key]
+
+    def notify(self, key):
+        with self._lock:
+            waiters = list(self._waiters.get(key, ()))
+        for waiter in waiters:
+            waiter.set()
+
+    def wait(self, key, timeout):
+        """Block until notified or timeout seconds pass
+
+        Returns True if notified, False on timeout, or None if the
+        registry is full and the caller should not wait.
+        """
+        event = threading.Event()
+        if not self.register(key, event, self.max_waiters):
+            return None
+        try:
+            return event.wait(timeout)
+        finally:
+            self.unregister(key, event)
+
+    async def async_wait(self, key, timeout):
+        """Like wait(), without holding a thread while waiting"""
+        event = asyncio.Event()
+        waiter = _AsyncWaiter(asyncio.get_running_loop(), event)
+        if not self.register(key, waiter, self.async_max_waiters):
+            return None
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.unregister(key, waiter)
+
+
+class _AsyncWaiter:
+    # notify() may be called from any thread
+    def __init__(self, loop, event):
+        self.loop = loop
+        self.event = event
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+waits = WaitRegistry()
+
+
+@receiver(post_save, sender=Source)
+def _notify_source_changed(sender, instance, **kwargs):
+    # Waiters re-check their sources, so a source rescheduled further
+    # out is also noticed, not only one which became due
+    if instance.active and instance.published:
+        waits.notify(instance.machine_id)
@@ -8,11 +8,14 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import datetime
+import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 
-from turku_api.models import BackupLog
+from turku_api.models import BackupLog, Source
 
 
 class Command(BaseCommand):
@@ -22,10 +25,73 @@ class Command(BaseCommand):
         parser.add_argument(
             "--days",
             type=int,
-            required=True,
+            default=None,
             help="Clean logs older than this number of days",
         )
+        parser.add_argument(
+            "--keep-last",
+            type=int,
+            default=None,
+            help="Always keep this number of most recent logs per source",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of logs to delete per transaction")
+        parser.add_argument("--sleep", type=float, default=0.0, help="Seconds to sleep between batches")
+        parser.add_argument("--dry-run", action="store_true", help="Report the number of logs which would be cleaned")
 
     def handle(self, *args, **options):
-        for backuplog in BackupLog.objects.filter(date_end__lt=(timezone.localtime() - datetime.timedelta(days=options["days"]))):
-            backuplog.delete()
+        if options["days"] is None and options["keep_last"] is None:
+            raise CommandError("At least one of --days or --keep-last is required")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive")
+        self.options = options
+        self.deleted = 0
+        self.start = time.monotonic()
+
+        age_q = Q()
+        if options["days"] is not None:
+            cutoff = timezone.localtime() - datetime.timedelta(days=options["days"])
+            # Logs of backups which never reported an end time are aged
+            # by the time they were received
+            age_q = Q(date_end__lt=cutoff) | Q(date_end__isnull=True, date__lt=cutoff)
+
+        if options["keep_last"] is None:
+            self.clean(BackupLog.objects.filter(age_q))
+        else:
+            for source_id in Source.objects.values_list("id", flat=True).iterator():
+                source_logs = BackupLog.objects.filter(source_id=source_id)
+                keep_dates = source_logs.order_by("-date").values_list("date", flat=True)
+                if options["keep_last"] > 0:
+                    keep_dates = keep_dates[options["keep_last"] - 1 : options["keep_last"]]
+                    if not keep_dates:
+                        continue
+                    source_logs = source_logs.filter(date__lt=keep_dates[0])
+                self.clean(source_logs.filter(age_q))
+
+        if options["dry_run"]:
+            self.stdout.write("{} logs would be cleaned".format(self.deleted))
+        elif options["verbosity"] >= 2:
+            self.report()
+
+    def clean(self, queryset):
+        if self.options["dry_run"]:
+            self.deleted += queryset.count()
+            return
+        while True:
+            pks = list(queryset.values_list("pk", flat=True)[: self.options["batch_size"]])
+            if not pks:
+                return
+            with transaction.atomic():
+                BackupLog.objects.filter(pk__in=pks).delete()
+            self.deleted += len(pks)
+            if self.options["verbosity"] >= 3:
+                self.report()
+            if self.options["sleep"]:
+                time.sleep(self.options["sleep"])
+
+    def report(self):
+        elapsed = time.monotonic() - self.start
+        self.stdout.write(
+            "{} logs cleaned in {:.1f} seconds ({:.0f} logs/second)".format(
+                self.deleted, elapsed, (self.deleted / elapsed) if elapsed else 0
+            )
+        )
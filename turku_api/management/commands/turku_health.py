@@ -10,6 +10,7 @@
 import sys
 
 from django.core.management.base import BaseCommand
+from django.utils import timezone
 
 from turku_api.models import Machine, Source, Storage
 
@@ -18,27 +19,33 @@ class Command(BaseCommand):
     help = "Report Turku health with a Nagios-compatible check"
 
     def handle(self, *args, **options):
+        now = timezone.localtime()
         storages = Storage.objects.filter(active=True, published=True)
-        storages_sick = [o for o in storages if not o.healthy()]
+        storages_sick = storages.sick(now)
         machines = Machine.objects.filter(active=True, published=True)
-        machines_sick = [o for o in machines if not o.healthy()]
+        machines_sick = machines.sick(now)
         sources = Source.objects.filter(machine__active=True, machine__published=True, active=True, published=True)
-        sources_sick = [o for o in sources if not o.healthy()]
-        all_sick = storages_sick + machines_sick + sources_sick
+        sources_sick = sources.sick(now).select_related("machine")
 
-        if all_sick:
+        counts = [
+            (qs.count(), qs_sick.count())
+            for qs, qs_sick in ((storages, storages_sick), (machines, machines_sick), (sources, sources_sick))
+        ]
+        if any(sick for total, sick in counts):
             self.stdout.write(
                 "CRITICAL {}/{} storages, {}/{} machines, {}/{} sources".format(
-                    len(storages_sick),
-                    len(storages),
-                    len(machines_sick),
-                    len(machines),
-                    len(sources_sick),
-                    len(sources),
+                    counts[0][1],
+                    counts[0][0],
+                    counts[1][1],
+                    counts[1][0],
+                    counts[2][1],
+                    counts[2][0],
                 )
             )
-            for object in all_sick:
-                self.stdout.write(repr(object))
+            if options["verbosity"] >= 2:
+                for qs_sick in (storages_sick, machines_sick, sources_sick):
+                    for object in qs_sick.iterator():
+                        self.stdout.write(repr(object))
             sys.exit(2)
         else:
-            print("OK {} storages, {} machines, {} sources".format(len(storages), len(machines), len(sources)))
+            print("OK {} storages, {} machines, {} sources".format(counts[0][0], counts[1][0], counts[2][0]))
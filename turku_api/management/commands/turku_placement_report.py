@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+
+from turku_api.placement import build_placement_table
+
+
+def skew(values):
+    """Return the ratio of the largest to the smallest value"""
+    values = [v for v in values if v is not None]
+    if not values:
+        return 1.0
+    if min(values) <= 0:
+        return float("inf")
+    return max(values) / min(values)
+
+
+class Command(BaseCommand):
+    help = "Report storage placement weights and the projected skew after new machine registrations"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--machines", type=int, default=100, help="Number of new machines to project")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed for the projection")
+
+    def handle(self, *args, **options):
+        if options["machines"] < 0:
+            raise CommandError("--machines must not be negative")
+
+        table = build_placement_table()
+        if not table:
+            raise CommandError("No storages are currently available")
+        shares = table.shares()
+        load_before = list(table.load)
+        space_per_load_before = [s / (1 + l) if h else None for s, l, h in zip(table.space, table.load, table.healthy)]
+
+        rand = random.Random(options["seed"]).random
+        for i in range(options["machines"]):
+            table.add_load(table.choose(rand))
+        space_per_load_after = [s / (1 + l) if h else None for s, l, h in zip(table.space, table.load, table.healthy)]
+
+        for i, storage in enumerate(table.storages):
+            self.stdout.write(
+                "{}: {} MiB available, load {} -> {}, next share {:.1%}{}".format(
+                    storage.name,
+                    table.space[i],
+                    load_before[i],
+                    table.load[i],
+                    shares[i],
+                    "" if table.healthy[i] else " (unhealthy)",
+                )
+            )
+        self.stdout.write(
+            "Space per load skew: {:.2f} now, {:.2f} after {} new machines".format(
+                skew(space_per_load_before), skew(space_per_load_after), options["machines"]
+            )
+        )
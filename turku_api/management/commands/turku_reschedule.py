@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from turku_api.models import Source
+from turku_api.schedule import frequency_next_scheduled
+
+
+class Command(BaseCommand):
+    help = "Recompute the next scheduled backup of all sources"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of sources to update per query")
+        parser.add_argument("--dry-run", action="store_true", help="Report the number of sources which would change")
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Also reschedule sources which are already due or were changed since their last backup",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive")
+
+        # Sources which have never been backed up are already due, and
+        # are scheduled from their first successful backup
+        sources = Source.objects.exclude(date_last_backed_up=None)
+        if not options["all"]:
+            # Leave sources set to back up now (such as a manually
+            # triggered backup), and sources changed since their last
+            # backup, whose schedule may have been set from that change
+            # (such as a new frequency through update_config)
+            sources = sources.filter(date_next_backup__gt=timezone.now(), date_updated__lte=F("date_last_backed_up"))
+        sources = sources.only("id", "frequency", "date_last_backed_up", "date_next_backup").order_by()
+        changed = 0
+        batch = []
+        for source in sources.iterator(chunk_size=options["batch_size"]):
+            date_next_backup = frequency_next_scheduled(source.frequency, str(source.id), source.date_last_backed_up)
+            if date_next_backup == source.date_next_backup:
+                continue
+            source.date_next_backup = date_next_backup
+            batch.append(source)
+            if len(batch) >= options["batch_size"]:
+                changed += self.update(batch, options)
+                batch = []
+        changed += self.update(batch, options)
+
+        if options["dry_run"]:
+            self.stdout.write("{} sources would be rescheduled".format(changed))
+        elif options["verbosity"] >= 2:
+            self.stdout.write("{} sources rescheduled".format(changed))
+
+    def update(self, batch, options):
+        if batch and not options["dry_run"]:
+            with transaction.atomic():
+                Source.objects.bulk_update(batch, ["date_next_backup"])
+        return len(batch)
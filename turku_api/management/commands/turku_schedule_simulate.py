@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from turku_api.models import Source, Storage
+from turku_api.schedule import SlotHistogram, compile_frequency, frequency_next_scheduled
+
+
+def peak_concurrency(starts, duration):
+    """Return the peak number of overlapping backups over a day
+
+    starts is a list of (frequency, datetime); each backup is assumed
+    to run for duration minutes.
+    """
+    minutes = [0] * 1440
+    for frequency, start in starts:
+        start = start.astimezone(timezone.get_current_timezone())
+        minute = (start.hour * 60) + start.minute
+        if compile_frequency(frequency).period == "hourly":
+            start_minutes = [(minute % 60) + (hour * 60) for hour in range(24)]
+        else:
+            start_minutes = [minute]
+        for m in start_minutes:
+            for i in range(m, m + duration):
+                minutes[i % 1440] += 1
+    return max(minutes)
+
+
+class Command(BaseCommand):
+    help = "Simulate peak concurrent backups per storage with and without schedule load-leveling"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--duration", type=int, default=30, help="Assumed backup duration, in minutes")
+
+    def handle(self, *args, **options):
+        now = timezone.localtime()
+        slot_seconds = getattr(settings, "TURKU_SCHEDULE_SLOT_SECONDS", 60)
+        for storage in Storage.objects.filter(active=True).order_by("name"):
+            sources = (
+                Source.objects.filter(machine__storage=storage, machine__active=True, active=True, published=True)
+                .order_by("id")
+                .values_list("id", "frequency")
+            )
+            before = []
+            after = []
+            histogram = SlotHistogram(slot_seconds)
+            for source_id, frequency in sources:
+                try:
+                    before.append((frequency, frequency_next_scheduled(frequency, str(source_id), now)))
+                    after.append((frequency, frequency_next_scheduled(frequency, str(source_id), now, histogram)))
+                except (ValueError, ImportError):
+                    continue
+            self.stdout.write(
+                "{}: {} sources, peak concurrent backups {} hashed, {} load-leveled".format(
+                    storage.name,
+                    len(before),
+                    peak_concurrency(before, options["duration"]),
+                    peak_concurrency(after, options["duration"]),
+                )
+            )
@@ -0,0 +1,140 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import bisect
+import collections
+import threading
+
+# Upper bounds in seconds, suited to API request latencies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # Per-bucket (not cumulative) counts; values over the last
+        # bucket are only reflected in count
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return (upper bound, cumulative count) pairs, ending with +Inf"""
+        out = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            out.append((bound, total))
+        out.append((float("inf"), self.count))
+        return out
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_name(name, labels):
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels))
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Process-local counters, gauges and histograms, keyed on a name and optional labels"""
+
+    def __init__(self):
+        self._counters = collections.Counter()
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def incr(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def get(self, name, **labels):
+        key = self._key(name, labels)
+        return self._gauges[key] if key in self._gauges else self._counters.get(key, 0)
+
+    def get_histogram(self, name, **labels):
+        return self._histograms.get(self._key(name, labels))
+
+    def snapshot(self):
+        """Return all counters as a dict of "name{label=value}" strings
+
+        Histograms are summarized by their _count and _sum.
+        """
+        out = {}
+        with self._lock:
+            for (name, labels), value in sorted(list(self._counters.items()) + list(self._gauges.items())):
+                out[_format_name(name, labels)] = value
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                out[_format_name(name + "_count", labels)] = histogram.count
+                out[_format_name(name + "_sum", labels)] = histogram.sum
+        return out
+
+    def prometheus_text(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in seen:
+                    lines.append("# TYPE {} counter".format(name))
+                    seen.add(name)
+                lines.append("{} {}".format(_format_name(name, labels), _format_value(value)))
+            for (name, labels), value in sorted(self._gauges.items()):
+                if name not in seen:
+                    lines.append("# TYPE {} gauge".format(name))
+                    seen.add(name)
+                lines.append("{} {}".format(_format_name(name, labels), _format_value(value)))
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in seen:
+                    lines.append("# TYPE {} histogram".format(name))
+                    seen.add(name)
+                for bound, count in histogram.cumulative():
+                    lines.append("{} {}".format(_format_name(name + "_bucket", labels + (("le", _format_value(bound)),)), count))
+                lines.append("{} {}".format(_format_name(name + "_sum", labels), _format_value(histogram.sum)))
+                lines.append("{} {}".format(_format_name(name + "_count", labels), histogram.count))
+        return "".join(line + "\n" for line in lines)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,443 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Generated by Django 5.2.18 on 2026-10-18 07:53
+
+import django.core.validators
+import django.db.models.deletion
+import django.utils.timezone
+import turku_api.models
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="Auth",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ("name", models.CharField(help_text="Human-readable name of this auth.", max_length=200, unique=True)),
+                (
+                    "secret_hash",
+                    models.CharField(
+                        help_text="Hashed secret (password) of this auth.",
+                        max_length=200,
+                        validators=[turku_api.models.validate_hashed_password],
+                    ),
+                ),
+                (
+                    "secret_type",
+                    models.CharField(
+                        choices=[("machine_reg", "Machine registration"), ("storage_reg", "Storage registration")],
+                        help_text="Auth secret type (machine/storage).",
+                        max_length=200,
+                    ),
+                ),
+                ("comment", models.CharField(blank=True, help_text="Human-readable comment.", max_length=200, null=True)),
+                (
+                    "active",
+                    models.BooleanField(
+                        default=True,
+                        help_text="Whether this auth is enabled.  Disabling prevents new registrations using its key, and prevents existing machines using its key from updating their configs.",
+                    ),
+                ),
+                (
+                    "date_added",
+                    models.DateTimeField(default=django.utils.timezone.localtime, help_text="Date/time this auth was added."),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="FilterSet",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ("name", models.CharField(help_text="Name of this filter set.", max_length=200, unique=True)),
+                (
+                    "filters",
+                    models.TextField(
+                        default="[]",
+                        help_text="JSON list of this filter set's filter rules.",
+                        validators=[turku_api.models.validate_json_string_list],
+                    ),
+                ),
+                ("comment", models.CharField(blank=True, help_text="Human-readable comment.", max_length=200, null=True)),
+                ("active", models.BooleanField(default=True, help_text="Whether this filter set is enabled.")),
+                (
+                    "date_added",
+                    models.DateTimeField(default=django.utils.timezone.localtime, help_text="Date/time this filter set was added."),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Machine",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                (
+                    "uuid",
+                    models.UUIDField(
+                        help_text="UUID of this machine.  This UUID is set by the machine and must be globally unique.",
+                        unique=True,
+                        validators=[turku_api.models.validate_uuid],
+                        verbose_name="UUID",
+                    ),
+                ),
+                (
+                    "secret_hash",
+                    models.CharField(
+                        help_text="Hashed secret (password) of this machine.",
+                        max_length=200,
+                        validators=[turku_api.models.validate_hashed_password],
+                    ),
+                ),
+                (
+                    "environment_name",
+                    models.CharField(blank=True, help_text="Environment this machine is part of.", max_length=200, null=True),
+                ),
+                (
+                    "service_name",
+                    models.CharField(
+                        blank=True,
+                        help_text="Service this machine is part of.  For Juju units, this is the first part of the unit name (before the slash).",
+                        max_length=200,
+                        null=True,
+                    ),
+                ),
+                (
+                    "unit_name",
+                    models.CharField(
+                        help_text='Unit name of this machine.  For Juju units, this is the full unit name (e.g. "service-name/0").  Otherwise, this should be the machine\'s hostname.',
+                        max_length=200,
+                    ),
+                ),
+                ("comment", models.CharField(blank=True, help_text="Human-readable comment.", max_length=200, null=True)),
+                (
+                    "ssh_public_key",
+                    models.CharField(
+                        help_text="SSH public key of this machine's agent.", max_length=2048, verbose_name="SSH public key"
+                    ),
+                ),
+                (
+                    "active",
+                    models.BooleanField(
+                        default=True,
+                        help_text="Whether this machine is enabled.  Disabling removes its key from its storage unit, stops this machine from updating its registration, etc.",
+                    ),
+                ),
+                (
+                    "published",
+                    models.BooleanField(default=True, help_text="Whether this machine has been enabled by the machine agent."),
+                ),
+                (
+                    "date_registered",
+                    models.DateTimeField(
+                        default=django.utils.timezone.localtime, help_text="Date/time this machine was registered."
+                    ),
+                ),
+                (
+                    "date_updated",
+                    models.DateTimeField(
+                        default=django.utils.timezone.localtime, help_text="Date/time this machine presented a modified config."
+                    ),
+                ),
+                (
+                    "date_checked_in",
+                    models.DateTimeField(blank=True, help_text="Date/time this machine last checked in.", null=True),
+                ),
+                (
+                    "auth",
+                    models.ForeignKey(
+                        help_text="Machine auth used to register this machine.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="turku_api.auth",
+                        validators=[turku_api.models.validate_machine_auth],
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="Source",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ("name", models.CharField(help_text="Computer-readable source name identifier.", max_length=200)),
+                ("comment", models.CharField(blank=True, help_text="Human-readable comment.", max_length=200, null=True)),
+                ("path", models.CharField(help_text="Full filesystem path of this source.", max_length=200)),
+                (
+                    "filter",
+                    models.CharField(
+                        default="[]",
+                        help_text="JSON list of rsync-compatible --filter options.",
+                        max_length=2048,
+                        validators=[turku_api.models.validate_json_string_list],
+                    ),
+                ),
+                (
+                    "exclude",
+                    models.CharField(
+                        default="[]",
+                        help_text="JSON list of rsync-compatible --exclude options.",
+                        max_length=2048,
+                        validators=[turku_api.models.validate_json_string_list],
+                    ),
+                ),
+                ("frequency", models.CharField(default="daily", help_text="How often to back up this source.", max_length=200)),
+                (
+                    "retention",
+                    models.CharField(
+                        default="last 5 days, earliest of month",
+                        help_text="Retention schedule, describing when to preserve snapshots.",
+                        max_length=200,
+                    ),
+                ),
+                (
+                    "bwlimit",
+                    models.CharField(
+                        blank=True,
+                        help_text="Bandwith limit for remote transfer, using the rsync --bwlimit format.",
+                        max_length=200,
+                        null=True,
+                        verbose_name="bandwidth limit",
+                    ),
+                ),
+                (
+                    "snapshot_mode",
+                    models.CharField(
+                        blank=True,
+                        choices=[("none", "No snapshotting"), ("link-dest", "Hardlink trees (rsync --link-dest)")],
+                        help_text="Override the storage unit's snapshot logic and use an explicit snapshot mode for this source.",
+                        max_length=200,
+                        null=True,
+                    ),
+                ),
+                (
+                    "preserve_hard_links",
+                    models.BooleanField(default=False, help_text="Whether to preserve hard links when backing up this source."),
+                ),
+                (
+                    "shared_service",
+                    models.BooleanField(
+                        default=False,
+                        help_text="Whether this source is part of a shared service of multiple machines to be backed up.",
+                    ),
+                ),
+                (
+                    "large_rotating_files",
+                    models.BooleanField(
+                        default=False,
+                        help_text='Whether this source contains a number of large files which rotate through filenames, e.g. "postgresql.1.dump.gz" becomes "postgresql.2.dump.gz".',
+                    ),
+                ),
+                (
+                    "large_modifying_files",
+                    models.BooleanField(
+                        default=False,
+                        help_text="Whether this source contains a number of large files which grow or are otherwise modified, e.g. log files or filesystem images.",
+                    ),
+                ),
+                (
+                    "active",
+                    models.BooleanField(
+                        default=True,
+                        help_text="Whether this source is enabled.  Disabling means the API server no longer gives it to the storage unit, even if it's time for a backup.",
+                    ),
+                ),
+                ("success", models.BooleanField(default=True, help_text="Whether this source's last backup was successful.")),
+                (
+                    "published",
+                    models.BooleanField(
+                        default=True, help_text="Whether this source is actively being published by the machine agent."
+                    ),
+                ),
+                (
+                    "date_added",
+                    models.DateTimeField(
+                        default=django.utils.timezone.localtime,
+                        help_text="Date/time this source was first added by the machine agent.",
+                    ),
+                ),
+                (
+                    "date_updated",
+                    models.DateTimeField(
+                        default=django.utils.timezone.localtime,
+                        help_text="Date/time the machine presented a modified config of this source.",
+                    ),
+                ),
+                (
+                    "date_last_backed_up",
+                    models.DateTimeField(blank=True, help_text="Date/time this source was last successfully backed up.", null=True),
+                ),
+                (
+                    "date_next_backup",
+                    models.DateTimeField(
+                        default=django.utils.timezone.localtime,
+                        help_text="Date/time this source is next scheduled to be backed up.  Set to now (or in the past) to trigger a backup as soon as possible.",
+                    ),
+                ),
+                (
+                    "machine",
+                    models.ForeignKey(
+                        help_text="Machine this source belongs to.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="turku_api.machine",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("machine", "name")},
+            },
+        ),
+        migrations.CreateModel(
+            name="Storage",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                (
+                    "name",
+                    models.CharField(
+                        help_text="Name of this storage unit.  This is used as its login ID and must be unique.",
+                        max_length=200,
+                        unique=True,
+                    ),
+                ),
+                (
+                    "secret_hash",
+                    models.CharField(
+                        help_text="Hashed secret (password) of this storage unit.",
+                        max_length=200,
+                        validators=[turku_api.models.validate_hashed_password],
+                    ),
+                ),
+                ("comment", models.CharField(blank=True, help_text="Human-readable comment.", max_length=200, null=True)),
+                (
+                    "ssh_ping_host",
+                    models.CharField(
+                        help_text="Hostname/IP address of this storage unit's SSH server.",
+                        max_length=200,
+                        verbose_name="SSH ping host",
+                    ),
+                ),
+                (
+                    "ssh_ping_host_keys",
+                    models.CharField(
+                        default="[]",
+                        help_text="JSON list of this storage unit's SSH host keys.",
+                        max_length=65536,
+                        validators=[turku_api.models.validate_json_string_list],
+                        verbose_name="SSH ping host keys",
+                    ),
+                ),
+                (
+                    "ssh_ping_port",
+                    models.PositiveIntegerField(
+                        help_text="Port number of this storage unit's SSH server.",
+                        validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(65535)],
+                        verbose_name="SSH ping port",
+                    ),
+                ),
+                (
+                    "ssh_ping_user",
+                    models.CharField(
+                        help_text="Username of this storage unit's SSH server.", max_length=200, verbose_name="SSH ping user"
+                    ),
+                ),
+                (
+                    "space_total",
+                    models.PositiveIntegerField(
+                        default=0, help_text="Total disk space of this storage unit's storage directories, in MiB."
+                    ),
+                ),
+                (
+                    "space_available",
+                    models.PositiveIntegerField(
+                        default=0, help_text="Available disk space of this storage unit's storage directories, in MiB."
+                    ),
+                ),
+                (
+                    "active",
+                    models.BooleanField(
+                        default=True,
+                        help_text="Whether this storage unit is enabled.  Disabling prevents this storage unit from checking in or being assigned to new machines. Existing machines which ping this storage unit will get errors because this storage unit can no longer query the API server.",
+                    ),
+                ),
+                ("published", models.BooleanField(default=True, help_text="Whether this storage unit has been enabled by itself.")),
+                (
+                    "date_registered",
+                    models.DateTimeField(
+                        default=django.utils.timezone.localtime, help_text="Date/time this storage unit was registered."
+                    ),
+                ),
+                (
+                    "date_updated",
+                    models.DateTimeField(
+                        default=django.utils.timezone.localtime,
+                        help_text="Date/time this storage unit presented a modified config.",
+                    ),
+                ),
+                (
+                    "date_checked_in",
+                    models.DateTimeField(blank=True, help_text="Date/time this storage unit last checked in.", null=True),
+                ),
+                (
+                    "auth",
+                    models.ForeignKey(
+                        help_text="Storage auth used to register this storage unit.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="turku_api.auth",
+                        validators=[turku_api.models.validate_storage_auth],
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="machine",
+            name="storage",
+            field=models.ForeignKey(
+                help_text="Storage unit this machine is assigned to.",
+                on_delete=django.db.models.deletion.CASCADE,
+                to="turku_api.storage",
+            ),
+        ),
+        migrations.CreateModel(
+            name="BackupLog",
+            fields=[
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                (
+                    "date",
+                    models.DateTimeField(
+                        default=django.utils.timezone.localtime, help_text="Date/time this log entry was received/processed."
+                    ),
+                ),
+                ("success", models.BooleanField(default=False, help_text="Whether this backup succeeded.")),
+                ("date_begin", models.DateTimeField(blank=True, help_text="Date/time this backup began.", null=True)),
+                ("date_end", models.DateTimeField(blank=True, help_text="Date/time this backup ended.", null=True)),
+                ("snapshot", models.CharField(blank=True, help_text="Name of the created snapshot.", max_length=200, null=True)),
+                ("summary", models.TextField(blank=True, help_text="Summary of the backup's events.", null=True)),
+                (
+                    "source",
+                    models.ForeignKey(
+                        help_text="Source this log entry belongs to.",
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="turku_api.source",
+                    ),
+                ),
+                (
+                    "storage",
+                    models.ForeignKey(
+                        blank=True,
+                        help_text="Storage unit this backup occurred on.",
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="turku_api.storage",
+                    ),
+                ),
+            ],
+        ),
+    ]
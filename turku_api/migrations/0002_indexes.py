@@ -0,0 +1,36 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Generated by Django 5.2.18 on 2026-10-18 07:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("turku_api", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="backuplog",
+            index=models.Index(fields=["source", "date"], name="backuplog_source_date_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="backuplog",
+            index=models.Index(fields=["date_end"], name="backuplog_date_end_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="source",
+            index=models.Index(
+                condition=models.Q(("active", True), ("published", True)),
+                fields=["machine", "date_next_backup"],
+                name="source_scheduled_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Generated by Django 5.2.18 on 2026-10-18 07:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("turku_api", "0002_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="machine",
+            name="config_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="Hash of the last config accepted from this machine.  Cleared when the machine or its sources are changed by other means.",
+                max_length=64,
+                null=True,
+            ),
+        ),
+    ]
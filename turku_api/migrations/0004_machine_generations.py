@@ -0,0 +1,47 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Generated by Django 5.2.18 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("turku_api", "0003_machine_config_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="machine",
+            name="storage_generation",
+            field=models.BigIntegerField(
+                default=0, editable=False, help_text="Machine generation of its storage unit when this machine was last changed."
+            ),
+        ),
+        migrations.AddField(
+            model_name="storage",
+            name="machines_generation",
+            field=models.BigIntegerField(
+                default=0, editable=False, help_text="Incremented whenever a machine assigned to this storage unit is changed."
+            ),
+        ),
+        migrations.AddField(
+            model_name="storage",
+            name="machines_resync_generation",
+            field=models.BigIntegerField(
+                default=0,
+                editable=False,
+                help_text="Machine generation of the last removal which requires a full machine list resync.",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="machine",
+            index=models.Index(fields=["storage", "storage_generation"], name="machine_storage_generation_idx"),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("turku_api", "0004_machine_generations"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="filterset",
+            name="date_updated",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now, help_text="Date/time this filter set was last changed."
+            ),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name="source",
+            name="date_updated",
+            field=models.DateTimeField(
+                default=django.utils.timezone.localtime,
+                help_text="Date/time the machine presented a modified config of this source, or it was otherwise changed.",
+            ),
+        ),
+    ]
@@ -0,0 +1,120 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+
+from django.db import migrations, models
+import turku_api.models
+
+# (model, field) pairs converted from JSON text to JSONField.  Each is
+# copied through a temporary field, so values are decoded (and any
+# invalid legacy text replaced by an empty list) the same way on all
+# database backends.
+JSON_FIELDS = (
+    ("storage", "ssh_ping_host_keys"),
+    ("source", "filter"),
+    ("source", "exclude"),
+    ("filterset", "filters"),
+)
+BATCH_SIZE = 1000
+
+
+def _decode(text):
+    try:
+        value = json.loads(text)
+    except (TypeError, ValueError):
+        return []
+    return value if isinstance(value, list) else []
+
+
+def _copy(apps, model_name, src, dst, convert):
+    model = apps.get_model("turku_api", model_name)
+    batch = []
+    for obj in model.objects.only("pk", src).iterator(chunk_size=BATCH_SIZE):
+        setattr(obj, dst, convert(getattr(obj, src)))
+        batch.append(obj)
+        if len(batch) >= BATCH_SIZE:
+            model.objects.bulk_update(batch, [dst])
+            batch = []
+    model.objects.bulk_update(batch, [dst])
+
+
+def forwards(apps, schema_editor):
+    for model_name, name in JSON_FIELDS:
+        _copy(apps, model_name, name, name + "_json", _decode)
+
+
+def backwards(apps, schema_editor):
+    for model_name, name in JSON_FIELDS:
+        _copy(apps, model_name, name + "_json", name, lambda value: json.dumps(value, sort_keys=True))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("turku_api", "0005_date_updated"),
+    ]
+
+    operations = (
+        [
+            migrations.AddField(
+                model_name=model_name,
+                name=name + "_json",
+                field=models.JSONField(default=list, blank=True),
+            )
+            for model_name, name in JSON_FIELDS
+        ]
+        + [migrations.RunPython(forwards, backwards)]
+        + [migrations.RemoveField(model_name=model_name, name=name) for model_name, name in JSON_FIELDS]
+        + [
+            migrations.RenameField(model_name=model_name, old_name=name + "_json", new_name=name)
+            for model_name, name in JSON_FIELDS
+        ]
+        + [
+            migrations.AlterField(
+                model_name="storage",
+                name="ssh_ping_host_keys",
+                field=models.JSONField(
+                    blank=True,
+                    default=list,
+                    help_text="JSON list of this storage unit's SSH host keys.",
+                    validators=[turku_api.models.validate_string_list],
+                    verbose_name="SSH ping host keys",
+                ),
+            ),
+            migrations.AlterField(
+                model_name="source",
+                name="filter",
+                field=models.JSONField(
+                    blank=True,
+                    default=list,
+                    help_text="JSON list of rsync-compatible --filter options.",
+                    validators=[turku_api.models.validate_string_list],
+                ),
+            ),
+            migrations.AlterField(
+                model_name="source",
+                name="exclude",
+                field=models.JSONField(
+                    blank=True,
+                    default=list,
+                    help_text="JSON list of rsync-compatible --exclude options.",
+                    validators=[turku_api.models.validate_string_list],
+                ),
+            ),
+            migrations.AlterField(
+                model_name="filterset",
+                name="filters",
+                field=models.JSONField(
+                    blank=True,
+                    default=list,
+                    help_text="JSON list of this filter set's filter rules.",
+                    validators=[turku_api.models.validate_string_list],
+                ),
+            ),
+        ]
+    )
@@ -11,12 +11,16 @@ import json
 import math
 import uuid
 
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.hashers import is_password_usable
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
+from turku_api.heartbeat import heartbeats
+
 
 def shannon_entropy(input):
     input_len = len(input)
@@ -46,6 +50,15 @@ def validate_hashed_password(value):
         raise ValidationError("Invalid hashed password")
 
 
+def validate_string_list(value):
+    if not isinstance(value, (list, tuple)):
+        raise ValidationError("Must be a list of strings")
+    for i in value:
+        if not isinstance(i, str):
+            raise ValidationError("Must be a list of strings")
+
+
+# Used by migrations from before the JSONField conversion
 def validate_json_string_list(value):
     try:
         decoded_json = json.loads(value)
@@ -76,6 +89,50 @@ def validate_machine_auth(value):
         raise ValidationError("Must be a Machine registration")
 
 
+class StorageQuerySet(models.QuerySet):
+    def sick(self, now=None):
+        """Storages which Storage.healthy() would report as unhealthy"""
+        if now is None:
+            now = timezone.localtime()
+        return self.filter(date_registered__lt=(now - timedelta(minutes=30))).filter(
+            models.Q(date_checked_in__isnull=True) | models.Q(date_checked_in__lt=(now - timedelta(minutes=30)))
+        )
+
+    def bump_machines_generation(self, storage_id, resync=False):
+        """Increment a Storage's machine generation, returning the new value
+
+        This must be called within a transaction, which holds the Storage
+        row lock until the Machine change is committed.  With resync,
+        machine lists from before the new generation can no longer be
+        brought up to date incrementally.
+        """
+        updates = {"machines_generation": models.F("machines_generation") + 1}
+        if resync:
+            updates["machines_resync_generation"] = models.F("machines_generation") + 1
+        self.filter(pk=storage_id).update(**updates)
+        return self.filter(pk=storage_id).values_list("machines_generation", flat=True).first()
+
+
+class MachineQuerySet(models.QuerySet):
+    def sick(self, now=None):
+        """Machines which Machine.healthy() would report as unhealthy"""
+        if now is None:
+            now = timezone.localtime()
+        return self.filter(date_registered__lt=(now - timedelta(hours=1))).filter(
+            models.Q(date_checked_in__isnull=True) | models.Q(date_checked_in__lt=(now - timedelta(hours=10)))
+        )
+
+
+class SourceQuerySet(models.QuerySet):
+    def sick(self, now=None):
+        """Sources which Source.healthy() would report as unhealthy"""
+        if now is None:
+            now = timezone.localtime()
+        return self.filter(date_added__lt=(now - timedelta(hours=4))).filter(
+            models.Q(success=False) | models.Q(date_next_backup__lt=(now - timedelta(hours=10)))
+        )
+
+
 class Auth(models.Model):
     SECRET_TYPES = (
         ("machine_reg", "Machine registration"),
@@ -111,9 +168,10 @@ class Storage(models.Model):
         if now <= (self.date_registered + timedelta(minutes=30)):
             # New registration, assume it's healthy
             return True
-        if not self.date_checked_in:
+        date_checked_in = heartbeats.date_checked_in(self)
+        if not date_checked_in:
             return False
-        return now <= (self.date_checked_in + timedelta(minutes=30))
+        return now <= (date_checked_in + timedelta(minutes=30))
 
     healthy.boolean = True
 
@@ -134,10 +192,10 @@ class Storage(models.Model):
         verbose_name="SSH ping host",
         help_text="Hostname/IP address of this storage unit's SSH server.",
     )
-    ssh_ping_host_keys = models.CharField(
-        max_length=65536,
-        default="[]",
-        validators=[validate_json_string_list],
+    ssh_ping_host_keys = models.JSONField(
+        default=list,
+        blank=True,
+        validators=[validate_string_list],
         verbose_name="SSH ping host keys",
         help_text="JSON list of this storage unit's SSH host keys.",
     )
@@ -181,6 +239,29 @@ class Storage(models.Model):
         help_text="Date/time this storage unit presented a modified config.",
     )
     date_checked_in = models.DateTimeField(blank=True, null=True, help_text="Date/time this storage unit last checked in.")
+    machines_generation = models.BigIntegerField(
+        default=0,
+        editable=False,
+        help_text="Incremented whenever a machine assigned to this storage unit is changed.",
+    )
+    machines_resync_generation = models.BigIntegerField(
+        default=0,
+        editable=False,
+        help_text="Machine generation of the last removal which requires a full machine list resync.",
+    )
+
+    objects = StorageQuerySet.as_manager()
+
+    # Maintained with atomic updates by Machine changes
+    GENERATION_FIELDS = frozenset(("machines_generation", "machines_resync_generation"))
+
+    def save(self, *args, **kwargs):
+        if kwargs.get("update_fields") is None and not self._state.adding and not kwargs.get("force_insert"):
+            # Don't overwrite the generations with what may be stale values
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in self.GENERATION_FIELDS
+            ]
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
@@ -192,9 +273,10 @@ class Machine(models.Model):
         if now <= (self.date_registered + timedelta(hours=1)):
             # New registration, assume it's healthy
             return True
-        if not self.date_checked_in:
+        date_checked_in = heartbeats.date_checked_in(self)
+        if not date_checked_in:
             return False
-        return now <= (self.date_checked_in + timedelta(hours=10))
+        return now <= (date_checked_in + timedelta(hours=10))
 
     healthy.boolean = True
 
@@ -261,11 +343,58 @@ class Machine(models.Model):
         help_text="Date/time this machine presented a modified config.",
     )
     date_checked_in = models.DateTimeField(blank=True, null=True, help_text="Date/time this machine last checked in.")
+    config_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        null=True,
+        editable=False,
+        help_text="Hash of the last config accepted from this machine.  Cleared when the machine or its sources "
+        + "are changed by other means.",
+    )
+    storage_generation = models.BigIntegerField(
+        default=0,
+        editable=False,
+        help_text="Machine generation of its storage unit when this machine was last changed.",
+    )
+
+    objects = MachineQuerySet.as_manager()
+
+    # Fields which are sent to storage units by storage_update_config
+    SYNC_FIELDS = frozenset(
+        ("uuid", "environment_name", "service_name", "unit_name", "comment", "ssh_public_key", "active", "published", "storage")
+    )
+
+    class Meta:
+        indexes = [
+            # Incremental machine lists in storage_update_config
+            models.Index(fields=["storage", "storage_generation"], name="machine_storage_generation_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and not (self.SYNC_FIELDS & set(update_fields)):
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            if not self._state.adding:
+                old = Machine.objects.filter(pk=self.pk).values_list("storage_id", "uuid").first()
+                if old is not None and old != (self.storage_id, self.uuid):
+                    # The old storage unit can't be told about the removal
+                    # incrementally
+                    Storage.objects.bump_machines_generation(old[0], resync=True)
+            self.storage_generation = Storage.objects.bump_machines_generation(self.storage_id) or 0
+            if update_fields is not None:
+                kwargs["update_fields"] = set(update_fields) | {"storage_generation"}
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return "%s (%s)" % (self.unit_name, str(self.uuid)[0:8])
 
 
+@receiver(post_delete, sender=Machine)
+def _machine_deleted(sender, instance, **kwargs):
+    Storage.objects.bump_machines_generation(instance.storage_id, resync=True)
+
+
 class Source(models.Model):
     def healthy(self):
         now = timezone.localtime()
@@ -287,16 +416,16 @@ class Source(models.Model):
     machine = models.ForeignKey(Machine, on_delete=models.CASCADE, help_text="Machine this source belongs to.")
     comment = models.CharField(max_length=200, blank=True, null=True, help_text="Human-readable comment.")
     path = models.CharField(max_length=200, help_text="Full filesystem path of this source.")
-    filter = models.CharField(
-        max_length=2048,
-        default="[]",
-        validators=[validate_json_string_list],
+    filter = models.JSONField(
+        default=list,
+        blank=True,
+        validators=[validate_string_list],
         help_text="JSON list of rsync-compatible --filter options.",
     )
-    exclude = models.CharField(
-        max_length=2048,
-        default="[]",
-        validators=[validate_json_string_list],
+    exclude = models.JSONField(
+        default=list,
+        blank=True,
+        validators=[validate_string_list],
         help_text="JSON list of rsync-compatible --exclude options.",
     )
     frequency = models.CharField(max_length=200, default="daily", help_text="How often to back up this source.")
@@ -353,7 +482,7 @@ class Source(models.Model):
     )
     date_updated = models.DateTimeField(
         default=timezone.localtime,
-        help_text="Date/time the machine presented a modified config of this source.",
+        help_text="Date/time the machine presented a modified config of this source, or it was otherwise changed.",
     )
     date_last_backed_up = models.DateTimeField(
         blank=True,
@@ -366,8 +495,32 @@ class Source(models.Model):
         + "trigger a backup as soon as possible.",
     )
 
+    objects = SourceQuerySet.as_manager()
+
+    # Fields which are updated by backup runs, not config changes
+    STATUS_FIELDS = frozenset(("success", "date_last_backed_up", "date_next_backup"))
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or not set(update_fields) <= self.STATUS_FIELDS:
+            # date_updated versions the source for agent_ping_restore
+            self.date_updated = timezone.localtime()
+            if update_fields is not None:
+                kwargs["update_fields"] = set(update_fields) | {"date_updated"}
+        super().save(*args, **kwargs)
+
     class Meta:
         unique_together = (("machine", "name"),)
+        indexes = [
+            # Scheduled source lookups during machine/storage check-ins.
+            # Where partial indexes are not supported (MySQL), the
+            # index is skipped and the machine foreign key index is used.
+            models.Index(
+                fields=["machine", "date_next_backup"],
+                condition=models.Q(active=True, published=True),
+                name="source_scheduled_idx",
+            ),
+        ]
 
     def __str__(self):
         return "%s %s" % (self.machine.unit_name, self.name)
@@ -393,6 +546,14 @@ class BackupLog(models.Model):
     snapshot = models.CharField(max_length=200, blank=True, null=True, help_text="Name of the created snapshot.")
     summary = models.TextField(blank=True, null=True, help_text="Summary of the backup's events.")
 
+    class Meta:
+        indexes = [
+            # Per-source log history
+            models.Index(fields=["source", "date"], name="backuplog_source_date_idx"),
+            # Log cleanup
+            models.Index(fields=["date_end"], name="backuplog_date_end_idx"),
+        ]
+
     def __str__(self):
         return "%s %s" % (str(self.source), self.date.strftime("%Y-%m-%d %H:%M:%S"))
 
@@ -400,14 +561,16 @@ class BackupLog(models.Model):
 class FilterSet(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, blank=False, null=False)
     name = models.CharField(max_length=200, unique=True, help_text="Name of this filter set.")
-    filters = models.TextField(
-        default="[]",
-        validators=[validate_json_string_list],
+    filters = models.JSONField(
+        default=list,
+        blank=True,
+        validators=[validate_string_list],
         help_text="JSON list of this filter set's filter rules.",
     )
     comment = models.CharField(max_length=200, blank=True, null=True, help_text="Human-readable comment.")
     active = models.BooleanField(default=True, help_text="Whether this filter set is enabled.")
     date_added = models.DateTimeField(default=timezone.localtime, help_text="Date/time this filter set was added.")
+    date_updated = models.DateTimeField(auto_now=True, help_text="Date/time this filter set was last changed.")
 
     def __str__(self):
         return self.name
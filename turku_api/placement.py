@@ -0,0 +1,142 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import bisect
+import itertools
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count, Q
+
+from turku_api.models import Storage
+
+
+def storage_weight(space_available, load, healthy=True):
+    """Return the placement weight of a Storage
+
+    The weight is the available space per unit of assigned load (each
+    active Machine and Source counts as one unit), so a new Machine is
+    drawn towards storages with room to spare and few existing jobs.
+    Unhealthy storages get no weight.
+    """
+    if not healthy:
+        return 0.0
+    return float(space_available) / (1 + load)
+
+
+class PlacementTable:
+    """Weighted Storage picker for new Machines
+
+    Holds the candidate storages with a cumulative weight table, so
+    each pick is a bisect lookup.  Assignments update the load of the
+    chosen storage in place, only recomputing the cumulative weights
+    from that storage onward.
+    """
+
+    def __init__(self, storages):
+        # storages is a list of (storage, space_available, load, healthy)
+        self.storages = [s[0] for s in storages]
+        self.space = [s[1] for s in storages]
+        self.load = [s[2] for s in storages]
+        self.healthy = [s[3] for s in storages]
+        if not any(self.healthy):
+            # If every storage looks unhealthy, it's more likely to be
+            # a monitoring problem than a real one; don't refuse service
+            self.healthy = [True] * len(self.storages)
+        self.weights = [storage_weight(*args) for args in zip(self.space, self.load, self.healthy)]
+        self.cumulative = list(itertools.accumulate(self.weights))
+        self.index = {storage.pk: i for i, storage in enumerate(self.storages)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.storages)
+
+    @property
+    def total(self):
+        return self.cumulative[-1] if self.cumulative else 0.0
+
+    def choose(self, rand=random.random):
+        """Return a Storage, or raise IndexError if there are none"""
+        with self._lock:
+            if not self.storages:
+                raise IndexError("No storages available")
+            if self.total <= 0:
+                candidates = [s for s, healthy in zip(self.storages, self.healthy) if healthy]
+                return candidates[int(rand() * len(candidates)) % len(candidates)]
+            i = bisect.bisect_right(self.cumulative, rand() * self.total)
+            return self.storages[min(i, len(self.storages) - 1)]
+
+    def add_load(self, storage, load=1):
+        """Account for load newly assigned to a Storage"""
+        with self._lock:
+            i = self.index.get(storage.pk)
+            if i is None:
+                return
+            self.load[i] += load
+            delta = storage_weight(self.space[i], self.load[i], self.healthy[i]) - self.weights[i]
+            self.weights[i] += delta
+            for j in range(i, len(self.cumulative)):
+                self.cumulative[j] += delta
+
+    def shares(self):
+        """Return the probability of each Storage being chosen next"""
+        with self._lock:
+            total = self.total
+            if total <= 0:
+                return [1.0 / len(self.storages) if h else 0.0 for h in self.healthy] if self.storages else []
+            return [w / total for w in self.weights]
+
+
+def build_placement_table():
+    """Build a PlacementTable of all active, published storages"""
+    storages = Storage.objects.filter(active=True, published=True).annotate(
+        machine_count=Count("machine", filter=Q(machine__active=True), distinct=True),
+        source_count=Count(
+            "machine__source",
+            filter=Q(machine__active=True, machine__source__active=True),
+            distinct=True,
+        ),
+    )
+    return PlacementTable(
+        [(s, s.space_available, s.machine_count + s.source_count, s.healthy()) for s in storages.order_by("name")]
+    )
+
+
+class Placement:
+    """Process-wide PlacementTable, rebuilt after TURKU_PLACEMENT_TTL seconds"""
+
+    def __init__(self):
+        self._table = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, "TURKU_PLACEMENT_TTL", 60)
+
+    def table(self):
+        with self._lock:
+            if self._table is None or time.monotonic() >= self._expires:
+                self._table = build_placement_table()
+                self._expires = time.monotonic() + self.ttl
+            return self._table
+
+    def choose(self):
+        """Pick a Storage for a new Machine, and account for it"""
+        table = self.table()
+        storage = table.choose()
+        table.add_load(storage)
+        return storage
+
+    def invalidate(self):
+        with self._lock:
+            self._table = None
+
+
+placement = Placement()
@@ -0,0 +1,186 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import contextlib
+import contextvars
+import cProfile
+import itertools
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from turku_api.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Set for the duration of an instrumented request.  Context variables
+# are copied into sync_to_async threads, so the async views are
+# accounted for too.
+_current = contextvars.ContextVar("turku_request_stats", default=None)
+
+
+class RequestStats:
+    """Time and resources spent handling one API request"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.response = None
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.hashing = False
+
+    def record(self, duration):
+        status = self.response.status_code if self.response is not None else 500
+        metrics.observe("turku_request_duration_seconds", duration, endpoint=self.endpoint)
+        metrics.incr("turku_requests_total", endpoint=self.endpoint, status=status)
+        metrics.incr("turku_request_db_queries_total", self.db_queries, endpoint=self.endpoint)
+        metrics.incr("turku_request_db_seconds_total", self.db_seconds, endpoint=self.endpoint)
+        metrics.incr("turku_request_hash_seconds_total", self.hash_seconds, endpoint=self.endpoint)
+        if self.response is not None and not self.response.streaming:
+            metrics.incr("turku_response_bytes_total", len(self.response.content), endpoint=self.endpoint)
+
+
+def _db_wrapper(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.db_queries += 1
+        stats.db_seconds += time.perf_counter() - start
+
+
+def install_db_wrapper(connection):
+    # Inserted first, so it doesn't upset the pop() in
+    # connection.execute_wrapper() if installed within one
+    if _db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _db_wrapper)
+
+
+@receiver(connection_created)
+def _connection_created(sender, connection, **kwargs):
+    install_db_wrapper(connection)
+
+
+@contextlib.contextmanager
+def hash_timer():
+    """Count the time spent in the block towards the request's password hashing
+
+    Nested blocks (such as a hash upgrade within check_password) are
+    only counted once.
+    """
+    stats = _current.get()
+    if stats is None or stats.hashing:
+        yield
+        return
+    stats.hashing = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.hash_seconds += time.perf_counter() - start
+        stats.hashing = False
+
+
+class SlowRequestProfiler:
+    """Opt-in cProfile sampling of API requests
+
+    A TURKU_PROFILE_SAMPLE_RATE fraction of requests is run under
+    cProfile, and profiles of those taking at least
+    TURKU_PROFILE_THRESHOLD seconds are written as pstats files to
+    TURKU_PROFILE_DIR.  Only one request per process is profiled at a
+    time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._serial = itertools.count()
+
+    @property
+    def sample_rate(self):
+        return getattr(settings, "TURKU_PROFILE_SAMPLE_RATE", 0.0)
+
+    @property
+    def threshold(self):
+        return getattr(settings, "TURKU_PROFILE_THRESHOLD", 1.0)
+
+    @property
+    def directory(self):
+        return getattr(settings, "TURKU_PROFILE_DIR", None) or tempfile.gettempdir()
+
+    def start(self):
+        """Return an enabled cProfile.Profile if this request is sampled"""
+        sample_rate = self.sample_rate
+        if not sample_rate or random.random() >= sample_rate:
+            return None
+        if not self._lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this process
+            self._lock.release()
+            return None
+        return profile
+
+    def finish(self, profile, endpoint, duration):
+        """Stop profiling, returning the pstats file path if the request was slow"""
+        profile.disable()
+        self._lock.release()
+        if duration < self.threshold:
+            return None
+        filename = os.path.join(
+            self.directory,
+            "turku-{}-{}-{}-{}.pstats".format(endpoint, time.strftime("%Y%m%dT%H%M%S"), os.getpid(), next(self._serial)),
+        )
+        try:
+            profile.dump_stats(filename)
+        except OSError:
+            logger.exception("Could not write profile of slow %s request", endpoint)
+            return None
+        metrics.incr("turku_slow_request_profiles_total", endpoint=endpoint)
+        logger.warning("Slow %s request (%.3f seconds) profiled to %s", endpoint, duration, filename)
+        return filename
+
+
+profiler = SlowRequestProfiler()
+
+
+@contextlib.contextmanager
+def instrument(endpoint, profile=True):
+    """Record latency, DB, hashing and response size metrics for a request
+
+    The caller sets the yielded RequestStats' response.  cProfile only
+    follows the calling thread, so profile should be False for async
+    views.
+    """
+    stats = RequestStats(endpoint)
+    token = _current.set(stats)
+    for connection in connections.all():
+        install_db_wrapper(connection)
+    active_profile = profiler.start() if profile else None
+    try:
+        yield stats
+    finally:
+        duration = time.perf_counter() - stats.start
+        if active_profile is not None:
+            profiler.finish(active_profile, endpoint, duration)
+        _current.reset(token)
+        stats.record(duration)
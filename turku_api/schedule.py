@@ -0,0 +1,271 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import binascii
+import collections
+from datetime import datetime, timedelta
+import functools
+import threading
+
+try:
+    from croniter import croniter
+except ImportError as e:
+    # We only want to raise this import error if cron format is
+    # attempted by the client
+    croniter = e
+
+from django.conf import settings
+from django.utils import timezone
+
+DAY_MAP = {
+    "sunday": 0,
+    "monday": 1,
+    "tuesday": 2,
+    "wednesday": 3,
+    "thursday": 4,
+    "friday": 5,
+    "saturday": 6,
+}
+
+# A parsed frequency definition.  period is "cron", "hourly", "daily",
+# "weekly", "monthly" or a day name.  cron is the cron definition for
+# the "cron" period.  start/end are the allowed time of day in seconds:
+# both None for any time, end None for an exact time, and end may be
+# past 86400 for ranges which roll over midnight.
+Schedule = collections.namedtuple("Schedule", ("period", "cron", "start", "end"))
+
+_cron_lock = threading.Lock()
+
+
+def hashedint(a, b, hash_id=""):
+    """ID-hashed drop-in replacement for random.randint"""
+
+    if isinstance(hash_id, bytes):
+        id_bytes = hash_id
+    elif isinstance(hash_id, str):
+        id_bytes = hash_id.encode("UTF-8")
+    else:
+        raise TypeError("id must be bytes or UTF-8 string")
+
+    crc = binascii.crc32(id_bytes) & 0xFFFFFFFF
+    return (crc % (b - a + 1)) + a
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_frequency(frequency):
+    """Parse a frequency definition into a Schedule"""
+    if frequency.startswith("cron"):
+        if isinstance(croniter, ImportError):
+            # croniter is not installed
+            raise croniter
+        return Schedule("cron", " ".join(frequency.split(" ")[1:]), None, None)
+
+    f = [x.strip() for x in frequency.split(",")]
+    period = f[0]
+    if period not in ("hourly", "daily", "weekly", "monthly") and period not in DAY_MAP:
+        # Fall back to daily
+        period = "daily"
+    if len(f) == 1 or period == "hourly":
+        return Schedule(period, None, None, None)
+
+    time_range = f[1].split("-")
+    start = (int(time_range[0][0:2]) * 60 * 60) + (int(time_range[0][2:4]) * 60)
+    if len(time_range) == 1:
+        # Not a range
+        return Schedule(period, None, start, None)
+    end = (int(time_range[1][0:2]) * 60 * 60) + (int(time_range[1][2:4]) * 60)
+    if end < start:
+        # Day rollover
+        end = end + 86400
+    return Schedule(period, None, start, end)
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile_cron(cron_schedule, source_id):
+    return croniter(cron_schedule, hash_id=source_id)
+
+
+def _cron_next(cron_schedule, source_id, base_time):
+    if "R" in cron_schedule:
+        # Randomized definitions are re-rolled every time
+        return croniter(cron_schedule, start_time=base_time, hash_id=source_id).get_next(datetime)
+    croniter_def = _compile_cron(cron_schedule, source_id)
+    with _cron_lock:
+        croniter_def.set_current(base_time, force=True)
+        return croniter_def.get_next(datetime)
+
+
+def schedule_target_date(schedule, source_id, base_time):
+    """Return the midnight of the day a schedule next runs on"""
+    today = base_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    if schedule.period == "weekly":
+        # Hashed day next week
+        target_day = hashedint(0, 6, source_id)
+        return today + timedelta(weeks=1) - timedelta(days=((today.weekday() + 1) % 7)) + timedelta(days=target_day)
+    elif schedule.period in DAY_MAP:
+        # Next Xday
+        target_date = today - timedelta(days=((today.weekday() + 1) % 7)) + timedelta(days=DAY_MAP[schedule.period])
+        if target_date < today:
+            target_date = target_date + timedelta(weeks=1)
+        return target_date
+    elif schedule.period == "monthly":
+        next_month = (today.replace(day=1) + timedelta(days=40)).replace(day=1)
+        month_after = (next_month.replace(day=1) + timedelta(days=40)).replace(day=1)
+        return next_month + timedelta(days=hashedint(1, (month_after - next_month).days, source_id))
+    # Tomorrow
+    return today + timedelta(days=1)
+
+
+def schedule_window(schedule):
+    """Return the (start, end) seconds of day a schedule may run within"""
+    if schedule.start is None:
+        return (0, 86399)
+    if schedule.end is None:
+        return (schedule.start, schedule.start)
+    return (schedule.start, schedule.end)
+
+
+class SlotHistogram:
+    """Number of scheduled backups starting in each time-of-day slot
+
+    Hourly schedules occupy their slot in every hour of the day; all
+    other schedules occupy the slot of their time of day.
+    """
+
+    def __init__(self, slot_seconds=60):
+        self.slot_seconds = slot_seconds
+        self.counts = [0] * (86400 // slot_seconds)
+        self._lock = threading.Lock()
+
+    def _offsets(self, hourly, offset):
+        if hourly:
+            return [(offset % 3600) + (hour * 3600) for hour in range(24)]
+        return [offset % 86400]
+
+    def _slot(self, offset):
+        return (offset // self.slot_seconds) % len(self.counts)
+
+    def add(self, frequency, when, count=1):
+        try:
+            hourly = compile_frequency(frequency).period == "hourly"
+        except (ValueError, ImportError):
+            return
+        when = when.astimezone(timezone.get_current_timezone())
+        offset = (when.hour * 3600) + (when.minute * 60) + when.second
+        with self._lock:
+            for o in self._offsets(hourly, offset):
+                slot = self._slot(o)
+                self.counts[slot] = max(0, self.counts[slot] + count)
+
+    def remove(self, frequency, when):
+        self.add(frequency, when, count=-1)
+
+    def load(self, hourly, offset):
+        return sum(self.counts[self._slot(o)] for o in self._offsets(hourly, offset))
+
+    def least_loaded(self, start, end, preferred, hourly=False):
+        """Return the least loaded offset in [start, end]
+
+        Each slot overlapping the range is a candidate, keeping the
+        preferred (hashed) offset's position within the slot.  The
+        choice is deterministic for a given histogram, and ties go to
+        the slot closest to the preferred offset.
+        """
+        best = None
+        preferred_slot, within_slot = divmod(preferred, self.slot_seconds)
+        with self._lock:
+            for slot in range(start // self.slot_seconds, (end // self.slot_seconds) + 1):
+                offset = min(max((slot * self.slot_seconds) + within_slot, start), end)
+                key = (self.load(hourly, offset), abs(slot - preferred_slot), slot)
+                if best is None or key < best[0]:
+                    best = (key, offset)
+        return best[1]
+
+
+def frequency_next_scheduled(frequency, source_id, base_time=None, histogram=None):
+    """Return the next scheduled datetime, given a frequency definition
+
+    Examples of English definitions:
+        "hourly", "daily", "weekly", "sunday", "monday", "tuesday",
+        "wednesday", "thursday", "friday", "saturday"
+    Within a specific time range: "daily, 0800-1600"
+    These definitions will return a randomly-hashed time within the
+    definition each time.
+
+    If croniter is installed, "cron" plus a cron definition can be used:
+        "cron 42 8 * * *"
+    Or a Jenkins-style hashed cron definition, consistently hashed
+    against the source ID:
+        "cron H H(8-16) * * *"
+    Or randomized:
+        "cron R R(8-16) * * *"
+
+    If a SlotHistogram is given, non-cron definitions are moved to the
+    least loaded slot within the definition, and the resulting time is
+    added to the histogram.
+    """
+    if not base_time:
+        base_time = timezone.localtime()
+    base_time = base_time.astimezone(timezone.get_current_timezone())
+    schedule = compile_frequency(frequency)
+
+    if schedule.period == "cron":
+        target_time = _cron_next(schedule.cron, source_id, base_time).replace(second=hashedint(0, 59, source_id))
+    elif schedule.period == "hourly":
+        minute = hashedint(0, 59, source_id)
+        second = hashedint(0, 59, source_id)
+        if histogram is not None:
+            minute, second = divmod(histogram.least_loaded(0, 3599, (minute * 60) + second, hourly=True), 60)
+        target_time = base_time.replace(
+            minute=minute,
+            second=second,
+            microsecond=0,
+        ) + timedelta(hours=1)
+    else:
+        start, end = schedule_window(schedule)
+        offset = hashedint(start, end, source_id)
+        if histogram is not None:
+            offset = histogram.least_loaded(start, end, offset)
+        target_time = schedule_target_date(schedule, source_id, base_time) + timedelta(seconds=offset)
+
+    if histogram is not None:
+        histogram.add(frequency, target_time)
+    return target_time
+
+
+def frequency_next_scheduled_times(frequency, source_id, count, base_time=None):
+    """Return the next count scheduled datetimes, given a frequency definition"""
+    out = []
+    for i in range(count):
+        base_time = frequency_next_scheduled(frequency, source_id, base_time)
+        out.append(base_time)
+    return out
+
+
+def storage_slot_histogram(storage):
+    """Return the shared SlotHistogram of a Storage's sources
+
+    Returns None unless TURKU_SCHEDULE_LOAD_LEVELING is enabled.  The
+    histogram is built with one query and kept up to date by this
+    process until it expires from the cache, after which it is rebuilt
+    to pick up changes made by other processes.
+    """
+    if not getattr(settings, "TURKU_SCHEDULE_LOAD_LEVELING", False):
+        return None
+    from turku_api.cache import histogram_cache
+    from turku_api.models import Source
+
+    histogram = histogram_cache.get(storage.pk)
+    if histogram is not None:
+        return histogram
+    histogram = SlotHistogram(getattr(settings, "TURKU_SCHEDULE_SLOT_SECONDS", 60))
+    for frequency, date_next_backup in Source.objects.filter(
+        machine__storage=storage, machine__active=True, active=True, published=True
+    ).values_list("frequency", "date_next_backup"):
+        histogram.add(frequency, date_next_backup)
+    histogram_cache.set(storage.pk, histogram)
+    return histogram
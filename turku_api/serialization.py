@@ -0,0 +1,60 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from django.conf import settings
+from django.http import HttpResponse
+
+
+def _backend():
+    backend = getattr(settings, "TURKU_JSON_BACKEND", "auto")
+    if backend == "auto":
+        return "orjson" if orjson is not None else "json"
+    if backend == "orjson" and orjson is None:
+        raise ImportError("TURKU_JSON_BACKEND is orjson, but orjson is not installed")
+    if backend not in ("orjson", "json"):
+        raise ValueError("Unknown TURKU_JSON_BACKEND {}".format(backend))
+    return backend
+
+
+BACKEND = _backend()
+
+
+def dumps(obj):
+    """Encode an API response or request body, returning bytes"""
+    if BACKEND == "orjson":
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("UTF-8")
+
+
+def loads(data):
+    """Decode an API request body
+
+    Raises ValueError on invalid JSON, with either backend.
+    """
+    if BACKEND == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def canonical_dumps(obj, **kwargs):
+    """Encode obj as stable text, for hashing
+
+    This always uses the stdlib encoder with sorted keys, so hashes
+    don't change with the backend.
+    """
+    return json.dumps(obj, sort_keys=True, **kwargs)
+
+
+def json_response(obj, **kwargs):
+    return HttpResponse(dumps(obj), content_type="application/json", **kwargs)
@@ -33,6 +33,7 @@ MIDDLEWARE = (
 MIDDLEWARE_CLASSES = MIDDLEWARE  # pre-1.10
 ROOT_URLCONF = "turku_api.urls"
 WSGI_APPLICATION = "turku_api.wsgi.application"
+ASGI_APPLICATION = "turku_api.asgi.application"
 LANGUAGE_CODE = "en-us"
 TIME_ZONE = "UTC"
 USE_I18N = True
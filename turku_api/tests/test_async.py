@@ -0,0 +1,90 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from datetime import timedelta
+import json
+from unittest import mock
+
+from django.test import override_settings
+from django.utils import timezone
+
+try:
+    from django.urls import re_path
+except ImportError:
+    from django.conf.urls import url as re_path
+
+from turku_api import async_views
+from turku_api.hashing import hasher_pool
+from turku_api.metrics import metrics
+from turku_api.models import Machine, Source
+from turku_api.tests.test_views import APITestCase
+
+urlpatterns = [re_path(r"^v1/", async_views.urls)]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class TestAsyncViews(APITestCase):
+    async def aapi(self, view_name, data, status=200):
+        response = await self.async_client.post("/v1/{}".format(view_name), json.dumps(data), content_type="application/json")
+        self.assertEqual(response.status_code, status, response.content)
+        return json.loads(response.content) if status == 200 else response
+
+    async def test_agent_ping_checkin(self):
+        """Test check-ins authenticate in the hasher pool and return due sources"""
+        await Source.objects.acreate(
+            name="source1", machine=self.machine, path="/srv", date_next_backup=timezone.now() - timedelta(minutes=1)
+        )
+        with mock.patch.object(hasher_pool, "run", wraps=hasher_pool.run) as run:
+            out = await self.aapi("agent_ping_checkin", self.machine_req())
+        self.assertEqual(list(out["machine"]["scheduled_sources"]), ["source1"])
+        self.assertEqual(run.call_count, 1)
+
+        await self.aapi(
+            "agent_ping_checkin", dict(self.machine_req(), machine={"uuid": str(self.machine.uuid), "secret": "x"}), 403
+        )
+
+    async def test_long_poll(self):
+        """Test an async long-poll wakes when a source comes due"""
+        await Source.objects.acreate(
+            name="source1", machine=self.machine, path="/srv", date_next_backup=timezone.now() + timedelta(seconds=1)
+        )
+        out = await self.aapi("agent_ping_checkin", self.machine_req(wait=30))
+        self.assertEqual(list(out["machine"]["scheduled_sources"]), ["source1"])
+
+    async def test_storage_endpoints(self):
+        """Test storage endpoints, including those run synchronously"""
+        await Source.objects.acreate(
+            name="source1", machine=self.machine, path="/srv", date_next_backup=timezone.now() - timedelta(minutes=1)
+        )
+        out = await self.aapi("storage_ping_checkin", self.storage_req(machine={"uuid": str(self.machine.uuid)}))
+        self.assertEqual(out["machine"]["unit_name"], "machine1")
+        self.assertIn("source1", out["machine"]["scheduled_sources"])
+        out = await self.aapi("storage_update_config", self.storage_req())
+        self.assertEqual(list(out["machines"]), [str(self.machine.uuid)])
+
+    async def test_update_config(self):
+        """Test update_config through the async handler"""
+        await self.aapi("update_config", self.machine_req(unit_name="renamed"))
+        self.assertEqual((await Machine.objects.aget(pk=self.machine.pk)).unit_name, "renamed")
+        self.assertEqual((await self.aapi("health", {}))["counts"]["machine"], 1)
+
+    async def test_metrics(self):
+        """Test hashing and queries in pool and sync_to_async threads are counted"""
+        metrics.clear()
+        await self.aapi("agent_ping_checkin", self.machine_req())
+        await self.aapi("update_config", self.machine_req(unit_name="renamed"))
+        for endpoint in ("update_config", "agent_ping_checkin"):
+            self.assertEqual(metrics.get("turku_requests_total", endpoint=endpoint, status=200), 1)
+            self.assertGreater(metrics.get("turku_request_db_queries_total", endpoint=endpoint), 0)
+        self.assertGreater(metrics.get("turku_request_hash_seconds_total", endpoint="agent_ping_checkin"), 0)
+
+    async def test_session_token(self):
+        with self.settings(TURKU_SESSION_TOKEN_TTL=3600):
+            token = (await self.aapi("session_token", self.machine_req()))["token"]
+            with mock.patch.object(hasher_pool, "run") as run:
+                await self.aapi("agent_ping_checkin", {"machine": {"uuid": str(self.machine.uuid), "token": token}})
+            run.assert_not_called()
@@ -0,0 +1,130 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.utils import timezone
+
+from turku_api.models import BackupLog, Machine, Source, Storage
+from turku_api.tests.test_views import APITestCase
+
+
+class TestCleanLogs(APITestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        self.source = Source.objects.create(name="source1", machine=self.machine, path="/srv/source1")
+        for days in range(10):
+            BackupLog.objects.create(source=self.source, date=now - timedelta(days=days), date_end=now - timedelta(days=days))
+        BackupLog.objects.create(source=self.source, date=now - timedelta(days=20), date_end=None)
+
+    def test_days(self):
+        """Test logs older than --days are cleaned, including logs without an end time"""
+        call_command("turku_clean_logs", days=5, batch_size=2)
+        self.assertEqual(BackupLog.objects.count(), 5)
+
+    def test_keep_last(self):
+        """Test --keep-last keeps the most recent logs per source"""
+        call_command("turku_clean_logs", days=1, keep_last=8)
+        self.assertEqual(BackupLog.objects.count(), 8)
+
+    def test_dry_run(self):
+        """Test --dry-run only counts logs"""
+        out = StringIO()
+        call_command("turku_clean_logs", days=5, dry_run=True, stdout=out)
+        self.assertEqual(out.getvalue(), "6 logs would be cleaned\n")
+        self.assertEqual(BackupLog.objects.count(), 11)
+
+
+class TestHealth(APITestCase):
+    def test_sick_matches_healthy(self):
+        """Test the sick() querysets agree with the healthy() methods"""
+        now = timezone.now()
+        self.machine.date_registered = now - timedelta(days=1)
+        self.machine.save()
+        Source.objects.create(name="new", machine=self.machine, path="/srv/new", success=False)
+        Source.objects.create(
+            name="failed", machine=self.machine, path="/srv/failed", success=False, date_added=now - timedelta(days=1)
+        )
+        Source.objects.create(
+            name="late",
+            machine=self.machine,
+            path="/srv/late",
+            date_added=now - timedelta(days=1),
+            date_next_backup=now - timedelta(days=1),
+        )
+        Source.objects.create(name="ok", machine=self.machine, path="/srv/ok", date_added=now - timedelta(days=1))
+        for model in (Storage, Machine, Source):
+            sick = set(model.objects.sick().values_list("pk", flat=True))
+            self.assertEqual(sick, {o.pk for o in model.objects.all() if not o.healthy()})
+        self.assertEqual(set(Source.objects.sick().values_list("name", flat=True)), {"failed", "late"})
+
+    def test_command(self):
+        """Test the Nagios output"""
+        out = StringIO()
+        self.machine.date_registered = timezone.now() - timedelta(days=1)
+        self.machine.save()
+        with self.assertRaises(SystemExit) as cm:
+            call_command("turku_health", verbosity=2, stdout=out)
+        self.assertEqual(cm.exception.code, 2)
+        self.assertEqual(out.getvalue(), "CRITICAL 0/1 storages, 1/1 machines, 0/0 sources\n<Machine: machine1 (9d9e8a6b)>\n")
+
+
+class TestReschedule(APITestCase):
+    def test_reschedule(self):
+        """Test sources are rescheduled from their last backup"""
+        now = timezone.now()
+        later = now + timedelta(days=30)
+        for name in ("source1", "source2", "source3"):
+            Source.objects.create(name=name, machine=self.machine, path="/srv/{}".format(name))
+        Source.objects.create(name="source4", machine=self.machine, path="/srv/source4", date_next_backup=now)
+        # Backed up after their last config change, as by storage_ping_source_update
+        Source.objects.exclude(name="source4").update(
+            date_updated=now - timedelta(hours=1), date_last_backed_up=now, date_next_backup=later
+        )
+        # Manually triggered
+        Source.objects.filter(name="source2").update(date_next_backup=now)
+        # Frequency changed since its last backup
+        source3 = Source.objects.get(name="source3")
+        source3.frequency = "weekly"
+        source3.save()
+
+        call_command("turku_reschedule")
+        self.assertLess(Source.objects.get(name="source1").date_next_backup, later)
+        self.assertEqual(Source.objects.get(name="source2").date_next_backup, now)
+        self.assertEqual(Source.objects.get(name="source3").date_next_backup, later)
+        self.assertEqual(Source.objects.get(name="source4").date_next_backup, now)
+
+        call_command("turku_reschedule", all=True)
+        self.assertGreater(Source.objects.get(name="source2").date_next_backup, now)
+        self.assertLess(Source.objects.get(name="source3").date_next_backup, later)
+        self.assertEqual(Source.objects.get(name="source4").date_next_backup, now)
+
+
+class TestScheduleSimulate(APITestCase):
+    def test_simulate(self):
+        """Test the simulation reports per-storage peaks"""
+        for i in range(5):
+            Source.objects.create(name="source{}".format(i), machine=self.machine, path="/srv", frequency="daily, 0800-0805")
+        out = StringIO()
+        call_command("turku_schedule_simulate", duration=1, stdout=out)
+        self.assertRegex(out.getvalue(), r"^storage1: 5 sources, peak concurrent backups \d+ hashed, 1 load-leveled\n$")
+
+
+class TestPlacementReport(APITestCase):
+    def test_report(self):
+        """Test the report projects placement of new machines"""
+        Storage.objects.filter(pk=self.storage.pk).update(space_available=1000)
+        out = StringIO()
+        call_command("turku_placement_report", machines=3, stdout=out)
+        self.assertEqual(
+            out.getvalue(),
+            "storage1: 1000 MiB available, load 1 -> 4, next share 100.0%\n"
+            "Space per load skew: 1.00 now, 1.00 after 3 new machines\n",
+        )
@@ -0,0 +1,64 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth import hashers
+from django.test import TestCase
+
+import turku_api.cache
+from turku_api import hashing
+from turku_api.metrics import metrics
+from turku_api.tests.test_views import APITestCase
+
+
+class TestHasherPool(TestCase):
+    def setUp(self):
+        metrics.clear()
+
+    def test_saturated(self):
+        """Test submissions beyond the queue limit are refused at once"""
+        pool = hashing.HasherPool()
+        release = threading.Event()
+        with self.settings(TURKU_HASHER_THREADS=1, TURKU_HASHER_MAX_QUEUE=1):
+            running = pool.submit(release.wait, 5)
+            while metrics.get("turku_hasher_active") < 1:
+                time.sleep(0.01)
+            queued = pool.submit(int, "1")
+            self.assertEqual(metrics.get("turku_hasher_queued"), 1)
+            with self.assertRaises(hashing.HasherSaturated) as cm:
+                pool.submit(int, "2")
+            self.assertGreaterEqual(cm.exception.retry_after, 1)
+            release.set()
+            self.assertTrue(running.result())
+            self.assertEqual(queued.result(), 1)
+        pool.shutdown()
+        self.assertEqual(metrics.get("turku_hasher_rejected_total"), 1)
+        self.assertEqual(metrics.get_histogram("turku_hasher_wait_seconds").count, 2)
+
+    def test_upgrade_on_caller(self):
+        """Test hash upgrades are saved from the calling thread, not the pool"""
+        threads = []
+        with self.settings(
+            PASSWORD_HASHERS=["django.contrib.auth.hashers.PBKDF2PasswordHasher", "django.contrib.auth.hashers.MD5PasswordHasher"]
+        ):
+            encoded = hashers.make_password("secret", hasher="md5")
+            self.assertTrue(hashing.check_password("secret", encoded, lambda password: threads.append(threading.get_ident())))
+        self.assertEqual(threads, [threading.get_ident()])
+
+
+class TestHasherBackpressure(APITestCase):
+    def test_503(self):
+        """Test a saturated hasher pool answers 503 with Retry-After"""
+        turku_api.cache.secret_cache.clear()
+        with mock.patch.object(hashing.hasher_pool, "call", side_effect=hashing.HasherSaturated(7)):
+            response = self.client.post("/v1/agent_ping_checkin", json.dumps(self.machine_req()), content_type="application/json")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "7")
@@ -0,0 +1,71 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.test import TestCase
+
+from turku_api import schedule
+
+
+class TestFrequencyNextScheduled(TestCase):
+    base_time = datetime(2024, 1, 3, 12, 0, 0, tzinfo=dt_timezone.utc)  # Wednesday
+
+    def test_compile(self):
+        """Test frequency definitions are parsed"""
+        self.assertEqual(schedule.compile_frequency("daily, 0800-1600"), schedule.Schedule("daily", None, 28800, 57600))
+        self.assertEqual(schedule.compile_frequency("monday, 2200-0200"), schedule.Schedule("monday", None, 79200, 93600))
+        self.assertEqual(schedule.compile_frequency("bogus, 0315"), schedule.Schedule("daily", None, 11700, None))
+        self.assertEqual(schedule.compile_frequency("cron H 8 * * *"), schedule.Schedule("cron", "H 8 * * *", None, None))
+
+    def test_daily_range(self):
+        """Test a daily time range"""
+        t = schedule.frequency_next_scheduled("daily, 0800-1600", "source", self.base_time)
+        self.assertEqual(t.date(), datetime(2024, 1, 4).date())
+        self.assertTrue(8 <= t.hour <= 16)
+
+    def test_day_name(self):
+        """Test a named day"""
+        t = schedule.frequency_next_scheduled("friday, 0315", "source", self.base_time)
+        self.assertEqual(t, datetime(2024, 1, 5, 3, 15, tzinfo=dt_timezone.utc))
+
+    def test_cron(self):
+        """Test a hashed cron definition is stable per source"""
+        t1 = schedule.frequency_next_scheduled("cron H 8 * * *", "source", self.base_time)
+        t2 = schedule.frequency_next_scheduled("cron H 8 * * *", "source", self.base_time)
+        self.assertEqual(t1, t2)
+        self.assertEqual((t1.date(), t1.hour), (datetime(2024, 1, 4).date(), 8))
+
+    def test_next_times(self):
+        """Test the next N scheduled times"""
+        times = schedule.frequency_next_scheduled_times("hourly", "source", 3, self.base_time)
+        self.assertEqual(times[1] - times[0], timedelta(hours=1))
+        self.assertEqual(times[2] - times[1], timedelta(hours=1))
+
+
+class TestLoadLeveling(TestCase):
+    base_time = datetime(2024, 1, 3, 12, 0, 0, tzinfo=dt_timezone.utc)
+
+    def test_least_loaded(self):
+        """Test sources are spread over the least loaded slots"""
+        histogram = schedule.SlotHistogram(60)
+        times = [
+            schedule.frequency_next_scheduled("daily, 0800-0810", "source{}".format(i), self.base_time, histogram)
+            for i in range(11)
+        ]
+        self.assertEqual(sorted(t.minute for t in times), list(range(11)))
+        self.assertEqual(sum(histogram.counts), 11)
+
+    def test_deterministic(self):
+        """Test the leveled choice is deterministic for a given histogram"""
+        h1 = schedule.SlotHistogram(60)
+        h2 = schedule.SlotHistogram(60)
+        for h in (h1, h2):
+            h.add("daily", datetime(2024, 1, 4, 8, 5, tzinfo=dt_timezone.utc))
+        t1 = schedule.frequency_next_scheduled("daily, 0800-0900", "source", self.base_time, h1)
+        t2 = schedule.frequency_next_scheduled("daily, 0800-0900", "source", self.base_time, h2)
+        self.assertEqual(t1, t2)
@@ -0,0 +1,31 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from unittest import mock, skipIf
+
+from django.test import TestCase
+
+from turku_api import serialization
+
+
+class TestSerialization(TestCase):
+    obj = {"machine": {"sources": {"source1": {"filter": ["- *.tmp"], "bwlimit": None, "shared_service": False}}}}
+
+    def test_stdlib(self):
+        """Test the stdlib backend round trip"""
+        with mock.patch.object(serialization, "BACKEND", "json"):
+            self.assertEqual(serialization.loads(serialization.dumps(self.obj)), self.obj)
+            with self.assertRaises(ValueError):
+                serialization.loads(b"{")
+
+    @skipIf(serialization.orjson is None, "orjson not installed")
+    def test_orjson(self):
+        """Test the orjson backend round trip and error type"""
+        with mock.patch.object(serialization, "BACKEND", "orjson"):
+            self.assertEqual(serialization.loads(serialization.dumps(self.obj)), self.obj)
+            with self.assertRaises(ValueError):
+                serialization.loads(b"{")
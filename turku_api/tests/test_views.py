@@ -5,8 +5,29 @@
 # SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-from django.test import TestCase
+from datetime import timedelta
+import json
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+from unittest import mock
+import uuid
 
+from django.contrib.auth import hashers
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import turku_api.cache
+from turku_api.heartbeat import heartbeats
+from turku_api.longpoll import WaitRegistry, waits
+from turku_api.metrics import Metrics, metrics
+from turku_api.models import Auth, BackupLog, FilterSet, Machine, Source, Storage
+from turku_api.placement import PlacementTable
 import turku_api.views
 
 
@@ -27,3 +48,648 @@ class TestHashedint(TestCase):
         """Test invalid id type raises TypeError"""
         with self.assertRaises(TypeError):
             turku_api.views.hashedint(1, 100, hash_id={1: 2})
+
+
+class APITestCase(TestCase):
+    machine_secret = "machine-secret"
+    storage_secret = "storage-secret"
+
+    def setUp(self):
+        self.storage_auth = Auth.objects.create(
+            name="Storage Registrations", secret_hash=hashers.make_password("storage-reg"), secret_type="storage_reg"
+        )
+        self.machine_auth = Auth.objects.create(
+            name="Machine Registrations", secret_hash=hashers.make_password("machine-reg"), secret_type="machine_reg"
+        )
+        self.storage = Storage.objects.create(
+            name="storage1",
+            secret_hash=hashers.make_password(self.storage_secret),
+            ssh_ping_host="storage1.example.com",
+            ssh_ping_host_keys=["ssh-ed25519 AAAA"],
+            ssh_ping_port=22,
+            ssh_ping_user="turku",
+            auth=self.storage_auth,
+        )
+        self.machine = Machine.objects.create(
+            uuid=uuid.UUID("9d9e8a6b-2f5c-4b1e-8c3a-6f0d1e2a7b45"),
+            secret_hash=hashers.make_password(self.machine_secret),
+            unit_name="machine1",
+            ssh_public_key="ssh-ed25519 BBBB",
+            auth=self.machine_auth,
+            storage=self.storage,
+        )
+        turku_api.cache.secret_cache.clear()
+        turku_api.cache.filter_cache.clear()
+        heartbeats.clear()
+
+    def tearDown(self):
+        heartbeats.flush()
+
+    def api(self, view_name, data):
+        response = self.client.post("/v1/{}".format(view_name), json.dumps(data), content_type="application/json")
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content)
+
+    def machine_req(self, **kwargs):
+        req = {"uuid": str(self.machine.uuid), "secret": self.machine_secret}
+        req.update(kwargs)
+        return {"machine": req}
+
+    def storage_req(self, machine=None, **kwargs):
+        req = {"storage": {"name": self.storage.name, "secret": self.storage_secret}}
+        req["storage"].update(kwargs)
+        if machine is not None:
+            req["machine"] = machine
+        return req
+
+
+class TestSecretCache(APITestCase):
+    def test_repeat_login_skips_hasher(self):
+        """Test a repeated machine login only verifies the secret once"""
+        with mock.patch("turku_api.hashing.hashers.check_password", wraps=hashers.check_password) as check_password:
+            self.api("agent_ping_checkin", self.machine_req())
+            self.api("agent_ping_checkin", self.machine_req())
+        self.assertEqual(check_password.call_count, 1)
+        self.assertEqual(turku_api.cache.secret_cache.hits, 1)
+
+    def test_wrong_secret(self):
+        """Test a cached login does not allow a different secret"""
+        self.api("agent_ping_checkin", self.machine_req())
+        response = self.client.post(
+            "/v1/agent_ping_checkin", json.dumps(self.machine_req(secret="wrong")), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_invalidated_on_change(self):
+        """Test changing the secret hash or active status invalidates the cache"""
+        self.api("agent_ping_checkin", self.machine_req())
+        self.machine.active = False
+        self.machine.save()
+        self.assertEqual(len(turku_api.cache.secret_cache), 0)
+
+
+class TestSessionTokens(APITestCase):
+    def token_req(self, token):
+        return {"machine": {"uuid": str(self.machine.uuid), "token": token}}
+
+    def post(self, view_name, data):
+        return self.client.post("/v1/{}".format(view_name), json.dumps(data), content_type="application/json")
+
+    def test_disabled(self):
+        self.assertEqual(self.post("session_token", self.machine_req()).status_code, 404)
+
+    def test_token(self):
+        """Test a token replaces the secret without running the hasher"""
+        with self.settings(TURKU_SESSION_TOKEN_TTL=3600):
+            out = self.api("session_token", self.machine_req())
+            self.assertEqual(out["expires_in"], 3600)
+            turku_api.cache.secret_cache.clear()
+            with mock.patch("turku_api.hashing.hashers.check_password") as check_password:
+                self.api("agent_ping_checkin", self.token_req(out["token"]))
+                self.api("update_config", self.token_req(out["token"]))
+            check_password.assert_not_called()
+
+            storage_token = self.api("session_token", self.storage_req())["token"]
+            self.api(
+                "storage_ping_checkin",
+                {"storage": {"name": self.storage.name, "token": storage_token}, "machine": {"uuid": str(self.machine.uuid)}},
+            )
+            # Tokens are bound to the kind of login
+            self.assertEqual(self.post("agent_ping_checkin", self.token_req(storage_token)).status_code, 403)
+            # A token can't be exchanged for another
+            self.assertEqual(self.post("session_token", self.token_req(out["token"])).status_code, 403)
+
+    def test_revoked(self):
+        """Test tokens stop working on expiry, deactivation or a secret change"""
+        with self.settings(TURKU_SESSION_TOKEN_TTL=3600):
+            token = self.api("session_token", self.machine_req())["token"]
+            with mock.patch("time.time", return_value=time.time() + 3601):
+                self.assertEqual(self.post("agent_ping_checkin", self.token_req(token)).status_code, 403)
+            self.assertEqual(
+                self.post("agent_ping_checkin", self.token_req(token[:-1] + ("y" if token.endswith("x") else "x"))).status_code, 403
+            )
+
+            self.machine.secret_hash = hashers.make_password("new-secret")
+            self.machine.save()
+            self.assertEqual(self.post("agent_ping_checkin", self.token_req(token)).status_code, 403)
+
+            self.machine_secret = "new-secret"
+            token = self.api("session_token", self.machine_req())["token"]
+            self.api("agent_ping_checkin", self.token_req(token))
+            self.machine.active = False
+            self.machine.save()
+            self.assertEqual(self.post("agent_ping_checkin", self.token_req(token)).status_code, 403)
+        with self.settings(TURKU_SESSION_TOKEN_TTL=0):
+            self.machine.active = True
+            self.machine.save()
+            self.assertEqual(self.post("agent_ping_checkin", self.token_req(token)).status_code, 403)
+
+
+class TestTTLCache(TestCase):
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted"""
+        cache = turku_api.cache.TTLCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+
+    def test_expiry(self):
+        """Test entries expire after their TTL"""
+        cache = turku_api.cache.TTLCache(ttl=10)
+        with mock.patch("turku_api.cache.time.monotonic", return_value=100):
+            cache.set("a", 1)
+        with mock.patch("turku_api.cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+
+
+class TestSourceResponses(APITestCase):
+    def add_sources(self, count):
+        FilterSet.objects.get_or_create(name="common", defaults={"filters": ["merge nested", "- *.tmp"]})
+        FilterSet.objects.get_or_create(name="nested", defaults={"filters": ["- .cache", "merge common"]})
+        for i in range(Source.objects.count(), count):
+            Source.objects.create(
+                name="source{}".format(i),
+                machine=self.machine,
+                path="/srv/{}".format(i),
+                filter=["merge common", "+ /srv"],
+                date_next_backup=timezone.localtime() - timedelta(minutes=1),
+            )
+
+    def test_filters(self):
+        """Test nested FilterSets are expanded"""
+        self.add_sources(1)
+        out = self.api("agent_ping_restore", self.machine_req())
+        self.assertEqual(out["machine"]["sources"]["source0"]["filter"], ["- .cache", "- *.tmp", "+ /srv"])
+        self.assertEqual(out["machine"]["sources"]["source0"]["storage"]["ssh_ping_host_keys"], ["ssh-ed25519 AAAA"])
+
+    def test_query_count(self):
+        """Test the number of queries does not grow with the number of sources"""
+        for view_name in ("agent_ping_checkin", "agent_ping_restore"):
+            self.add_sources(1)
+            self.api(view_name, self.machine_req())
+            with CaptureQueriesContext(connection) as one_source:
+                self.api(view_name, self.machine_req())
+            self.add_sources(20)
+            with CaptureQueriesContext(connection) as many_sources:
+                out = self.api(view_name, self.machine_req())
+            self.assertEqual(len(out["machine"]["scheduled_sources" if view_name == "agent_ping_checkin" else "sources"]), 20)
+            self.assertEqual(len(one_source), len(many_sources))
+
+    def test_filter_cache(self):
+        """Test expansions are cached and invalidated by FilterSet changes"""
+        self.add_sources(1)
+        FilterSet.objects.create(name="unrelated", filters=["- /tmp"])
+        turku_api.views.compile_filters([["merge common"], ["merge unrelated"]])
+        with self.assertNumQueries(0):
+            turku_api.views.compile_filters([["merge common"], ["merge unrelated"]])
+
+        nested = FilterSet.objects.get(name="nested")
+        nested.filters = ["- .local"]
+        nested.save()
+        self.assertIsNone(turku_api.cache.filter_cache.get(("merge common",)))
+        self.assertEqual(turku_api.cache.filter_cache.get(("merge unrelated",)), ["- /tmp"])
+        self.assertEqual(turku_api.views.compile_filters([["merge common"]])[("merge common",)], ["- .local", "- *.tmp"])
+
+    def test_filter_cache_missing_set(self):
+        """Test creating a previously missing FilterSet invalidates expansions"""
+        self.assertEqual(turku_api.views.compile_filters([["merge later"]])[("merge later",)], [])
+        FilterSet.objects.create(name="later", filters=["- /tmp"])
+        self.assertEqual(turku_api.views.compile_filters([["merge later"]])[("merge later",)], ["- /tmp"])
+
+
+class TestStoragePingSourceUpdate(APITestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("source1", "source2"):
+            Source.objects.create(name=name, machine=self.machine, path="/srv/{}".format(name), success=False)
+
+    def test_batch(self):
+        """Test a batch of source updates is applied with per-source errors"""
+        machine = {
+            "uuid": str(self.machine.uuid),
+            "sources": {
+                "source1": {"success": True, "snapshot": "snap1", "time_begin": 1700000000, "time_end": 1700000060},
+                "source2": {"success": False, "time_begin": "invalid"},
+                "missing": {"success": True},
+            },
+        }
+        out = self.api("storage_ping_source_update", self.storage_req(machine))
+        self.assertEqual(set(out["errors"]), {"source2", "missing"})
+        source1 = Source.objects.get(name="source1")
+        self.assertTrue(source1.success)
+        self.assertGreater(source1.date_next_backup, timezone.now())
+        self.assertEqual(BackupLog.objects.get().snapshot, "snap1")
+        self.assertEqual(BackupLog.objects.get().date_end - BackupLog.objects.get().date_begin, timedelta(seconds=60))
+
+    def test_not_found(self):
+        """Test a request with no valid sources fails as a whole"""
+        machine = {"uuid": str(self.machine.uuid), "sources": {"missing": {"success": True}}}
+        response = self.client.post(
+            "/v1/storage_ping_source_update", json.dumps(self.storage_req(machine)), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class TestStoragePingCheckinBatch(APITestCase):
+    def test_batch(self):
+        """Test many machines check in with one auth and a fixed number of queries"""
+        machines = [self.machine]
+        for i in range(1, 5):
+            machine = Machine.objects.create(
+                uuid=uuid.UUID(int=random.Random(i).getrandbits(128), version=4),
+                secret_hash="!",
+                unit_name="machine{}".format(i + 1),
+                ssh_public_key="ssh-ed25519 BBBB",
+                auth=self.machine_auth,
+                storage=self.storage,
+            )
+            machines.append(machine)
+            Source.objects.create(
+                name="source1", machine=machine, path="/srv", date_next_backup=timezone.now() - timedelta(minutes=1)
+            )
+        Source.objects.create(name="later", machine=self.machine, path="/srv", date_next_backup=timezone.now() + timedelta(days=1))
+        missing = "c7d3e3b4-7a4b-4c2e-9e1f-2b6f0d9a8c11"
+
+        req = self.storage_req()
+        req["machines"] = [str(machine.uuid) for machine in machines] + [missing]
+        with self.settings(TURKU_HEARTBEAT_INTERVAL=0), CaptureQueriesContext(connection) as queries:
+            out = self.api("storage_ping_checkin_batch", req)
+        # Storage login, machines, sources, and the check-in update
+        self.assertEqual(len(queries), 4)
+        self.assertEqual(out["machines_not_found"], [missing])
+        self.assertEqual(out["machines"][str(self.machine.uuid)]["scheduled_sources"], {})
+        self.assertEqual(out["machines"][str(machines[1].uuid)]["unit_name"], "machine2")
+        self.assertEqual(list(out["machines"][str(machines[1].uuid)]["scheduled_sources"]), ["source1"])
+        self.assertEqual(Machine.objects.filter(date_checked_in__isnull=False).count(), 5)
+
+    def test_invalid(self):
+        for machines in (None, "x", ["not-a-uuid"], [1]):
+            req = self.storage_req()
+            req["machines"] = machines
+            response = self.client.post("/v1/storage_ping_checkin_batch", json.dumps(req), content_type="application/json")
+            self.assertEqual(response.status_code, 400, machines)
+
+
+class TestUpdateConfig(APITestCase):
+    def test_reconcile_sources(self):
+        """Test sources are added, modified and unpublished"""
+        Source.objects.create(name="keep", machine=self.machine, path="/srv/keep")
+        Source.objects.create(name="modify", machine=self.machine, path="/srv/modify")
+        Source.objects.create(name="remove", machine=self.machine, path="/srv/remove")
+        sources = {
+            "keep": {"path": "/srv/keep"},
+            "modify": {"path": "/srv/modified", "frequency": "hourly", "filter": ["- *.tmp"]},
+            "new": {"path": "/srv/new"},
+        }
+        self.api("update_config", self.machine_req(unit_name="machine1", sources=sources))
+        self.assertEqual(
+            dict(Source.objects.values_list("name", "published")), {"keep": True, "modify": True, "remove": False, "new": True}
+        )
+        modify = Source.objects.get(name="modify")
+        self.assertEqual((modify.path, modify.filter), ("/srv/modified", ["- *.tmp"]))
+        self.assertLessEqual(modify.date_next_backup, timezone.now() + timedelta(hours=2))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.api("update_config", self.machine_req(unit_name="machine1", sources=sources))
+        self.assertFalse([q for q in queries if q["sql"].startswith(("UPDATE", "INSERT")) and "turku_api_source" in q["sql"]])
+
+    def test_validation_error(self):
+        """Test a validation error leaves all sources untouched"""
+        sources = {"good": {"path": "/srv/good"}, "bad": {"path": "/srv/bad", "snapshot_mode": "invalid"}}
+        response = self.client.post(
+            "/v1/update_config", json.dumps(self.machine_req(sources=sources)), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Source.objects.exists())
+
+    def test_config_hash(self):
+        """Test an unchanged config only records the check-in"""
+        sources = {"source1": {"path": "/srv/source1"}}
+        config_hash = self.api("update_config", self.machine_req(unit_name="machine1", sources=sources))["config_hash"]
+        with self.assertNumQueries(1):
+            out = self.api("update_config", self.machine_req(unit_name="machine1", sources=sources))
+        self.assertEqual(out["config_hash"], config_hash)
+        self.assertEqual(self.api("update_config", self.machine_req(config_hash=config_hash))["config_hash"], config_hash)
+
+        # Changes made outside update_config invalidate the hash
+        source = Source.objects.get(name="source1")
+        source.path = "/srv/changed"
+        source.save()
+        response = self.client.post(
+            "/v1/update_config", json.dumps(self.machine_req(config_hash=config_hash)), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 409)
+        self.api("update_config", self.machine_req(unit_name="machine1", sources=sources))
+        self.assertEqual(Source.objects.get(name="source1").path, "/srv/source1")
+
+
+class TestHeartbeats(APITestCase):
+    def test_write_behind(self):
+        """Test check-ins are buffered, read through, and flushed in one query"""
+        self.machine.date_registered = timezone.now() - timedelta(days=1)
+        self.machine.save()
+        self.assertFalse(self.machine.healthy())
+        with self.settings(TURKU_HEARTBEAT_INTERVAL=3600):
+            self.api("agent_ping_checkin", self.machine_req())
+            machine = Machine.objects.get(pk=self.machine.pk)
+            self.assertIsNone(machine.date_checked_in)
+            self.assertTrue(machine.healthy())
+            with self.assertNumQueries(1):
+                heartbeats.flush()
+        self.assertIsNotNone(Machine.objects.get(pk=self.machine.pk).date_checked_in)
+
+    def test_write_through(self):
+        """Test an interval of 0 writes check-ins immediately"""
+        with self.settings(TURKU_HEARTBEAT_INTERVAL=0):
+            self.api("agent_ping_checkin", self.machine_req())
+        self.assertIsNotNone(Machine.objects.get(pk=self.machine.pk).date_checked_in)
+
+
+class TestPlacement(APITestCase):
+    def add_storage(self, name, space_available, **kwargs):
+        return Storage.objects.create(
+            name=name,
+            secret_hash=hashers.make_password(self.storage_secret),
+            ssh_ping_host="{}.example.com".format(name),
+            ssh_ping_port=22,
+            ssh_ping_user="turku",
+            space_available=space_available,
+            auth=self.storage_auth,
+            **kwargs,
+        )
+
+    def test_table(self):
+        """Test picks follow the cumulative weights and assignments update them"""
+        storage2 = self.add_storage("storage2", 3000)
+        table = PlacementTable([(self.storage, 1000, 0, True), (storage2, 3000, 0, True)])
+        self.assertEqual(table.cumulative, [1000.0, 4000.0])
+        self.assertEqual(table.choose(lambda: 0.2), self.storage)
+        self.assertEqual(table.choose(lambda: 0.3), storage2)
+        table.add_load(storage2, 2)
+        self.assertEqual(table.cumulative, [1000.0, 2000.0])
+        self.assertEqual(table.shares(), [0.5, 0.5])
+
+    def test_new_machine(self):
+        """Test new machines avoid full and unhealthy storages"""
+        self.add_storage("storage2", 1000)
+        self.add_storage("storage3", 5000, date_registered=timezone.now() - timedelta(days=1))
+        for i in range(5):
+            # Seeded, as an occasional random UUID fails the entropy check
+            machine_uuid = str(uuid.UUID(int=random.Random(i).getrandbits(128), version=4))
+            req = {
+                "auth": {"name": self.machine_auth.name, "secret": "machine-reg"},
+                "machine": {"uuid": machine_uuid, "secret": "secret", "unit_name": "new", "ssh_public_key": "ssh-ed25519 CCCC"},
+            }
+            self.api("update_config", req)
+            self.assertEqual(Machine.objects.get(uuid=machine_uuid).storage.name, "storage2")
+
+
+class TestStorageMachineList(APITestCase):
+    def test_incremental(self):
+        """Test machine lists are sent in full, then as changes since the token"""
+        out = self.api("storage_update_config", self.storage_req())
+        self.assertTrue(out["machines_full"])
+        self.assertEqual(list(out["machines"]), [str(self.machine.uuid)])
+        token = out["machines_token"]
+
+        out = self.api("storage_update_config", self.storage_req(machines_token=token))
+        self.assertEqual((out["machines"], out["machines_removed"], out["machines_full"]), ({}, [], False))
+
+        self.machine.ssh_public_key = "ssh-ed25519 CCCC"
+        self.machine.save()
+        out = self.api("storage_update_config", self.storage_req(machines_token=token))
+        self.assertEqual(out["machines"][str(self.machine.uuid)]["ssh_public_key"], "ssh-ed25519 CCCC")
+        token = out["machines_token"]
+
+        self.machine.active = False
+        self.machine.save(update_fields=["active"])
+        out = self.api("storage_update_config", self.storage_req(machines_token=token))
+        self.assertEqual((out["machines"], out["machines_removed"]), ({}, [str(self.machine.uuid)]))
+
+        # Heartbeats don't change the generation
+        heartbeats.record_many(Machine, [self.machine.pk], timezone.now())
+        heartbeats.flush()
+        self.assertEqual(self.api("storage_update_config", self.storage_req(machines_token=out["machines_token"]))["machines"], {})
+
+    def test_resync(self):
+        """Test deleted machines and unknown tokens force a full list"""
+        token = self.api("storage_update_config", self.storage_req())["machines_token"]
+        self.machine.delete()
+        out = self.api("storage_update_config", self.storage_req(machines_token=token))
+        self.assertEqual((out["machines"], out["machines_full"]), ({}, True))
+        self.assertTrue(self.api("storage_update_config", self.storage_req(machines_token="invalid"))["machines_full"])
+        self.assertTrue(self.api("storage_update_config", self.storage_req(machines_token="1000"))["machines_full"])
+
+    def test_storage_save_keeps_generation(self):
+        """Test saving a stale Storage doesn't roll back its generation"""
+        storage = Storage.objects.get(pk=self.storage.pk)
+        self.machine.unit_name = "renamed"
+        self.machine.save()
+        storage.comment = "comment"
+        storage.save()
+        self.assertEqual(Storage.objects.get(pk=self.storage.pk).machines_generation, self.machine.storage_generation)
+
+
+class TestETags(APITestCase):
+    def test_restore(self):
+        """Test agent_ping_restore is not rebuilt while its sources are unchanged"""
+        source = Source.objects.create(name="source1", machine=self.machine, path="/srv/source1")
+        etag = self.api("agent_ping_restore", self.machine_req())["etag"]
+        with mock.patch.object(turku_api.views.SourceResponseBuilder, "build") as build:
+            out = self.api("agent_ping_restore", dict(self.machine_req(), if_none_match=etag))
+        self.assertEqual(out, {"not_modified": True, "etag": etag})
+        build.assert_not_called()
+
+        source.retention = "last 1 day"
+        source.save()
+        out = self.api("agent_ping_restore", dict(self.machine_req(), if_none_match=etag))
+        self.assertEqual(out["machine"]["sources"]["source1"]["retention"], "last 1 day")
+        self.assertNotEqual(out["etag"], etag)
+
+        etag = out["etag"]
+        FilterSet.objects.create(name="new", filters=[])
+        self.assertNotEqual(self.api("agent_ping_restore", dict(self.machine_req(), if_none_match=etag))["etag"], etag)
+
+    def test_restore_stale_filter_cache(self):
+        """Test a FilterSet changed in another process is served with its new ETag"""
+        FilterSet.objects.create(name="common", filters=["- /a"])
+        Source.objects.create(name="source1", machine=self.machine, path="/srv", filter=["merge common"])
+        etag = self.api("agent_ping_restore", self.machine_req())["etag"]
+        self.assertEqual(
+            self.api("agent_ping_checkin", dict(self.machine_req()))["machine"]["scheduled_sources"]["source1"]["filter"], ["- /a"]
+        )
+
+        # A queryset update sends no signals, as for an edit made by
+        # another worker process
+        FilterSet.objects.filter(name="common").update(filters=["- /b"], date_updated=timezone.now() + timedelta(seconds=1))
+        out = self.api("agent_ping_restore", dict(self.machine_req(), if_none_match=etag))
+        self.assertNotEqual(out["etag"], etag)
+        self.assertEqual(out["machine"]["sources"]["source1"]["filter"], ["- /b"])
+        self.assertTrue(self.api("agent_ping_restore", dict(self.machine_req(), if_none_match=out["etag"]))["not_modified"])
+
+    def test_storage_update_config(self):
+        """Test storage_update_config honors if_none_match until a machine changes"""
+        etag = self.api("storage_update_config", self.storage_req())["etag"]
+        self.assertTrue(self.api("storage_update_config", dict(self.storage_req(), if_none_match=etag))["not_modified"])
+        self.machine.unit_name = "renamed"
+        self.machine.save()
+        out = self.api("storage_update_config", dict(self.storage_req(), if_none_match=etag))
+        self.assertEqual(out["machines"][str(self.machine.uuid)]["unit_name"], "renamed")
+
+
+class TestRequestLimits(APITestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+
+    def test_content_length(self):
+        """Test oversized requests are refused and counted"""
+        body = json.dumps(self.machine_req(comment="x" * 2000))
+        with self.settings(TURKU_MAX_REQUEST_SIZE=1024):
+            response = self.client.post("/v1/agent_ping_restore", body, content_type="application/json")
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(metrics.get("turku_request_rejected_bytes_total", reason="too_large"), len(body))
+
+    def test_bounded_read(self):
+        """Test the body is not read past the limit without a Content-Length"""
+        request = mock.Mock()
+        request.read.side_effect = [b"x" * 100] * 5 + [b""]
+        self.assertIsNone(turku_api.views.read_request_body(request, 250, chunk_size=100))
+        self.assertEqual(request.read.call_count, 3)
+
+    def test_schema(self):
+        """Test malformed requests are refused before reaching the view"""
+        for req in ([], {"machine": []}, {"machine": {"sources": []}}):
+            response = self.client.post("/v1/update_config", json.dumps(req), content_type="application/json")
+            self.assertEqual(response.status_code, 400, req)
+        with self.settings(TURKU_MAX_REQUEST_SOURCES=1):
+            response = self.client.post(
+                "/v1/update_config", json.dumps(self.machine_req(sources={"a": {}, "b": {}})), content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(metrics.get("turku_requests_rejected_total", reason="invalid"), 4)
+
+
+class TestLongPoll(APITestCase):
+    @override_settings(TURKU_LONGPOLL_MAX_WAITERS=10)
+    def test_wakes_when_due(self):
+        """Test a long-poll returns once a source comes due"""
+        Source.objects.create(
+            name="source1", machine=self.machine, path="/srv", date_next_backup=timezone.now() + timedelta(seconds=1)
+        )
+        start = time.monotonic()
+        out = self.api("agent_ping_checkin", self.machine_req(wait=30))
+        self.assertEqual(list(out["machine"]["scheduled_sources"]), ["source1"])
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_timeout(self):
+        """Test a long-poll ends empty at its timeout, or at once when the registry is full"""
+        Source.objects.create(
+            name="source1", machine=self.machine, path="/srv", date_next_backup=timezone.now() + timedelta(days=1)
+        )
+        with self.settings(TURKU_LONGPOLL_MAX_WAITERS=10):
+            self.assertEqual(self.api("agent_ping_checkin", self.machine_req(wait=0.1))["machine"]["scheduled_sources"], {})
+        with self.settings(TURKU_LONGPOLL_MAX_WAITERS=1), mock.patch.object(waits, "_count", 1):
+            with mock.patch("threading.Event.wait") as event_wait:
+                out = self.api("agent_ping_checkin", self.machine_req(wait=30))
+        self.assertEqual(out["machine"]["scheduled_sources"], {})
+        event_wait.assert_not_called()
+
+    def test_disabled_by_default(self):
+        """Test blocking long-polls are opt-in, so they can't hold the only worker thread"""
+        Source.objects.create(
+            name="source1", machine=self.machine, path="/srv", date_next_backup=timezone.now() + timedelta(days=1)
+        )
+        with mock.patch.object(waits, "wait") as wait:
+            self.assertEqual(self.api("agent_ping_checkin", self.machine_req(wait=300))["machine"]["scheduled_sources"], {})
+        wait.assert_not_called()
+
+    @override_settings(TURKU_LONGPOLL_MAX_WAITERS=10)
+    def test_invalid_wait(self):
+        """Test non-finite waits are refused and negative waits end at once"""
+        for wait in ("nan", "inf", "-inf"):
+            response = self.client.post(
+                "/v1/agent_ping_checkin", json.dumps(self.machine_req(wait=wait)), content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 400)
+        with mock.patch.object(waits, "wait") as wait:
+            self.assertEqual(self.api("agent_ping_checkin", self.machine_req(wait=-5))["machine"]["scheduled_sources"], {})
+        wait.assert_not_called()
+
+    @override_settings(TURKU_LONGPOLL_MAX_WAITERS=10)
+    def test_notify(self):
+        """Test waiters are woken by notifications for their key only"""
+        registry = WaitRegistry()
+        results = {}
+        threads = [threading.Thread(target=lambda key=key: results.update({key: registry.wait(key, 5)})) for key in ("a", "b")]
+        for thread in threads:
+            thread.start()
+        while len(registry) < 2:
+            time.sleep(0.01)
+        registry.notify("a")
+        threads[0].join()
+        self.assertEqual(results, {"a": True})
+        registry.notify("b")
+        threads[1].join()
+        self.assertEqual(len(registry), 0)
+
+
+class TestRequestMetrics(APITestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+
+    def test_request(self):
+        """Test latency, DB, hashing and response size are recorded per endpoint"""
+        response = self.client.post("/v1/agent_ping_checkin", json.dumps(self.machine_req()), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.client.post(
+            "/v1/agent_ping_checkin",
+            json.dumps({"machine": {"uuid": str(self.machine.uuid), "secret": "x"}}),
+            content_type="application/json",
+        )
+
+        endpoint = "agent_ping_checkin"
+        self.assertEqual(metrics.get_histogram("turku_request_duration_seconds", endpoint=endpoint).count, 2)
+        self.assertEqual(metrics.get("turku_requests_total", endpoint=endpoint, status=200), 1)
+        self.assertEqual(metrics.get("turku_requests_total", endpoint=endpoint, status=403), 1)
+        self.assertGreater(metrics.get("turku_request_db_queries_total", endpoint=endpoint), 0)
+        self.assertGreater(metrics.get("turku_request_hash_seconds_total", endpoint=endpoint), 0)
+        self.assertGreaterEqual(metrics.get("turku_response_bytes_total", endpoint=endpoint), len(response.content))
+
+    def test_prometheus_text(self):
+        m = Metrics()
+        m.incr("requests_total", endpoint="a")
+        for value in (0.003, 0.2, 1000):
+            m.observe("duration_seconds", value, buckets=(0.01, 1), endpoint="a")
+        self.assertEqual(
+            m.prometheus_text(),
+            "# TYPE requests_total counter\n"
+            'requests_total{endpoint="a"} 1\n'
+            "# TYPE duration_seconds histogram\n"
+            'duration_seconds_bucket{endpoint="a",le="0.01"} 1\n'
+            'duration_seconds_bucket{endpoint="a",le="1"} 2\n'
+            'duration_seconds_bucket{endpoint="a",le="+Inf"} 3\n'
+            'duration_seconds_sum{endpoint="a"} 1000.203\n'
+            'duration_seconds_count{endpoint="a"} 3\n',
+        )
+        response = turku_api.views.prometheus_metrics(RequestFactory().get("/metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+    def test_slow_request_profile(self):
+        """Test sampled requests over the threshold are written as pstats"""
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with self.settings(TURKU_PROFILE_SAMPLE_RATE=1, TURKU_PROFILE_THRESHOLD=0, TURKU_PROFILE_DIR=profile_dir):
+                self.api("health", {})
+            files = os.listdir(profile_dir)
+            self.assertEqual(len(files), 1)
+            self.assertIn("health", files[0])
+            pstats.Stats(os.path.join(profile_dir, files[0]))
+            with self.settings(TURKU_PROFILE_SAMPLE_RATE=1, TURKU_PROFILE_THRESHOLD=60, TURKU_PROFILE_DIR=profile_dir):
+                self.api("health", {})
+            self.assertEqual(len(os.listdir(profile_dir)), 1)
+        self.assertEqual(metrics.get("turku_slow_request_profiles_total", endpoint="health"), 1)
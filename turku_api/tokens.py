@@ -0,0 +1,51 @@
+# SPDX-PackageName: turku-api
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/turku-api
+# SPDX-FileCopyrightText: © 2015 Canonical Ltd.
+# SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import hashlib
+
+from django.conf import settings
+from django.core import signing
+from django.utils.crypto import constant_time_compare
+
+SALT = "turku_api.tokens"
+
+
+def ttl():
+    """Token lifetime in seconds; 0 disables tokens"""
+    return getattr(settings, "TURKU_SESSION_TOKEN_TTL", 0)
+
+
+def secret_version(secret_hash):
+    return hashlib.sha256(secret_hash.encode("utf-8")).hexdigest()[:32]
+
+
+def issue(kind, obj):
+    """Issue a session token for a Machine or Storage
+
+    The token is a timestamped HMAC signature (keyed on SECRET_KEY) over
+    the login kind, object ID and a digest of the object's current
+    secret_hash, and nothing is stored server-side.  The object is still
+    loaded on each login, so the token stops working as soon as it is
+    deactivated or its secret (or secret hash) changes.
+    """
+    return signing.dumps([kind, str(obj.pk), secret_version(obj.secret_hash)], salt=SALT, compress=False)
+
+
+def verify(token, kind, obj):
+    """Return whether a token was issued for this object and is still valid"""
+    max_age = ttl()
+    if not max_age or not isinstance(token, str):
+        return False
+    try:
+        token_kind, pk, version = signing.loads(token, salt=SALT, max_age=max_age)
+    except (signing.BadSignature, TypeError, ValueError):
+        return False
+    return (
+        token_kind == kind
+        and constant_time_compare(pk, str(obj.pk))
+        and constant_time_compare(version, secret_version(obj.secret_hash))
+    )
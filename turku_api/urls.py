@@ -5,6 +5,7 @@
 # SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+from django.conf import settings
 from django.contrib import admin
 from django.views.generic.base import RedirectView
 
@@ -20,14 +21,22 @@ except ImportError:
 
 from turku_api import views
 
+if getattr(settings, "TURKU_ASYNC_API", False):
+    from turku_api import async_views as api_views
+else:
+    api_views = views
+
 admin.autodiscover()
 
 urlpatterns = [
     re_path(r"^$", RedirectView.as_view(url=reverse_lazy("admin:index"))),
     re_path(r"^admin/", admin.site.urls),
-    re_path(r"^v1/", views.urls),
+    re_path(r"^v1/", api_views.urls),
 ]
 
+if getattr(settings, "TURKU_METRICS_ENDPOINT", False):
+    urlpatterns.append(re_path(r"^metrics$", views.prometheus_metrics))
+
 try:
     from local_urls import *  # noqa: F401,F403
 except ImportError:
@@ -5,21 +5,17 @@
 # SPDX-FileCopyrightText: © 2015 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import binascii
-from datetime import datetime, timedelta
-import json
-import random
+import collections
+from datetime import datetime
+import hashlib
+import math
+import time
 import uuid
 
-try:
-    import croniter
-except ImportError as e:
-    # We only want to raise this import error if cron format is
-    # attempted by the client
-    croniter = e
-
-from django.contrib.auth import hashers
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Min
 from django.http import (
     HttpResponse,
     HttpResponseBadRequest,
@@ -39,135 +35,269 @@ except ImportError:
         return _legacy_url(r"^{}$".format(route), view, **kwargs)
 
 
+from turku_api import hashing, tokens
+from turku_api.cache import filter_cache, secret_cache
+from turku_api.heartbeat import heartbeats
+from turku_api.longpoll import waits
+from turku_api.metrics import metrics
 from turku_api.models import Auth, BackupLog, FilterSet, Machine, Source, Storage
+from turku_api.placement import placement
+from turku_api.profiling import instrument
+from turku_api.schedule import frequency_next_scheduled, hashedint, storage_slot_histogram  # noqa: F401
+from turku_api.serialization import canonical_dumps, json_response, loads
+
+
+def machine_config_hash(req_machine):
+    """Return a canonical hash of a Machine's requested config"""
+    config = {k: v for k, v in req_machine.items() if k not in ("secret", "token", "config_hash")}
+    return hashlib.sha256(canonical_dumps(config).encode("UTF-8")).hexdigest()
+
+
+def response_etag(*markers):
+    """Return an ETag for a response, given version markers of its contents"""
+    return hashlib.sha256(canonical_dumps(markers, default=str).encode("UTF-8")).hexdigest()[0:32]
+
 
+def longpoll_timeout(remaining, next_backup):
+    """Return how long a long-poll should wait before re-checking sources"""
+    timeout = min(remaining, getattr(settings, "TURKU_LONGPOLL_RECHECK", 30))
+    if next_backup is not None:
+        timeout = min(timeout, max((next_backup - timezone.now()).total_seconds(), 0))
+    return timeout
 
-def hashedint(a, b, hash_id=""):
-    """ID-hashed drop-in replacement for random.randint"""
 
-    if isinstance(hash_id, bytes):
-        id_bytes = hash_id
-    elif isinstance(hash_id, str):
-        id_bytes = hash_id.encode("UTF-8")
-    else:
-        raise TypeError("id must be bytes or UTF-8 string")
+def hash_setter(obj, password):
+    obj.secret_hash = hashing.make_password(password)
+    obj.save(update_fields=["secret_hash"])
 
-    crc = binascii.crc32(id_bytes) & 0xFFFFFFFF
-    return (crc % (b - a + 1)) + a
 
+def check_secret(kind, ident, secret, obj):
+    """Check a Machine/Storage secret, skipping the hasher if recently verified"""
+    if secret_cache.check(kind, ident, secret, obj.secret_hash):
+        return True
+    if not hashing.check_password(secret, obj.secret_hash, setter=lambda password: hash_setter(obj, password)):
+        return False
+    # Cache against the current hash, which may have been upgraded by the setter
+    secret_cache.add(kind, ident, secret, obj.secret_hash)
+    return True
+
+
+SOURCE_CONFIG_FIELDS = (
+    "path",
+    "frequency",
+    "retention",
+    "comment",
+    "shared_service",
+    "large_rotating_files",
+    "large_modifying_files",
+    "bwlimit",
+    "snapshot_mode",
+    "preserve_hard_links",
+    "filter",
+    "exclude",
+)
 
-def frequency_next_scheduled(frequency, source_id, base_time=None):
-    """Return the next scheduled datetime, given a frequency definition
+FILTER_VERBS = (
+    "dir-merge",
+    ":",
+    "clear",
+    "!",
+    "exclude",
+    "-",
+    "include",
+    "+",
+    "hide",
+    "H",
+    "show",
+    "S",
+    "protect",
+    "P",
+    "risk",
+    "R",
+)
+
+
+def filter_merge_names(rules):
+    """Return the FilterSet names referenced by merge rules"""
+    names = set()
+    for f in rules:
+        try:
+            verb, subsetname = f.split(" ", 1)
+        except ValueError:
+            continue
+        if verb in ("merge", "."):
+            names.add(subsetname)
+    return names
 
-    Examples of English definitions:
-        "hourly", "daily", "weekly", "sunday", "monday", "tuesday",
-        "wednesday", "thursday", "friday", "saturday"
-    Within a specific time range: "daily, 0800-1600"
-    These definitions will return a randomly-hashed time within the
-    definition each time.
 
-    If croniter is installed, "cron" plus a cron definition can be used:
-        "cron 42 8 * * *"
-    Or a Jenkins-style hashed cron definition, consistently hashed
-    against the source ID:
-        "cron H H(8-16) * * *"
-    Or randomized:
-        "cron R R(8-16) * * *"
+def load_filter_sets(rule_lists):
+    """Load all FilterSets needed to expand the given filter rule lists
+
+    FilterSets are fetched one nesting level at a time, so the number
+    of queries depends on the depth of the FilterSet graph, not on the
+    number of sources.  Returns a dict of name to decoded rules.
+    """
+    filter_sets = {}
+    wanted = set()
+    for rules in rule_lists:
+        wanted |= filter_merge_names(rules)
+    seen = set()
+    while wanted:
+        seen |= wanted
+        next_wanted = set()
+        for fs in FilterSet.objects.filter(name__in=wanted, active=True):
+            filter_sets[fs.name] = fs.filters
+            next_wanted |= filter_merge_names(filter_sets[fs.name])
+        wanted = next_wanted - seen
+    return filter_sets
+
+
+def build_filters(rules, filter_sets, loaded_sets=None):
+    """Expand merge rules in a filter list using preloaded FilterSets"""
+    if loaded_sets is None:
+        loaded_sets = set()
+    out = []
+    for f in rules:
+        try:
+            verb, subsetname = f.split(" ", 1)
+        except ValueError:
+            continue
+        if verb in ("merge", "."):
+            if subsetname in loaded_sets or subsetname not in filter_sets:
+                continue
+            loaded_sets.add(subsetname)
+            out.extend(build_filters(filter_sets[subsetname], filter_sets, loaded_sets))
+        elif verb in FILTER_VERBS:
+            out.append(f)
+    return out
+
+
+def filter_dependencies(rules, filter_sets):
+    """Return all FilterSet names an expansion of rules may depend on"""
+    names = set()
+    pending = filter_merge_names(rules)
+    while pending:
+        name = pending.pop()
+        if name in names:
+            continue
+        names.add(name)
+        if name in filter_sets:
+            pending |= filter_merge_names(filter_sets[name])
+    return names
+
+
+def compile_filters(rule_lists, use_cache=True):
+    """Return expanded filter lists for Source filter rule lists
+
+    The result is keyed on each rule list as a tuple.  Expansions are
+    served from the process-wide filter cache where possible; the
+    remaining FilterSets are loaded in bulk.  With use_cache False,
+    every expansion is built from freshly loaded FilterSets (and the
+    cache is refreshed with the results).
     """
-    if not base_time:
-        base_time = timezone.localtime()
-    base_time = base_time.astimezone(timezone.get_current_timezone())
-
-    if frequency.startswith("cron"):
-        if isinstance(croniter, ImportError):
-            # croniter is not installed
-            raise croniter
-        cron_schedule = " ".join(frequency.split(" ")[1:])
-        croniter_def = croniter(cron_schedule, start_time=base_time, hash_id=source_id)
-        return croniter_def.get_next(datetime).replace(second=hashedint(0, 59, source_id))
-
-    f = [x.strip() for x in frequency.split(",")]
-
-    if f[0] == "hourly":
-        target_time = base_time.replace(
-            minute=hashedint(0, 59, source_id),
-            second=hashedint(0, 59, source_id),
-            microsecond=0,
-        ) + timedelta(hours=1)
-        return target_time
-
-    today = base_time.replace(hour=0, minute=0, second=0, microsecond=0)
-    if f[0] == "daily":
-        # Tomorrow
-        target_date = today + timedelta(days=1)
-    elif f[0] == "weekly":
-        # Hashed day next week
-        target_day = hashedint(0, 6, source_id)
-        target_date = today + timedelta(weeks=1) - timedelta(days=((today.weekday() + 1) % 7)) + timedelta(days=target_day)
-    elif f[0] in (
-        "sunday",
-        "monday",
-        "tuesday",
-        "wednesday",
-        "thursday",
-        "friday",
-        "saturday",
-    ):
-        # Next Xday
-        day_map = {
-            "sunday": 0,
-            "monday": 1,
-            "tuesday": 2,
-            "wednesday": 3,
-            "thursday": 4,
-            "friday": 5,
-            "saturday": 6,
+    out = {}
+    missing = {}
+    for rules in rule_lists:
+        key = tuple(rules)
+        if key in out or key in missing:
+            continue
+        cached = filter_cache.get(key) if use_cache else None
+        if cached is None:
+            missing[key] = rules
+        else:
+            out[key] = cached
+    if not missing:
+        return out
+
+    generation = filter_cache.generation
+    filter_sets = load_filter_sets(missing.values())
+    for key, rules in missing.items():
+        out[key] = build_filters(rules, filter_sets)
+        filter_cache.set(key, out[key], filter_dependencies(rules, filter_sets), generation)
+    return out
+
+
+class SourceResponseBuilder:
+    """Build source configuration responses for a Storage's machines
+
+    The storage block is built once, and all FilterSets referenced by
+    the sources are expanded from the filter cache or loaded in bulk,
+    so building a response does not issue any per-source queries.
+    """
+
+    def __init__(self, storage):
+        self.storage_out = {
+            "name": storage.name,
+            "ssh_ping_host": storage.ssh_ping_host,
+            "ssh_ping_host_keys": storage.ssh_ping_host_keys,
+            "ssh_ping_port": storage.ssh_ping_port,
+            "ssh_ping_user": storage.ssh_ping_user,
         }
-        target_day = day_map[f[0]]
-        target_date = today - timedelta(days=((today.weekday() + 1) % 7)) + timedelta(days=target_day)
-        if target_date < today:
-            target_date = target_date + timedelta(weeks=1)
-    elif f[0] == "monthly":
-        next_month = (today.replace(day=1) + timedelta(days=40)).replace(day=1)
-        month_after = (next_month.replace(day=1) + timedelta(days=40)).replace(day=1)
-        target_date = next_month + timedelta(days=hashedint(1, (month_after - next_month).days, source_id))
-    else:
-        # Fall back to daily
-        target_date = today + timedelta(days=1)
-
-    if len(f) == 1:
-        return target_date + timedelta(seconds=hashedint(0, 86399, source_id))
-    time_range = f[1].split("-")
-    start = (int(time_range[0][0:2]) * 60 * 60) + (int(time_range[0][2:4]) * 60)
-    if len(time_range) == 1:
-        # Not a range
-        return target_date + timedelta(seconds=start)
-    end = (int(time_range[1][0:2]) * 60 * 60) + (int(time_range[1][2:4]) * 60)
-    if end < start:
-        # Day rollover
-        end = end + 86400
-    return target_date + timedelta(seconds=hashedint(start, end, source_id))
-
-
-def random_weighted(m):
-    """Return a weighted random key."""
-    total = sum(m.values())
-    if total <= 0:
-        return random.choice(list(m.keys()))
-    weighted = []
-    tp = 0
-    for k, v in m.items():
-        tp = tp + (float(v) / float(total))
-        weighted.append((k, tp))
-    r = random.random()
-    for k, v in weighted:
-        if r < v:
-            return k
 
+    def source_out(self, source, filters):
+        return {
+            "path": source.path,
+            "retention": source.retention,
+            "bwlimit": source.bwlimit,
+            "filter": filters[tuple(source.filter)],
+            "exclude": source.exclude,
+            "shared_service": source.shared_service,
+            "large_rotating_files": source.large_rotating_files,
+            "large_modifying_files": source.large_modifying_files,
+            "snapshot_mode": source.snapshot_mode,
+            "preserve_hard_links": source.preserve_hard_links,
+            "storage": self.storage_out,
+        }
 
-def hash_setter(obj, password):
-    obj.secret_hash = hashers.make_password(password)
-    obj.save(update_fields=["secret_hash"])
+    def build(self, sources, use_cache=True):
+        sources = list(sources)
+        filters = compile_filters((source.filter for source in sources), use_cache)
+        return {source.name: self.source_out(source, filters) for source in sources}
+
+    def build_by_machine(self, sources):
+        """Build responses for sources of many machines, keyed on Machine ID"""
+        sources = list(sources)
+        filters = compile_filters(source.filter for source in sources)
+        out = collections.defaultdict(dict)
+        for source in sources:
+            out[source.machine_id][source.name] = self.source_out(source, filters)
+        return out
+
+
+def read_request_body(django_request, max_size, chunk_size=65536):
+    """Read a request body in chunks, stopping once it exceeds max_size
+
+    Returns the body, or None if it is too large.  A max_size of 0
+    disables the limit.
+    """
+    chunks = []
+    size = 0
+    while True:
+        chunk = django_request.read(chunk_size)
+        if not chunk:
+            return b"".join(chunks)
+        size += len(chunk)
+        if max_size and size > max_size:
+            metrics.incr("turku_request_rejected_bytes_total", size, reason="too_large")
+            return None
+        chunks.append(chunk)
+
+
+def validate_request(req):
+    """Check the shape of a decoded API request, returning an error or None"""
+    if not isinstance(req, dict):
+        return "Request must be a JSON object"
+    for k in ("machine", "storage", "auth"):
+        if k in req and not isinstance(req[k], dict):
+            return 'Invalid type for "%s"' % k
+    sources = req.get("machine", {}).get("sources")
+    if sources is not None:
+        if not isinstance(sources, dict):
+            return 'Invalid type for "machine.sources"'
+        max_sources = getattr(settings, "TURKU_MAX_REQUEST_SOURCES", 10000)
+        if max_sources and len(sources) > max_sources:
+            return 'Too many sources in "machine.sources"'
+    return None
 
 
 class HttpResponseException(Exception):
@@ -181,10 +311,12 @@ class HttpResponseException(Exception):
 class ViewV1:
     view_names = (
         "health",
+        "session_token",
         "update_config",
         "agent_ping_checkin",
         "agent_ping_restore",
         "storage_ping_checkin",
+        "storage_ping_checkin_batch",
         "storage_ping_source_update",
         "storage_update_config",
     )
@@ -200,32 +332,72 @@ class ViewV1:
         if not (("CONTENT_TYPE" in self.django_request.META) and (self.django_request.META["CONTENT_TYPE"] == "application/json")):
             raise HttpResponseException(HttpResponseBadRequest("Bad Content-Type (expected application/json)"))
 
+        # Refuse oversized requests before reading them if possible,
+        # and never read more than the limit
+        max_size = getattr(settings, "TURKU_MAX_REQUEST_SIZE", 4 * 1024 * 1024)
+        try:
+            content_length = int(self.django_request.META.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            content_length = 0
+        if max_size and content_length > max_size:
+            metrics.incr("turku_requests_rejected_total", reason="too_large")
+            metrics.incr("turku_request_rejected_bytes_total", content_length, reason="too_large")
+            raise HttpResponseException(HttpResponse("Request body too large", status=413))
+        body = read_request_body(self.django_request, max_size)
+        if body is None:
+            metrics.incr("turku_requests_rejected_total", reason="too_large")
+            raise HttpResponseException(HttpResponse("Request body too large", status=413))
+
         # Load the POSTed JSON
         try:
-            self.req = json.load(self.django_request)
+            self.req = loads(body)
         except ValueError as e:
+            metrics.incr("turku_requests_rejected_total", reason="invalid")
+            metrics.incr("turku_request_rejected_bytes_total", len(body), reason="invalid")
             raise HttpResponseException(HttpResponseBadRequest(str(e)))
+        error = validate_request(self.req)
+        if error is not None:
+            metrics.incr("turku_requests_rejected_total", reason="invalid")
+            metrics.incr("turku_request_rejected_bytes_total", len(body), reason="invalid")
+            raise HttpResponseException(HttpResponseBadRequest(error))
+
+    def check_not_modified(self, etag):
+        """Short-circuit with a "not modified" response if the client already has etag"""
+        if etag is None or self.req.get("if_none_match") != etag:
+            return
+        response = json_response({"not_modified": True, "etag": etag})
+        response["ETag"] = '"{}"'.format(etag)
+        raise HttpResponseException(response)
+
+    def etag_response(self, out, etag):
+        if etag is None:
+            return json_response(out)
+        out["etag"] = etag
+        response = json_response(out)
+        response["ETag"] = '"{}"'.format(etag)
+        return response
+
+    def check_login(self, kind, ident, req_login, obj):
+        """Check a login's secret, or its session token if it sent one instead"""
+        if "secret" in req_login:
+            return check_secret(kind, ident, req_login["secret"], obj)
+        return tokens.verify(req_login["token"], kind, obj)
 
     def storage_login(self, is_update_config=False):
         """Authenticate a Storage login"""
 
         if "storage" not in self.req:
             raise HttpResponseException(HttpResponseBadRequest('Missing required option "storage"'))
-        for k in ("name", "secret"):
-            if k not in self.req["storage"]:
-                raise HttpResponseException(HttpResponseForbidden("Bad auth"))
+        if "name" not in self.req["storage"] or not ({"secret", "token"} & set(self.req["storage"])):
+            raise HttpResponseException(HttpResponseForbidden("Bad auth"))
         try:
             storage = Storage.objects.get(name=self.req["storage"]["name"], active=True)
         except Storage.DoesNotExist:
-            if is_update_config:
+            if is_update_config and "secret" in self.req["storage"]:
                 return
             else:
                 raise HttpResponseException(HttpResponseForbidden("Bad auth"))
-        if not hashers.check_password(
-            self.req["storage"]["secret"],
-            storage.secret_hash,
-            setter=lambda password: hash_setter(storage, password),
-        ):
+        if not self.check_login("storage", storage.name, self.req["storage"], storage):
             raise HttpResponseException(HttpResponseForbidden("Bad auth"))
 
         return storage
@@ -256,15 +428,17 @@ class ViewV1:
             raise HttpResponseException(HttpResponseBadRequest('"machine" dict required'))
 
         # Make sure these exist in the request (validation comes later)
-        for k in ("uuid", "secret"):
-            if k not in self.req["machine"]:
-                raise HttpResponseException(HttpResponseBadRequest('Missing required machine option "%s"' % k))
+        if "uuid" not in self.req["machine"]:
+            raise HttpResponseException(HttpResponseBadRequest('Missing required machine option "uuid"'))
+        if not ({"secret", "token"} & set(self.req["machine"])):
+            raise HttpResponseException(HttpResponseBadRequest('Missing required machine option "secret"'))
 
         # Load the machine
         try:
             machine = Machine.objects.get(uuid=uuid.UUID(self.req["machine"]["uuid"]), active=True)
         except Machine.DoesNotExist:
-            if is_update_config:
+            if is_update_config and "secret" in self.req["machine"]:
+                # Registration requires the secret itself
                 return
             else:
                 # Return Forbidden for nonexistent Machines to avoid
@@ -272,11 +446,7 @@ class ViewV1:
                 raise HttpResponseException(HttpResponseForbidden("Bad auth"))
         if (not is_update_config) and (not machine.published):
             raise HttpResponseException(HttpResponseForbidden("Bad auth"))
-        if not hashers.check_password(
-            self.req["machine"]["secret"],
-            machine.secret_hash,
-            setter=lambda password: hash_setter(machine, password),
-        ):
+        if not self.check_login("machine", machine.uuid, self.req["machine"], machine):
             raise HttpResponseException(HttpResponseForbidden("Bad auth"))
 
         return machine
@@ -289,7 +459,7 @@ class ViewV1:
             a = Auth.objects.get(name=auth_req["name"], secret_type=secret_type, active=True)
         except Auth.DoesNotExist:
             raise HttpResponseException(HttpResponseForbidden("Bad auth"))
-        if hashers.check_password(
+        if hashing.check_password(
             auth_req["secret"],
             a.secret_hash,
             setter=lambda password: hash_setter(a, password),
@@ -297,16 +467,44 @@ class ViewV1:
             return a
         raise HttpResponseException(HttpResponseForbidden("Bad auth"))
 
+    def session_token(self):
+        """Exchange a Machine or Storage secret for a session token
+
+        The token may be sent in place of the secret until it expires,
+        sparing the password hasher on each request.
+        """
+        ttl = tokens.ttl()
+        if not ttl:
+            raise HttpResponseException(HttpResponseNotFound("Session tokens are disabled"))
+        kind = "machine" if "machine" in self.req else "storage"
+        if not isinstance(self.req.get(kind), dict) or "secret" not in self.req[kind]:
+            raise HttpResponseException(HttpResponseForbidden("Bad auth"))
+        obj = self.machine_login() if kind == "machine" else self.storage_login()
+        return json_response({"token": tokens.issue(kind, obj), "expires_in": ttl})
+
     def update_config(self):
         machine = self.machine_login(is_update_config=True)
         req_machine = self.req["machine"]
+        req_config_hash = machine_config_hash(req_machine)
+
+        # Agents may send just a previously returned config_hash instead
+        # of the full config, or the full config may be identical to the
+        # last accepted one.  Either way, only the check-in is recorded.
+        unchanged_marker = "config_hash" in req_machine and "sources" not in req_machine
+        if machine is not None and machine.config_hash:
+            if (unchanged_marker and req_machine["config_hash"] == machine.config_hash) or (req_config_hash == machine.config_hash):
+                heartbeats.record(machine, timezone.localtime())
+                return json_response({"config_hash": machine.config_hash})
+        if unchanged_marker:
+            return HttpResponse("Config hash mismatch, full config required", status=409)
+
         modified = []
         new_machine = False
         if machine is None:
             # machine_login failed, so go ahead with creating a new Machine
             # (but only if get_registration_auth doesn't raise)
             machine = Machine(uuid=uuid.UUID(req_machine["uuid"]))
-            machine.secret_hash = hashers.make_password(req_machine["secret"])
+            machine.secret_hash = hashing.make_password(req_machine["secret"])
             machine.auth = self.get_registration_auth("machine_reg")
             new_machine = True
 
@@ -328,10 +526,7 @@ class ViewV1:
             new_storage_needed = True
         if new_storage_needed:
             try:
-                weights = {}
-                for storage in Storage.objects.filter(active=True, published=True):
-                    weights[storage] = storage.space_available
-                machine.storage = random_weighted(weights)
+                machine.storage = placement.choose()
                 modified.append("storage")
             except IndexError:
                 raise HttpResponseException(HttpResponseNotFound("No storages are currently available"))
@@ -358,205 +553,184 @@ class ViewV1:
                 machine.full_clean()
             except ValidationError as e:
                 raise HttpResponseException(HttpResponseBadRequest("Validation error: %s" % str(e)))
-        machine.date_checked_in = now
-        modified.append("date_checked_in")
         if new_machine:
+            machine.date_checked_in = now
             machine.save()
         elif modified:
+            machine.date_checked_in = now
             machine.save(update_fields=(modified + ["date_checked_in"]))
+        else:
+            heartbeats.record(machine, now)
 
         req_sources = req_machine.get("sources", {})
         if not isinstance(req_sources, dict):
             raise HttpResponseException(HttpResponseBadRequest('Invalid type for "sources"'))
 
-        sources_in_db = []
+        self.reconcile_sources(machine, req_sources)
+
+        # Record the accepted config, without triggering the
+        # invalidation signals
+        Machine.objects.filter(pk=machine.pk).update(config_hash=req_config_hash)
+        return json_response({"config_hash": req_config_hash})
+
+    def reconcile_sources(self, machine, req_sources):
+        """Bring a Machine's Sources in line with its requested config
+
+        The differences are computed and validated in memory, then
+        written with set-based queries in a single transaction.
+        """
+        for source_name, req_source in req_sources.items():
+            if not isinstance(req_source, dict):
+                raise HttpResponseException(HttpResponseBadRequest('Invalid type for source "%s"' % source_name))
+
+        now = timezone.localtime()
+        histogram = storage_slot_histogram(machine.storage)
+        sources_in_db = set()
+        unpublished = []
+        modified_groups = collections.defaultdict(list)
         for source in machine.source_set.all():
             if source.name not in req_sources:
-                source.published = False
-                source.save(update_fields=["published"])
+                if source.published:
+                    unpublished.append(source.id)
                 continue
-            sources_in_db.append(source.name)
+            sources_in_db.add(source.name)
+            req_source = req_sources[source.name]
 
             modified = []
-            for k in (
-                "path",
-                "frequency",
-                "retention",
-                "comment",
-                "shared_service",
-                "large_rotating_files",
-                "large_modifying_files",
-                "bwlimit",
-                "snapshot_mode",
-                "preserve_hard_links",
-            ):
-                if (k in req_sources[source.name]) and (getattr(source, k) != req_sources[source.name][k]):
-                    setattr(source, k, req_sources[source.name][k])
+            for k in SOURCE_CONFIG_FIELDS:
+                if (k in req_source) and (getattr(source, k) != req_source[k]):
                     if k == "frequency":
-                        source.date_next_backup = frequency_next_scheduled(req_sources[source.name][k], str(source.id))
-                    modified.append(k)
-            for k in ("filter", "exclude"):
-                if k not in req_sources[source.name]:
-                    continue
-                v = json.dumps(req_sources[source.name][k], sort_keys=True)
-                if getattr(source, k) != v:
-                    setattr(source, k, v)
+                        if histogram is not None:
+                            histogram.remove(source.frequency, source.date_next_backup)
+                        source.date_next_backup = frequency_next_scheduled(req_source[k], str(source.id), histogram=histogram)
+                        modified.append("date_next_backup")
+                    setattr(source, k, req_source[k])
                     modified.append(k)
 
             if not source.published:
                 source.published = True
                 modified.append("published")
             if modified:
-                source.date_updated = timezone.localtime()
+                source.date_updated = now
                 modified.append("date_updated")
-                try:
-                    source.full_clean()
-                except ValidationError as e:
-                    raise HttpResponseException(HttpResponseBadRequest("Validation error: %s" % str(e)))
-                source.save(update_fields=modified)
+                self.validate_source(source)
+                modified_groups[tuple(sorted(modified))].append(source)
 
-        for source_name in req_sources:
+        new_sources = []
+        for source_name, req_source in req_sources.items():
             if source_name in sources_in_db:
                 continue
             source = Source()
             source.name = source_name
             source.machine = machine
 
-            for k in (
-                "path",
-                "frequency",
-                "retention",
-                "comment",
-                "shared_service",
-                "large_rotating_files",
-                "large_modifying_files",
-                "bwlimit",
-                "snapshot_mode",
-                "preserve_hard_links",
-            ):
-                if k not in req_sources[source.name]:
-                    continue
-                setattr(source, k, req_sources[source.name][k])
-            for k in ("filter", "exclude"):
-                if k not in req_sources[source.name]:
+            for k in SOURCE_CONFIG_FIELDS:
+                if k not in req_source:
                     continue
-                v = json.dumps(req_sources[source.name][k], sort_keys=True)
-                setattr(source, k, v)
+                setattr(source, k, req_source[k])
 
             # New source, so schedule it regardless
-            source.date_next_backup = frequency_next_scheduled(source.frequency, str(source.id))
-
-            try:
-                source.full_clean()
-            except ValidationError as e:
-                raise HttpResponseException(HttpResponseBadRequest("Validation error: %s" % str(e)))
-            source.save()
-
-        return HttpResponse(json.dumps({}), content_type="application/json")
-
-    def build_filters(self, set, loaded_sets=None):
-        if not loaded_sets:
-            loaded_sets = []
-        out = []
-        for f in set:
-            try:
-                verb, subsetname = f.split(" ", 1)
-            except ValueError:
-                continue
-            if verb in ("merge", "."):
-                if subsetname in loaded_sets:
-                    continue
-                try:
-                    fs = FilterSet.objects.get(name=subsetname, active=True)
-                except FilterSet.DoesNotExist:
-                    continue
-                for f2 in self.build_filters(json.loads(fs.filters), loaded_sets):
-                    out.append(f2)
-                loaded_sets.append(subsetname)
-            elif verb in (
-                "dir-merge",
-                ":",
-                "clear",
-                "!",
-                "exclude",
-                "-",
-                "include",
-                "+",
-                "hide",
-                "H",
-                "show",
-                "S",
-                "protect",
-                "P",
-                "risk",
-                "R",
-            ):
-                out.append(f)
-        return out
+            source.date_next_backup = frequency_next_scheduled(source.frequency, str(source.id), histogram=histogram)
+            self.validate_source(source)
+            new_sources.append(source)
+
+        with transaction.atomic():
+            if unpublished:
+                Source.objects.filter(id__in=unpublished).update(published=False)
+            # Sources modified in the same way are updated together, so
+            # unmodified fields are never written back
+            for fields, sources in modified_groups.items():
+                Source.objects.bulk_update(sources, fields)
+            if new_sources:
+                Source.objects.bulk_create(new_sources)
+
+    def validate_source(self, source):
+        # The machine has just been loaded or saved, and names are
+        # unique by construction of the diff, so skip the per-row
+        # foreign key and uniqueness queries
+        try:
+            source.full_clean(exclude=["machine"], validate_unique=False)
+        except ValidationError as e:
+            raise HttpResponseException(HttpResponseBadRequest("Validation error: %s" % str(e)))
 
     def get_checkin_scheduled_sources(self, m):
-        scheduled_sources = {}
         now = timezone.localtime()
-        for source in m.source_set.filter(date_next_backup__lte=now, active=True, published=True):
-            scheduled_sources[source.name] = {
-                "path": source.path,
-                "retention": source.retention,
-                "bwlimit": source.bwlimit,
-                "filter": self.build_filters(json.loads(source.filter)),
-                "exclude": json.loads(source.exclude),
-                "shared_service": source.shared_service,
-                "large_rotating_files": source.large_rotating_files,
-                "large_modifying_files": source.large_modifying_files,
-                "snapshot_mode": source.snapshot_mode,
-                "preserve_hard_links": source.preserve_hard_links,
-                "storage": {
-                    "name": source.machine.storage.name,
-                    "ssh_ping_host": source.machine.storage.ssh_ping_host,
-                    "ssh_ping_host_keys": json.loads(source.machine.storage.ssh_ping_host_keys),
-                    "ssh_ping_port": source.machine.storage.ssh_ping_port,
-                    "ssh_ping_user": source.machine.storage.ssh_ping_user,
-                },
-            }
-        return scheduled_sources
+        sources = m.source_set.filter(date_next_backup__lte=now, active=True, published=True)
+        return SourceResponseBuilder(m.storage).build(sources)
 
     def agent_ping_checkin(self):
         machine = self.machine_login()
         scheduled_sources = self.get_checkin_scheduled_sources(machine)
         now = timezone.localtime()
+        heartbeats.record(machine, now)
+
+        if not scheduled_sources:
+            scheduled_sources = self.wait_checkin_scheduled_sources(machine)
 
         out = {"machine": {"scheduled_sources": scheduled_sources}}
 
-        machine.date_checked_in = now
-        machine.save(update_fields=["date_checked_in"])
-        return HttpResponse(json.dumps(out), content_type="application/json")
+        return json_response(out)
+
+    def requested_wait(self):
+        try:
+            wait = float(self.req["machine"].get("wait", 0))
+        except (TypeError, ValueError):
+            raise HttpResponseException(HttpResponseBadRequest('Invalid type for "machine.wait"'))
+        if not math.isfinite(wait):
+            raise HttpResponseException(HttpResponseBadRequest('Invalid type for "machine.wait"'))
+        return max(0.0, min(wait, getattr(settings, "TURKU_LONGPOLL_MAX_WAIT", 300)))
+
+    def wait_checkin_scheduled_sources(self, machine):
+        """Long-poll until a source is due, if requested by the agent
+
+        The agent asks for this with "wait" (in seconds) in its machine
+        block.  The wait ends early when the earliest scheduled source
+        comes due or one of the machine's sources is changed in this
+        process, and sources are re-checked every
+        TURKU_LONGPOLL_RECHECK seconds to notice changes made elsewhere.
+        A waiting check-in holds a worker thread, so this is disabled
+        unless TURKU_LONGPOLL_MAX_WAITERS is set.
+        """
+        if not waits.max_waiters:
+            return {}
+        deadline = time.monotonic() + self.requested_wait()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {}
+            next_backup = machine.source_set.filter(active=True, published=True).aggregate(next_backup=Min("date_next_backup"))[
+                "next_backup"
+            ]
+            timeout = longpoll_timeout(remaining, next_backup)
+            if waits.wait(machine.pk, timeout) is None:
+                # Too many agents are already waiting
+                return {}
+            scheduled_sources = self.get_checkin_scheduled_sources(machine)
+            if scheduled_sources:
+                return scheduled_sources
 
     def agent_ping_restore(self):
         machine = self.machine_login()
-        sources = {}
-        for source in machine.source_set.filter(active=True):
-            sources[source.name] = {
-                "path": source.path,
-                "retention": source.retention,
-                "bwlimit": source.bwlimit,
-                "filter": self.build_filters(json.loads(source.filter)),
-                "exclude": json.loads(source.exclude),
-                "shared_service": source.shared_service,
-                "large_rotating_files": source.large_rotating_files,
-                "large_modifying_files": source.large_modifying_files,
-                "snapshot_mode": source.snapshot_mode,
-                "preserve_hard_links": source.preserve_hard_links,
-                "storage": {
-                    "name": source.machine.storage.name,
-                    "ssh_ping_host": source.machine.storage.ssh_ping_host,
-                    "ssh_ping_host_keys": json.loads(source.machine.storage.ssh_ping_host_keys),
-                    "ssh_ping_port": source.machine.storage.ssh_ping_port,
-                    "ssh_ping_user": source.machine.storage.ssh_ping_user,
-                },
-            }
+
+        # Every change to a source or FilterSet moves its date_updated,
+        # so the ETag can be checked without building the response.
+        # The filter cache may be stale for changes made in another
+        # process, so the response is built from freshly loaded
+        # FilterSets to match the ETag's markers.
+        builder = SourceResponseBuilder(machine.storage)
+        sources = machine.source_set.filter(active=True)
+        etag = response_etag(
+            "agent_ping_restore",
+            builder.storage_out,
+            list(sources.order_by("id").values_list("id", "date_updated")),
+            list(FilterSet.objects.order_by("id").values_list("id", "date_updated")),
+        )
+        self.check_not_modified(etag)
+        sources = builder.build(sources, use_cache=False)
 
         out = {"machine": {"sources": sources}}
 
-        return HttpResponse(json.dumps(out), content_type="application/json")
+        return self.etag_response(out, etag)
 
     def storage_ping_checkin(self):
         storage = self.storage_login()
@@ -574,9 +748,47 @@ class ViewV1:
                 "scheduled_sources": scheduled_sources,
             }
         }
-        machine.date_checked_in = now
-        machine.save(update_fields=["date_checked_in"])
-        return HttpResponse(json.dumps(out), content_type="application/json")
+        heartbeats.record(machine, now)
+        return json_response(out)
+
+    def storage_ping_checkin_batch(self):
+        """Check in many of a Storage's machines with one authentication
+
+        Machines which aren't found (or aren't active, published and
+        assigned to this Storage) are listed in machines_not_found.
+        """
+        storage = self.storage_login()
+        req_machines = self.req.get("machines")
+        if not isinstance(req_machines, list):
+            raise HttpResponseException(HttpResponseBadRequest('"machines" list required'))
+        max_machines = getattr(settings, "TURKU_MAX_BATCH_MACHINES", 10000)
+        if max_machines and len(req_machines) > max_machines:
+            raise HttpResponseException(HttpResponseBadRequest('Too many machines in "machines"'))
+        try:
+            machine_uuids = {uuid.UUID(machine_uuid): machine_uuid for machine_uuid in req_machines}
+        except (TypeError, ValueError, AttributeError):
+            raise HttpResponseException(HttpResponseBadRequest('Invalid UUID in "machines"'))
+
+        now = timezone.localtime()
+        machines = Machine.objects.filter(uuid__in=list(machine_uuids), storage=storage, active=True, published=True)
+        machines = list(machines.only("id", "uuid", "environment_name", "service_name", "unit_name"))
+        sources = Source.objects.filter(
+            machine__in=[machine.pk for machine in machines], date_next_backup__lte=now, active=True, published=True
+        )
+        scheduled_sources = SourceResponseBuilder(storage).build_by_machine(sources)
+
+        out = {"machines": {}, "machines_not_found": []}
+        for machine in machines:
+            out["machines"][str(machine.uuid)] = {
+                "environment_name": machine.environment_name,
+                "service_name": machine.service_name,
+                "unit_name": machine.unit_name,
+                "scheduled_sources": scheduled_sources.get(machine.pk, {}),
+            }
+            del machine_uuids[machine.uuid]
+        out["machines_not_found"] = sorted(machine_uuids.values())
+        heartbeats.record_many(Machine, [machine.pk for machine in machines], now)
+        return json_response(out)
 
     def storage_ping_source_update(self):
         storage = self.storage_login()
@@ -584,34 +796,64 @@ class ViewV1:
 
         if "sources" not in self.req["machine"]:
             raise HttpResponseException(HttpResponseBadRequest('Missing required option "machine.sources"'))
-        for source_name in self.req["machine"]["sources"]:
-            source_data = self.req["machine"]["sources"][source_name]
-            try:
-                source = machine.source_set.get(name=source_name, active=True, published=True)
-            except Source.DoesNotExist:
-                raise HttpResponseException(HttpResponseNotFound("Source not found"))
-            now = timezone.localtime()
-            is_success = "success" in source_data and source_data["success"]
-            source.success = is_success
-            if is_success:
-                source.date_last_backed_up = now
-                source.date_next_backup = frequency_next_scheduled(source.frequency, str(source.id), now)
-            source.save(update_fields=["date_last_backed_up", "date_next_backup"])
+        req_sources = self.req["machine"]["sources"]
+        if not isinstance(req_sources, dict):
+            raise HttpResponseException(HttpResponseBadRequest('Invalid type for "machine.sources"'))
+
+        now = timezone.localtime()
+        sources = {
+            source.name: source for source in machine.source_set.filter(name__in=list(req_sources), active=True, published=True)
+        }
+        histogram = storage_slot_histogram(storage)
+        errors = {}
+        updated_sources = []
+        backup_logs = []
+        for source_name, source_data in req_sources.items():
+            if source_name not in sources:
+                errors[source_name] = HttpResponseNotFound("Source not found")
+                continue
+            if not isinstance(source_data, dict):
+                errors[source_name] = HttpResponseBadRequest("Invalid source data")
+                continue
+            source = sources[source_name]
             backup_log = BackupLog()
             backup_log.source = source
             backup_log.date = now
             backup_log.storage = storage
-            backup_log.success = is_success
+            backup_log.success = "success" in source_data and source_data["success"]
             if "snapshot" in source_data:
                 backup_log.snapshot = source_data["snapshot"]
             if "summary" in source_data:
                 backup_log.summary = source_data["summary"]
-            if "time_begin" in source_data:
-                backup_log.date_begin = timezone.make_aware(datetime.utcfromtimestamp(source_data["time_begin"]))
-            if "time_end" in source_data:
-                backup_log.date_end = timezone.make_aware(datetime.utcfromtimestamp(source_data["time_end"]))
-            backup_log.save()
-        return HttpResponse(json.dumps({}), content_type="application/json")
+            try:
+                if "time_begin" in source_data:
+                    backup_log.date_begin = timezone.make_aware(datetime.utcfromtimestamp(source_data["time_begin"]))
+                if "time_end" in source_data:
+                    backup_log.date_end = timezone.make_aware(datetime.utcfromtimestamp(source_data["time_end"]))
+            except (TypeError, ValueError, OverflowError, OSError):
+                errors[source_name] = HttpResponseBadRequest("Invalid time_begin/time_end")
+                continue
+
+            source.success = backup_log.success
+            if backup_log.success:
+                source.date_last_backed_up = now
+                if histogram is not None:
+                    histogram.remove(source.frequency, source.date_next_backup)
+                source.date_next_backup = frequency_next_scheduled(source.frequency, str(source.id), now, histogram)
+            updated_sources.append(source)
+            backup_logs.append(backup_log)
+
+        if errors and not updated_sources:
+            # Nothing could be processed; fail the request as a whole
+            raise HttpResponseException(list(errors.values())[0])
+        with transaction.atomic():
+            Source.objects.bulk_update(updated_sources, ["success", "date_last_backed_up", "date_next_backup"])
+            BackupLog.objects.bulk_create(backup_logs)
+
+        out = {}
+        if errors:
+            out["errors"] = {source_name: e.content.decode("UTF-8") for source_name, e in errors.items()}
+        return json_response(out)
 
     def storage_update_config(self):
         storage = self.storage_login(is_update_config=True)
@@ -623,7 +865,7 @@ class ViewV1:
             # storage_login failed, so go ahead with creating a new Storage
             # (but only if get_registration_auth doesn't raise)
             storage = Storage(name=req_storage["name"])
-            storage.secret_hash = hashers.make_password(req_storage["secret"])
+            storage.secret_hash = hashing.make_password(req_storage["secret"])
             storage.auth = self.get_registration_auth("storage_reg")
             new_storage = True
 
@@ -647,19 +889,12 @@ class ViewV1:
             "ssh_ping_user",
             "space_total",
             "space_available",
+            "ssh_ping_host_keys",
         ):
             if (k in req_storage) and (getattr(storage, k) != req_storage[k]):
                 setattr(storage, k, req_storage[k])
                 modified.append(k)
 
-        for k in ("ssh_ping_host_keys",):
-            if k not in req_storage:
-                continue
-            v = json.dumps(req_storage[k], sort_keys=True)
-            if getattr(storage, k) != v:
-                setattr(storage, k, v)
-                modified.append(k)
-
         # Validate/save if modified
         now = timezone.localtime()
         if modified:
@@ -669,15 +904,36 @@ class ViewV1:
                 storage.full_clean()
             except ValidationError as e:
                 raise HttpResponseException(HttpResponseBadRequest("Validation error: %s" % str(e)))
-        storage.date_checked_in = now
-        modified.append("date_checked_in")
         if new_storage:
+            storage.date_checked_in = now
             storage.save()
         elif modified:
+            storage.date_checked_in = now
             storage.save(update_fields=(modified + ["date_checked_in"]))
+        else:
+            heartbeats.record(storage, now)
+
+        # If the storage unit presents the token of its last machine
+        # list, only send the machines changed since then
+        generation = storage.machines_generation
+        try:
+            token = int(req_storage["machines_token"])
+        except (KeyError, TypeError, ValueError):
+            token = None
+        full = token is None or token < storage.machines_resync_generation or token > generation
+        etag = response_etag("storage_update_config", str(storage.pk), generation, None if full else token)
+        self.check_not_modified(etag)
+        if full:
+            machine_query = Machine.objects.filter(storage=storage, active=True, published=True)
+        else:
+            machine_query = Machine.objects.filter(storage=storage, storage_generation__gt=token)
 
         machines = {}
-        for machine in Machine.objects.filter(storage=storage, active=True, published=True):
+        removed = []
+        for machine in machine_query:
+            if not (machine.active and machine.published):
+                removed.append(str(machine.uuid))
+                continue
             machines[str(machine.uuid)] = {
                 "environment_name": machine.environment_name,
                 "service_name": machine.service_name,
@@ -685,7 +941,10 @@ class ViewV1:
                 "comment": machine.comment,
                 "ssh_public_key": machine.ssh_public_key,
             }
-        return HttpResponse(json.dumps({"machines": machines}), content_type="application/json")
+        out = {"machines": machines, "machines_token": str(generation), "machines_full": full}
+        if not full:
+            out["machines_removed"] = removed
+        return self.etag_response(out, etag)
 
     def health(self):
         # This is a general purpose test of the API server (its ability
@@ -702,18 +961,35 @@ class ViewV1:
                 "filter_set": FilterSet.objects.count(),
                 "backup_log": BackupLog.objects.count(),
             },
+            "metrics": metrics.snapshot(),
         }
-        return HttpResponse(json.dumps(out), content_type="application/json")
+        return json_response(out)
 
 
 @csrf_exempt
 def view_handler(request):
     namespace_map = {"v1": ViewV1}
-    try:
-        namespace, name = request.resolver_match.view_name.split(":", 1)
-        return getattr(namespace_map[namespace](request), name).__call__()
-    except HttpResponseException as e:
-        return e.message
+    namespace, name = request.resolver_match.view_name.split(":", 1)
+    with instrument(name) as stats:
+        try:
+            stats.response = getattr(namespace_map[namespace](request), name).__call__()
+        except HttpResponseException as e:
+            stats.response = e.message
+        except hashing.HasherSaturated as e:
+            stats.response = hasher_saturated_response(e)
+    return stats.response
+
+
+def hasher_saturated_response(e):
+    response = HttpResponse("Password hasher busy, try again later", status=503)
+    response["Retry-After"] = str(e.retry_after)
+    return response
+
+
+def prometheus_metrics(request):
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    return HttpResponse(metrics.prometheus_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 urls = (